@@ -0,0 +1,307 @@
+"""
+Admission control and priority queuing in front of LLM calls.
+
+Nothing used to limit how many generations hit the provider at once: bursts
+ran into provider 429s and every request then failed after a long wait.
+Each LLM call now takes a slot from an AdmissionController first:
+
+- token buckets per provider for requests/minute and tokens/minute, so we
+  stay under the provider's limits instead of discovering them via 429s;
+- priority classes: interactive queries are always dispatched before
+  batch work (exports, speculative generation);
+- fair queuing within a class: clients are served round-robin, so one
+  client's burst cannot starve everyone else;
+- load shedding: when the queue is deeper than we can drain in time, new
+  calls fail immediately with Overloaded(retry_after) instead of waiting.
+
+Callers turn Overloaded into "503 Retry-After" or serve a stale result.
+
+Limits are configured for the whole deployment and divided evenly between
+the WEB_CONCURRENCY server processes (gunicorn.conf.py exports it). Each
+process enforces its share locally, without coordinating with the others,
+so the provider sees at most the configured rates. A process gets at least
+one call in flight.
+"""
+import os
+import math
+import time
+import itertools
+import threading
+import contextvars
+from collections import OrderedDict, deque
+
+INTERACTIVE = 0
+BATCH = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BATCH: "batch"}
+
+# Server processes sharing the configured limits.
+PROCESSES = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+MAX_IN_FLIGHT = max(1, int(os.getenv("LLM_MAX_IN_FLIGHT", 8)) // PROCESSES)
+# Queue depth at which new calls of each class are shed; batch work gives way first.
+SHED_DEPTH = {
+    INTERACTIVE: int(os.getenv("LLM_SHED_DEPTH", 64)),
+    BATCH: int(os.getenv("LLM_SHED_DEPTH_BATCH", 16)),
+}
+# Longest a call may wait in the queue before it is rejected.
+QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", 20))
+# Completion budget assumed when reserving tokens before the call.
+EXPECTED_OUTPUT_TOKENS = 600
+
+# Who is calling, set per request by the route: (client key, priority class).
+caller = contextvars.ContextVar("llm_caller", default=("anonymous", INTERACTIVE))
+
+
+def estimate_tokens(text):
+    return len(text) // 4 + 1
+
+
+class Overloaded(Exception):
+    """The call was not admitted; retry_after is a hint in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"{reason} (retry after {retry_after}s)")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Cancelled(Exception):
+    """The caller gave up on the call (e.g. a hedge that lost the race)."""
+
+
+class TokenBucket:
+    """Refills continuously at per_minute / 60 per second, up to per_minute."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount is available (0 if it is available now)."""
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount):
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class ProviderBudget:
+    """Requests/minute and tokens/minute for one provider."""
+
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+
+    def wait_time(self, tokens):
+        return max(self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+    def take(self, tokens):
+        self.requests.take(1)
+        self.tokens.take(tokens)
+
+
+def budget_from_env(provider, rpm, tpm):
+    """This process's share of the provider's deployment-wide limits."""
+    name = provider.upper()
+    return ProviderBudget(int(os.getenv(f"LLM_RPM_{name}", rpm)) / PROCESSES,
+                          int(os.getenv(f"LLM_TPM_{name}", tpm)) / PROCESSES)
+
+
+class _Ticket:
+    def __init__(self, client, priority, provider, tokens):
+        self.client = client
+        self.priority = priority
+        self.provider = provider
+        self.tokens = tokens
+        self.enqueued = time.monotonic()
+        self.admitted = None
+
+
+class Slot:
+    """Held for the duration of one LLM call; report actual usage via used()."""
+
+    def __init__(self, controller, ticket):
+        self.controller = controller
+        self.ticket = ticket
+        self.actual_tokens = None
+        self.released = False
+        self.lock = threading.Lock()
+
+    def used(self, tokens):
+        self.actual_tokens = tokens
+
+    def release(self):
+        """
+        Frees the slot now; later calls do nothing. An abandoned call gives its
+        place back before the provider answers. Its token reservation stays
+        spent, since the provider still processes the request.
+        """
+        with self.lock:
+            if self.released:
+                return
+            self.released = True
+        self.controller._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+class AdmissionController:
+    def __init__(self, budgets, max_in_flight=MAX_IN_FLIGHT, shed_depth=None,
+                 queue_timeout=QUEUE_TIMEOUT_SECONDS):
+        self.budgets = budgets
+        self.max_in_flight = max_in_flight
+        self.shed_depth = shed_depth or dict(SHED_DEPTH)
+        self.queue_timeout = queue_timeout
+        self.condition = threading.Condition()
+        # priority -> client -> deque of tickets; client order is the round-robin order.
+        self.queues = {priority: OrderedDict() for priority in PRIORITY_NAMES}
+        self.in_flight = 0
+        self.service_seconds = 2.0   # moving average of call duration, for Retry-After
+        self.stats = {"admitted": 0, "shed": 0, "timed_out": 0, "throttled": 0}
+
+    # --- queue ---
+    def depth(self, priority=None):
+        priorities = PRIORITY_NAMES if priority is None else [priority]
+        return sum(len(q) for p in priorities for q in self.queues[p].values())
+
+    def saturated(self):
+        """True once interactive calls would wait longer than half the queue timeout."""
+        return self.retry_after() > self.queue_timeout / 2
+
+    def retry_after(self):
+        waiting = self.depth() + self.in_flight
+        return max(1, math.ceil(waiting * self.service_seconds / self.max_in_flight))
+
+    def _next(self):
+        """
+        (first ticket that may go now, {provider: seconds until its budget has
+        room}). Tickets are taken in priority order, then round-robin across
+        clients. A provider out of budget is skipped, so its tickets wait
+        without holding up calls to other providers.
+        """
+        throttled = {}
+        for priority in sorted(self.queues):
+            for row in itertools.zip_longest(*self.queues[priority].values()):
+                for ticket in row:
+                    if ticket is None or ticket.provider in throttled:
+                        continue
+                    budget = self.budgets.get(ticket.provider)
+                    throttle = budget.wait_time(ticket.tokens) if budget else 0.0
+                    if throttle == 0.0:
+                        return ticket, throttled
+                    throttled[ticket.provider] = throttle
+        return None, throttled
+
+    def _dequeue(self, ticket):
+        clients = self.queues[ticket.priority]
+        tickets = clients.pop(ticket.client)
+        tickets.remove(ticket)
+        if tickets:
+            # Back of the round-robin order: other clients go first next time.
+            clients[ticket.client] = tickets
+
+    def _remove(self, ticket):
+        clients = self.queues[ticket.priority]
+        tickets = clients.get(ticket.client)
+        if tickets and ticket in tickets:
+            tickets.remove(ticket)
+            if not tickets:
+                del clients[ticket.client]
+
+    # --- admission ---
+    def slot(self, provider, prompt_tokens, client=None, priority=None, cancelled=None, deadline=None):
+        """
+        Blocks until this call may go to the provider and returns a Slot to
+        use as a context manager. Raises Overloaded instead of queueing when
+        the queue is too deep or the wait exceeds the queue timeout (or the
+        caller's own deadline, a time.monotonic() value), and Cancelled once
+        the cancelled event is set (see wake()).
+        """
+        default_client, default_priority = caller.get()
+        client = client or default_client
+        priority = default_priority if priority is None else priority
+        ticket = _Ticket(client, priority, provider, prompt_tokens + EXPECTED_OUTPUT_TOKENS)
+        budget = self.budgets.get(provider)
+        deadline = min(ticket.enqueued + self.queue_timeout, deadline or float("inf"))
+        with self.condition:
+            if self.depth(priority) >= self.shed_depth[priority]:
+                self.stats["shed"] += 1
+                raise Overloaded(f"{PRIORITY_NAMES[priority]} queue full", self.retry_after())
+            self.queues[priority].setdefault(client, deque()).append(ticket)
+            try:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise Cancelled("left the queue")
+                    wait = deadline - time.monotonic()
+                    if wait <= 0:
+                        self.stats["timed_out"] += 1
+                        raise Overloaded("queue wait exceeded", self.retry_after())
+                    if self.in_flight < self.max_in_flight:
+                        head, throttled = self._next()
+                        if head is ticket:
+                            break
+                        if provider in throttled:
+                            self.stats["throttled"] += 1
+                        if throttled:
+                            # Nothing signals a refill: wake up when the first budget has room.
+                            wait = min(wait, min(throttled.values()))
+                    self.condition.wait(wait)
+                self._dequeue(ticket)
+            except BaseException:
+                self._remove(ticket)
+                self.condition.notify_all()
+                raise
+            if budget:
+                budget.take(ticket.tokens)
+            self.in_flight += 1
+            ticket.admitted = time.monotonic()
+            self.stats["admitted"] += 1
+            # The next ticket may be dispatchable too.
+            self.condition.notify_all()
+        return Slot(self, ticket)
+
+    def wake(self):
+        """Wakes queued callers, e.g. so that cancelled ones leave the queue."""
+        with self.condition:
+            self.condition.notify_all()
+
+    def _release(self, slot):
+        ticket = slot.ticket
+        with self.condition:
+            self.in_flight -= 1
+            elapsed = time.monotonic() - ticket.admitted
+            self.service_seconds = 0.8 * self.service_seconds + 0.2 * elapsed
+            budget = self.budgets.get(ticket.provider)
+            if budget and slot.actual_tokens is not None:
+                # Settle the reservation against what the provider reported.
+                if slot.actual_tokens < ticket.tokens:
+                    budget.tokens.give_back(ticket.tokens - slot.actual_tokens)
+                else:
+                    budget.tokens.take(slot.actual_tokens - ticket.tokens)
+            self.condition.notify_all()
+
+    def snapshot(self):
+        with self.condition:
+            return {
+                **self.stats,
+                "in_flight": self.in_flight,
+                "queued": {PRIORITY_NAMES[p]: self.depth(p) for p in PRIORITY_NAMES},
+                "retry_after": self.retry_after(),
+            }
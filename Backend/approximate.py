@@ -0,0 +1,311 @@
+"""
+Approximate answers from a sample, for expensive trade aggregations.
+
+A group-by over all of `trades` is a full scan, and the user sees nothing
+until it finishes. For decomposable aggregations - a row-level prefix
+followed by $count, or by a $group of $sum/$avg/$count with an optional
+$sort/$skip/$limit (top-N) - the same pipeline runs on a sample first:
+
+- on the precomputed stratified sample `trades_sample` (one stratum per
+  year_id, rebuilt with `python approximate.py build-sample`), or else on
+  a `$sample` of the trades collection itself;
+- per group and stratum the sample yields sum(y) and sum(y^2), which give
+  the scaled estimate and its variance (stratified expansion estimator
+  for sums and counts, ratio estimator for averages);
+- estimates carry a 95% confidence interval, and the top-N tail is applied
+  to the estimates.
+
+The server streams the estimate first and the exact result when the full
+query completes (see /api/trade/progressive).
+
+  python approximate.py build-sample [--size N]   # (re)build trades_sample
+  python approximate.py status
+"""
+import os
+import sys
+import math
+import argparse
+from partitioning import PartitionRouter, PYTHON_TAIL_STAGES, sort_key, _group_key
+
+SOURCE = "trades"
+SAMPLE_COLLECTION = "trades_sample"
+STRATA_COLLECTION = "trades_sample_strata"
+STRATUM_FIELD = "_stratum"
+STRATUM_KEY = "year_id"
+SAMPLE_SIZE = int(os.getenv("APPROX_SAMPLE_SIZE", 20000))
+# Small strata still get enough rows for a usable variance.
+MIN_PER_STRATUM = 200
+# Below this many trades the exact query is fast enough on its own.
+MIN_POPULATION = int(os.getenv("APPROX_MIN_POPULATION", SAMPLE_SIZE * 5))
+CONFIDENCE = 0.95
+Z = 1.96
+ESTIMABLE_ACCUMULATORS = {"$sum", "$avg", "$count"}
+
+
+# --- Planning ---
+def plan(pipeline):
+    """
+    (prefix, $group body, tail, count field) for a pipeline that can be
+    estimated from a sample, else None.
+    """
+    prefix, tail = PartitionRouter.split(pipeline)
+    if not tail:
+        return None
+    (head, body), = tail[0].items()
+    if head == "$count":
+        if len(tail) != 1:
+            return None
+        return prefix, {"_id": None, body: {"$count": {}}}, [], body
+    if head != "$group":
+        return None
+    for field, accumulator in body.items():
+        if field == "_id":
+            continue
+        if not isinstance(accumulator, dict) or len(accumulator) != 1:
+            return None
+        if next(iter(accumulator)) not in ESTIMABLE_ACCUMULATORS:
+            return None
+    if not all(next(iter(stage)) in PYTHON_TAIL_STAGES for stage in tail[1:]):
+        return None
+    return prefix, body, tail[1:], None
+
+
+def _square(expression):
+    return {"$cond": [{"$isNumber": expression}, {"$multiply": [expression, expression]}, 0]}
+
+
+def partial_group(group, stratified):
+    """Per group and stratum sums of y and y^2 for every accumulator."""
+    partial = {"_id": {"g": group["_id"], "s": f"${STRATUM_FIELD}" if stratified else None}}
+    kinds = {}
+    for field, accumulator in group.items():
+        if field == "_id":
+            continue
+        (operator, expression), = accumulator.items()
+        if operator == "$count":
+            operator, expression = "$sum", 1
+        if operator == "$sum":
+            partial[f"{field}__y"] = {"$sum": expression}
+            partial[f"{field}__y2"] = {"$sum": _square(expression)}
+        else:
+            partial[f"{field}__x"] = {"$sum": expression}
+            partial[f"{field}__x2"] = {"$sum": _square(expression)}
+            partial[f"{field}__c"] = {"$sum": {"$cond": [{"$isNumber": expression}, 1, 0]}}
+        kinds[field] = "count" if expression == 1 else operator
+    return partial, kinds
+
+
+# --- Estimation ---
+def _variance(total, squares, n):
+    """Sample variance of y over all n sampled rows (rows outside the group count as 0)."""
+    if n < 2:
+        return 0.0
+    return max(0.0, (squares - total * total / n) / (n - 1))
+
+
+def _expansion(partials, strata, field):
+    """Stratified estimate of a population total and its variance."""
+    estimate = variance = 0.0
+    for stratum, row in partials.items():
+        population, size = strata[stratum]
+        total, squares = row.get(f"{field}__y") or 0, row.get(f"{field}__y2") or 0
+        estimate += population / size * total
+        variance += population ** 2 * (1 - size / population) * _variance(total, squares, size) / size
+    return estimate, variance
+
+
+def _ratio(partials, strata, field):
+    """Ratio estimate of a group mean and its linearized variance."""
+    values = counts = 0.0
+    for stratum, row in partials.items():
+        population, size = strata[stratum]
+        values += population / size * (row.get(f"{field}__x") or 0)
+        counts += population / size * (row.get(f"{field}__c") or 0)
+    if not counts:
+        return None, 0.0
+    ratio = values / counts
+    variance = 0.0
+    for stratum, row in partials.items():
+        population, size = strata[stratum]
+        x, x2, c = (row.get(f"{field}__{part}") or 0 for part in ("x", "x2", "c"))
+        # Residuals d = x - ratio * c; c is 0/1 per row, so x*c = x and c^2 = c.
+        d, d2 = x - ratio * c, x2 - 2 * ratio * x + ratio * ratio * c
+        variance += population ** 2 * (1 - size / population) * _variance(d, d2, size) / size
+    return ratio, variance / (counts * counts)
+
+
+def estimate_rows(partial_rows, strata, kinds):
+    """Merges per-stratum partials into estimated rows with confidence intervals."""
+    groups = {}
+    for row in partial_rows:
+        key = _group_key(row["_id"].get("g"))
+        stratum = row["_id"].get("s")
+        groups.setdefault(key, (row["_id"].get("g"), {}))[1][stratum] = row
+    results = []
+    for group_id, partials in groups.values():
+        row = {"_id": group_id}
+        bounds = {}
+        for field, kind in kinds.items():
+            if kind == "$avg":
+                value, variance = _ratio(partials, strata, field)
+            else:
+                value, variance = _expansion(partials, strata, field)
+            if value is None:
+                row[field] = None
+                continue
+            margin = Z * math.sqrt(variance)
+            low, high = value - margin, value + margin
+            if kind == "count":
+                value, low, high = round(value), max(0, math.floor(low)), math.ceil(high)
+            row[field] = value
+            bounds[field] = {
+                "low": low,
+                "high": high,
+                "relative_error": round(margin / abs(value), 4) if value else None,
+            }
+        row["_error"] = bounds
+        results.append(row)
+    return results
+
+
+def apply_tail(rows, stages):
+    for stage in stages:
+        (name, body), = stage.items()
+        if name == "$sort":
+            rows.sort(key=sort_key(body))
+        elif name == "$skip":
+            rows = rows[body:]
+        else:
+            rows = rows[:body]
+    return rows
+
+
+# --- Sampler ---
+class Approximator:
+    """
+    Estimates trade aggregations from trades_sample when it has been built,
+    else from a $sample of trades.
+    """
+
+    def __init__(self, db, sample_size=SAMPLE_SIZE, min_population=MIN_POPULATION):
+        self.db = db
+        self.sample_size = sample_size
+        self.min_population = min_population
+        self.strata = {}   # stratum -> (population, sample size), from the strata collection
+        self.stats = {"estimated": 0, "skipped": 0}
+
+    def refresh(self):
+        self.strata = {row["stratum"]: (row["population"], row["size"])
+                       for row in self.db.get_collection(STRATA_COLLECTION).find({}, {"_id": 0})
+                       if row.get("size")}
+        return self.strata
+
+    @property
+    def method(self):
+        return "stratified" if self.strata else "$sample"
+
+    def _sample_plan(self):
+        """(collection, sampling stages, strata) or None if the population is small."""
+        if self.strata:
+            population = sum(population for population, _ in self.strata.values())
+            if population < self.min_population:
+                return None
+            return self.db.get_collection(SAMPLE_COLLECTION), [], dict(self.strata)
+        source = self.db.get_collection(SOURCE)
+        population = source.estimated_document_count()
+        if population < self.min_population:
+            return None
+        size = min(self.sample_size, population)
+        return source, [{"$sample": {"size": size}}], {None: (population, size)}
+
+    def estimate(self, pipeline):
+        """
+        Returns {"mode", "confidence", "sample", "error_bounds", "results"}
+        for a trades pipeline, or None when it cannot (or need not) be estimated.
+        """
+        planned = plan(pipeline)
+        sampled = self._sample_plan() if planned is not None else None
+        if sampled is None:
+            self.stats["skipped"] += 1
+            return None
+        prefix, group, tail, count_field = planned
+        collection, sampling, strata = sampled
+        partial, kinds = partial_group(group, stratified=bool(self.strata))
+        partial_rows = list(collection.aggregate(sampling + prefix + [{"$group": partial}], allowDiskUse=True))
+        rows = estimate_rows(partial_rows, strata, kinds)
+        if count_field is not None:
+            # {"$count": "n"} returns no document when nothing matches.
+            rows = [{count_field: row[count_field], "_error": row["_error"]} for row in rows if row[count_field]]
+        rows = apply_tail(rows, tail)
+        errors = [bound["relative_error"] for row in rows for bound in row["_error"].values()
+                  if bound["relative_error"] is not None]
+        self.stats["estimated"] += 1
+        population = sum(population for population, _ in strata.values())
+        sample_size = sum(size for _, size in strata.values())
+        print(f"--- Approximate answer from {sample_size}/{population} sampled trade(s) ({self.method})")
+        return {
+            "mode": "approximate",
+            "confidence": CONFIDENCE,
+            "sample": {"method": self.method, "size": sample_size, "population": population,
+                       "fraction": round(sample_size / population, 6)},
+            "error_bounds": {"max_relative_error": max(errors) if errors else None},
+            "results": rows,
+        }
+
+    def snapshot(self):
+        return {**self.stats, "method": self.method, "strata": len(self.strata)}
+
+
+# --- Stratified sample ---
+def build_sample(db, size=SAMPLE_SIZE):
+    """
+    (Re)builds trades_sample: a uniform sample within each year_id,
+    proportional to the year's share of trades with a floor per year.
+    """
+    source = db.get_collection(SOURCE)
+    total = source.count_documents({})
+    if not total:
+        print(f"'{SOURCE}' is empty; nothing to sample.")
+        return False
+    sample = db.get_collection(SAMPLE_COLLECTION)
+    strata = db.get_collection(STRATA_COLLECTION)
+    sample.drop()
+    strata.drop()
+    for stratum in source.distinct(STRATUM_KEY):
+        population = source.count_documents({STRATUM_KEY: stratum})
+        target = min(population, max(MIN_PER_STRATUM, round(size * population / total)))
+        documents = list(source.aggregate([
+            {"$match": {STRATUM_KEY: stratum}},
+            {"$sample": {"size": target}},
+            {"$addFields": {STRATUM_FIELD: stratum}},
+        ]))
+        if documents:
+            sample.insert_many(documents)
+        strata.insert_one({"stratum": stratum, "population": population, "size": len(documents)})
+        print(f"  {STRATUM_KEY} {stratum}: {len(documents)} of {population}")
+    sample.create_index(STRATUM_FIELD)
+    print(f"Sampled {sample.count_documents({})} of {total} trade(s) into '{SAMPLE_COLLECTION}'.")
+    return True
+
+
+def main():
+    from dotenv import load_dotenv
+    import pymongo
+
+    parser = argparse.ArgumentParser(description="Sample collection for approximate trade answers")
+    sub = parser.add_subparsers(dest="command", required=True)
+    build_parser = sub.add_parser("build-sample", help=f"rebuild {SAMPLE_COLLECTION}, stratified by {STRATUM_KEY}")
+    build_parser.add_argument("--size", type=int, default=SAMPLE_SIZE, help="target total sample size")
+    sub.add_parser("status", help="list strata and their sample sizes")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = pymongo.MongoClient(os.getenv("MONGO_ATLAS_URI")).get_database("Trade")
+    if args.command == "build-sample":
+        sys.exit(0 if build_sample(db, args.size) else 1)
+    for stratum, (population, size) in Approximator(db).refresh().items():
+        print(f"{stratum}\t{size}\t{population}")
+
+
+if __name__ == "__main__":
+    main()
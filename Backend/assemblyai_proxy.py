@@ -3,73 +3,438 @@ AssemblyAI WebSocket Proxy for Browser Clients
 
 Since browsers cannot send custom headers with WebSocket connections,
 this proxy server handles the authentication and forwards the connection.
+
+Each browser connection gets its own upstream session. Audio flows through
+a bounded queue per direction, so a slow upstream slows down reads from the
+browser (backpressure) instead of buffering without limit. Audio shorter
+than UPSTREAM_CHUNK_MS is coalesced into upstream messages of at least that
+much. public/audio-processor.js posts 4096-sample (256 ms) frames, which
+pass through whole; the coalescer joins the shorter pieces left when
+silence is trimmed from a frame, and small frames from other clients. Silence is detected server-side and
+dropped before it is forwarded, so upstream bandwidth and STT billing scale
+with speech rather than wall-clock time.
+
+Run:
+    python assemblyai_proxy.py                 # proxy to AssemblyAI
+    python assemblyai_proxy.py --fake-upstream # proxy to a local fake STT server
 """
 import os
+import sys
+import json
+import time
+import signal
 import asyncio
+import itertools
+import urllib.request
+from urllib.parse import urlsplit, parse_qsl, urlencode
+from collections import deque
+import numpy as np
 import websockets
-from flask import Flask
-from flask_cors import CORS
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = Flask(__name__)
-CORS(app, resources={r"/api/*": {"origins": "http://localhost:5173"}})
-
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY") or os.getenv("VITE_ASSEMBLYAI_API_KEY")
+UPSTREAM_URL = os.getenv("ASSEMBLYAI_WS_URL", "wss://streaming.assemblyai.com/v3/ws")
+PROXY_HOST = os.getenv("STT_PROXY_HOST", "localhost")
+PROXY_PORT = int(os.getenv("STT_PROXY_PORT", 8765))
+# Backend endpoint that receives partial transcripts for speculative query
+# generation (dperp1.py: /api/trade/speculate). Unset = disabled.
+SPECULATION_URL = os.getenv("STT_SPECULATION_URL")
 
-async def proxy_handler(websocket, path):
-    """Proxy WebSocket connection to AssemblyAI with authentication"""
-    if not ASSEMBLYAI_API_KEY:
-        await websocket.close(code=4001, reason="API key not configured")
-        return
-    
-    # Connect to AssemblyAI v3 Streaming API
-    assemblyai_url = f"wss://streaming.assemblyai.com/v3/ws?sample_rate=16000&format_turns=true"
-    
+# --- Tuning ---
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 2  # PCM16 mono
+# AssemblyAI accepts 50-1000 ms per message; ~100 ms is the sweet spot.
+UPSTREAM_CHUNK_MS = int(os.getenv("STT_PROXY_CHUNK_MS", 100))
+MAX_CHUNK_MS = 1000
+# Pending audio is flushed after this long even if the chunk is not full.
+FLUSH_AFTER_MS = int(os.getenv("STT_PROXY_FLUSH_MS", 60))
+QUEUE_SIZE = int(os.getenv("STT_PROXY_QUEUE_SIZE", 32))
+DEFAULT_QUERY = "sample_rate=16000&format_turns=true"
+# Connection parameters a browser may pass on to the authenticated upstream session.
+ALLOWED_QUERY_PARAMS = {
+    "sample_rate", "encoding", "format_turns", "end_of_turn_confidence_threshold",
+    "min_end_of_turn_silence_when_confident", "max_turn_silence",
+}
+
+# --- Voice activity detection ---
+VAD_ENABLED = os.getenv("STT_PROXY_VAD", "1") != "0"
+VAD_FRAME_MS = 20
+# Same floor as the client-side silenceThreshold in audio-processor.js.
+VAD_MIN_RMS = float(os.getenv("STT_PROXY_VAD_MIN_RMS", 0.01))
+VAD_NOISE_FACTOR = 3.0
+# Unvoiced consonants (s, f, sh) are quiet but have a high zero-crossing rate.
+VAD_ZCR_RANGE = (0.1, 0.5)
+# Audio kept after speech ends. Must exceed the upstream end-of-turn
+# silence (max_turn_silence, 1280 ms by default) or turns never close.
+VAD_HANGOVER_MS = int(os.getenv("STT_PROXY_VAD_HANGOVER_MS", 1400))
+# Audio kept before speech starts so word onsets are not clipped.
+VAD_PREROLL_MS = int(os.getenv("STT_PROXY_VAD_PREROLL_MS", 200))
+# During long silences a short chunk of digital silence keeps the upstream session alive.
+KEEPALIVE_MS = int(os.getenv("STT_PROXY_KEEPALIVE_MS", 5000))
+KEEPALIVE_CHUNK_MS = 50
+
+_session_ids = itertools.count(1)
+
+
+def _ms_to_bytes(ms):
+    return SAMPLE_RATE * BYTES_PER_SAMPLE * ms // 1000
+
+
+def upstream_query(query):
+    """The client's query string reduced to ALLOWED_QUERY_PARAMS (DEFAULT_QUERY if none remain)."""
+    params = parse_qsl(query or "", keep_blank_values=True)
+    allowed = [(name, value) for name, value in params if name in ALLOWED_QUERY_PARAMS]
+    dropped = sorted({name for name, _ in params if name not in ALLOWED_QUERY_PARAMS})
+    if dropped:
+        print(f"--- Dropped client query parameter(s) {dropped}")
+    return urlencode(allowed) if allowed else DEFAULT_QUERY
+
+
+def _request_path(websocket):
+    # websockets >= 13 exposes .request; older versions expose .path
+    request = getattr(websocket, "request", None)
+    return request.path if request is not None else getattr(websocket, "path", "/")
+
+
+async def _connect_upstream(url, headers):
     try:
-        async with websockets.connect(
-            assemblyai_url,
-            extra_headers={"Authorization": ASSEMBLYAI_API_KEY}
-        ) as assemblyai_ws:
-            # Forward messages in both directions
-            async def forward_to_assemblyai():
-                try:
-                    async for message in websocket:
-                        await assemblyai_ws.send(message)
-                except websockets.exceptions.ConnectionClosed:
-                    pass
-            
-            async def forward_to_client():
-                try:
-                    async for message in assemblyai_ws:
-                        await websocket.send(message)
-                except websockets.exceptions.ConnectionClosed:
-                    pass
-            
-            # Run both forwarding tasks concurrently
-            await asyncio.gather(
-                forward_to_assemblyai(),
-                forward_to_client()
-            )
-    except Exception as e:
-        print(f"Proxy error: {e}")
-        await websocket.close(code=1011, reason=str(e))
+        return await websockets.connect(url, additional_headers=headers, max_queue=QUEUE_SIZE)
+    except TypeError:
+        return await websockets.connect(url, extra_headers=headers, max_queue=QUEUE_SIZE)
+
+
+class FrameCoalescer:
+    """Joins small PCM frames into chunks of target_bytes (never splitting samples)."""
+
+    def __init__(self, target_bytes, max_bytes):
+        self.target_bytes = target_bytes
+        self.max_bytes = max_bytes
+        self.buffer = bytearray()
+        self.first_at = None
+
+    def add(self, frame):
+        """Appends a frame; returns the list of chunks now ready to send."""
+        if not self.buffer:
+            self.first_at = time.monotonic()
+        self.buffer.extend(frame)
+        ready = []
+        while len(self.buffer) >= self.target_bytes:
+            size = min(len(self.buffer), self.max_bytes)
+            size -= size % BYTES_PER_SAMPLE
+            ready.append(bytes(self.buffer[:size]))
+            del self.buffer[:size]
+        if not self.buffer:
+            self.first_at = None
+        return ready
+
+    def due(self, flush_after):
+        return bool(self.buffer) and time.monotonic() - self.first_at >= flush_after
+
+    def flush(self):
+        size = len(self.buffer) - len(self.buffer) % BYTES_PER_SAMPLE
+        chunk = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.first_at = None if not self.buffer else self.first_at
+        return chunk
+
+
+class VoiceActivityDetector:
+    """
+    Energy + zero-crossing VAD over 20 ms frames with hangover and pre-roll.
+    filter() returns the bytes worth forwarding; silent frames are dropped.
+    """
+
+    def __init__(self, sample_rate=SAMPLE_RATE):
+        self.frame_samples = sample_rate * VAD_FRAME_MS // 1000
+        self.hangover_frames = VAD_HANGOVER_MS // VAD_FRAME_MS
+        self.noise_rms = VAD_MIN_RMS / VAD_NOISE_FACTOR
+        self.since_speech = self.hangover_frames  # start in the silent state
+        self.preroll = deque(maxlen=max(1, VAD_PREROLL_MS // VAD_FRAME_MS))
+        self.speech_frames = 0
+        self.silent_frames = 0
+
+    def classify(self, samples):
+        """Returns (frame_count, is_speech) for int16 samples, vectorised over frames."""
+        count = -(-len(samples) // self.frame_samples)
+        padded = np.zeros(count * self.frame_samples, dtype=np.float32)
+        padded[:len(samples)] = samples / 32768.0
+        frames = padded.reshape(count, self.frame_samples)
+        rms = np.sqrt(np.mean(frames * frames, axis=1))
+        zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+        threshold = max(VAD_MIN_RMS, self.noise_rms * VAD_NOISE_FACTOR)
+        low, high = VAD_ZCR_RANGE
+        is_speech = (rms > threshold) | ((rms > threshold / 2) & (zcr > low) & (zcr < high))
+        if (~is_speech).any():
+            # Track the background level so a noisy room does not count as speech.
+            self.noise_rms = 0.95 * self.noise_rms + 0.05 * float(rms[~is_speech].mean())
+        return count, is_speech
+
+    def filter(self, data):
+        samples = np.frombuffer(data[:len(data) - len(data) % BYTES_PER_SAMPLE], dtype="<i2")
+        if not len(samples):
+            return b""
+        count, is_speech = self.classify(samples)
+        frame_bytes = self.frame_samples * BYTES_PER_SAMPLE
+        kept = bytearray()
+        for index in range(count):
+            frame = data[index * frame_bytes:(index + 1) * frame_bytes]
+            if is_speech[index]:
+                if self.since_speech >= self.hangover_frames:
+                    kept.extend(b"".join(self.preroll))
+                    self.preroll.clear()
+                self.since_speech = 0
+                self.speech_frames += 1
+            else:
+                self.since_speech += 1
+                self.silent_frames += 1
+            if self.since_speech < self.hangover_frames:
+                kept.extend(frame)
+            else:
+                self.preroll.append(frame)
+        return bytes(kept)
+
+
+class ProxySession:
+    """One browser <-> upstream session with its own queues and metrics."""
+
+    def __init__(self, client, upstream_url, headers):
+        self.id = next(_session_ids)
+        self.client = client
+        self.upstream_url = upstream_url
+        self.headers = headers
+        self.upstream = None
+        self.to_upstream = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.to_client = asyncio.Queue(maxsize=QUEUE_SIZE)
+        self.coalescer = FrameCoalescer(_ms_to_bytes(UPSTREAM_CHUNK_MS), _ms_to_bytes(MAX_CHUNK_MS))
+        self.vad = VoiceActivityDetector() if VAD_ENABLED else None
+        self.stt_session = None
+        self.last_transcript = None
+        self.background = set()
+        self.started = time.monotonic()
+        self.last_upstream_send = self.started
+        self.metrics = {
+            "frames_in": 0, "bytes_in": 0, "messages_up": 0, "bytes_up": 0,
+            "messages_down": 0, "bytes_down": 0, "max_queue_up": 0, "max_queue_down": 0,
+            "bytes_saved": 0, "keepalives": 0,
+        }
+
+    async def run(self):
+        self.upstream = await _connect_upstream(self.upstream_url, self.headers)
+        tasks = [
+            asyncio.create_task(self.read_client()),
+            asyncio.create_task(self.write_upstream()),
+            asyncio.create_task(self.read_upstream()),
+            asyncio.create_task(self.write_client()),
+        ]
+        try:
+            # The session ends as soon as either side goes away.
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() and not isinstance(task.exception(), websockets.ConnectionClosed):
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await self.upstream.close()
+
+    async def _put(self, queue, item, metric):
+        await queue.put(item)  # blocks when full: this is the backpressure
+        self.metrics[metric] = max(self.metrics[metric], queue.qsize())
+
+    # --- browser -> upstream ---
+    async def read_client(self):
+        async for message in self.client:
+            if isinstance(message, bytes):
+                self.metrics["frames_in"] += 1
+                self.metrics["bytes_in"] += len(message)
+                if self.vad is not None:
+                    voiced = self.vad.filter(message)
+                    self.metrics["bytes_saved"] += len(message) - len(voiced)
+                    message = voiced
+                    if not message:
+                        continue
+                for chunk in self.coalescer.add(message):
+                    await self._put(self.to_upstream, chunk, "max_queue_up")
+            else:
+                # Control messages (e.g. Terminate) must follow the audio sent before them.
+                pending = self.coalescer.flush()
+                if pending:
+                    await self._put(self.to_upstream, pending, "max_queue_up")
+                await self._put(self.to_upstream, message, "max_queue_up")
+
+    async def write_upstream(self):
+        flush_after = FLUSH_AFTER_MS / 1000
+        while True:
+            try:
+                message = await asyncio.wait_for(self.to_upstream.get(), timeout=flush_after)
+            except asyncio.TimeoutError:
+                if self.coalescer.due(flush_after):
+                    message = self.coalescer.flush()
+                elif time.monotonic() - self.last_upstream_send >= KEEPALIVE_MS / 1000:
+                    message = bytes(_ms_to_bytes(KEEPALIVE_CHUNK_MS))
+                    self.metrics["keepalives"] += 1
+                    self.metrics["bytes_saved"] -= len(message)
+                else:
+                    continue
+                if not message:
+                    continue
+            await self.upstream.send(message)
+            self.last_upstream_send = time.monotonic()
+            self.metrics["messages_up"] += 1
+            if isinstance(message, bytes):
+                self.metrics["bytes_up"] += len(message)
+
+    # --- upstream -> browser ---
+    async def read_upstream(self):
+        async for message in self.upstream:
+            if SPECULATION_URL and isinstance(message, str):
+                self.observe_transcript(message)
+            await self._put(self.to_client, message, "max_queue_down")
+
+    def observe_transcript(self, message):
+        """Forwards changed partial/final transcripts to the query backend."""
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return
+        if data.get("type") == "Begin":
+            # The browser sees the same id in its Begin message.
+            self.stt_session = data.get("id")
+        elif data.get("type") == "Turn" and data.get("transcript"):
+            final = bool(data.get("end_of_turn") and data.get("turn_is_formatted"))
+            if data["transcript"] == self.last_transcript and not final:
+                return
+            self.last_transcript = data["transcript"]
+            payload = {"session": self.stt_session or f"proxy-{self.id}",
+                       "transcript": data["transcript"], "final": final}
+            task = asyncio.create_task(self._post_transcript(payload))
+            self.background.add(task)
+            task.add_done_callback(self.background.discard)
+
+    async def _post_transcript(self, payload):
+        request = urllib.request.Request(
+            SPECULATION_URL, data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"}, method="POST",
+        )
+        try:
+            await asyncio.to_thread(urllib.request.urlopen, request, timeout=2)
+        except Exception as e:
+            print(f"--- Speculation post failed (session {self.id}): {e}")
+
+    async def write_client(self):
+        while True:
+            message = await self.to_client.get()
+            await self.client.send(message)
+            self.metrics["messages_down"] += 1
+            self.metrics["bytes_down"] += len(message)
+
+    async def terminate(self):
+        """Asks upstream to end the session cleanly (used on shutdown)."""
+        if self.upstream is not None:
+            try:
+                await self.upstream.send(json.dumps({"type": "Terminate"}))
+            except websockets.ConnectionClosed:
+                pass
+        await self.client.close(code=1001, reason="Proxy shutting down")
+
+    def snapshot(self):
+        snapshot = {"session": self.id, "duration_s": round(time.monotonic() - self.started, 2), **self.metrics}
+        if self.vad is not None:
+            snapshot["speech_ms"] = self.vad.speech_frames * VAD_FRAME_MS
+            snapshot["silence_ms"] = self.vad.silent_frames * VAD_FRAME_MS
+        if self.metrics["bytes_in"]:
+            snapshot["saved_pct"] = round(100 * self.metrics["bytes_saved"] / self.metrics["bytes_in"], 1)
+        return snapshot
+
+
+class ProxyServer:
+    """Accepts browser connections and runs one ProxySession per client."""
+
+    def __init__(self, upstream_url=UPSTREAM_URL, api_key=ASSEMBLYAI_API_KEY):
+        self.upstream_url = upstream_url
+        self.headers = {"Authorization": api_key} if api_key else {}
+        self.sessions = {}
+
+    async def handler(self, websocket, path=None):
+        query = upstream_query(urlsplit(path or _request_path(websocket)).query)
+        session = ProxySession(websocket, f"{self.upstream_url}?{query}", self.headers)
+        self.sessions[session.id] = session
+        print(f"--- Session {session.id} opened ({len(self.sessions)} active)")
+        try:
+            await session.run()
+        except Exception as e:
+            print(f"Proxy error (session {session.id}): {e}")
+            await websocket.close(code=1011, reason=str(e)[:120])
+        finally:
+            del self.sessions[session.id]
+            print(f"--- Session closed: {json.dumps(session.snapshot())}")
+
+    def metrics(self):
+        return [session.snapshot() for session in self.sessions.values()]
+
+    async def serve(self, host=PROXY_HOST, port=PROXY_PORT, stop=None):
+        stop = stop or asyncio.Event()
+        async with websockets.serve(self.handler, host, port, max_queue=QUEUE_SIZE):
+            print(f"Starting AssemblyAI WebSocket proxy on ws://{host}:{port} -> {self.upstream_url}")
+            await stop.wait()
+            print(f"--- Shutting down, closing {len(self.sessions)} session(s)")
+            await asyncio.gather(*(s.terminate() for s in list(self.sessions.values())), return_exceptions=True)
+
+
+# --- Local fake streaming-STT server (for development and tests) ---
+async def fake_stt_handler(websocket, path=None):
+    """Mimics the AssemblyAI v3 message flow: Begin, one Turn per message, Termination."""
+    received = 0
+    await websocket.send(json.dumps({"type": "Begin", "id": "fake-session", "expires_at": int(time.time()) + 3600}))
+    async for message in websocket:
+        if isinstance(message, bytes):
+            received += len(message)
+            await websocket.send(json.dumps({
+                "type": "Turn", "transcript": f"{received} bytes", "end_of_turn": False,
+                "turn_is_formatted": False, "chunk_bytes": len(message),
+            }))
+        elif json.loads(message).get("type") == "Terminate":
+            seconds = received / (SAMPLE_RATE * BYTES_PER_SAMPLE)
+            await websocket.send(json.dumps({
+                "type": "Termination", "audio_duration_seconds": seconds, "session_duration_seconds": seconds,
+            }))
+            break
+
+
+async def serve_fake_stt(host="localhost", port=8766):
+    return await websockets.serve(fake_stt_handler, host, port)
+
 
 def start_proxy_server():
     """Start the WebSocket proxy server"""
-    if not ASSEMBLYAI_API_KEY:
+    fake = "--fake-upstream" in sys.argv
+    if not fake and not ASSEMBLYAI_API_KEY:
         print("WARNING: ASSEMBLYAI_API_KEY not found in environment variables")
         print("WebSocket proxy will not work without an API key")
         return
-    
-    print(f"Starting AssemblyAI WebSocket proxy on ws://localhost:8765")
-    print("Make sure to update the frontend to connect to ws://localhost:8765")
-    
-    # Note: This requires websockets library: pip install websockets
-    # asyncio.run(websockets.serve(proxy_handler, "localhost", 8765))
-    # For now, this is a template - you'll need to run it separately or integrate with Flask
+
+    async def main():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:  # Windows
+                pass
+        if fake:
+            fake_server = await serve_fake_stt()
+            server = ProxyServer("ws://localhost:8766/v3/ws", api_key=None)
+        else:
+            server = ProxyServer()
+        await server.serve(stop=stop)
+        if fake:
+            fake_server.close()
+
+    asyncio.run(main())
+
 
 if __name__ == "__main__":
     start_proxy_server()
-
@@ -0,0 +1,79 @@
+"""
+Traffic capture for /api/trade/query, for deterministic offline replay.
+
+Set CAPTURE_PATH to record production traffic as JSON lines:
+
+- {"type": "request", "t": arrival (epoch seconds), "query", "session",
+   "client", "status", "ms"} for every query request;
+- {"type": "llm", "prompt_sha", "query", "text", "latency"} for every LLM
+  completion, with the question being answered when it ran inside a
+  request.
+
+Replay the file against a server started with LLM_PROVIDERS=replay:<file>
+(llm_providers.ReplayProvider answers from the recorded completions), and
+drive it with `python loadtest.py <server> --replay <file>`.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+import contextvars
+
+CAPTURE_PATH = os.getenv("CAPTURE_PATH")
+
+# The question the current request is answering, for tagging LLM completions.
+current_query = contextvars.ContextVar("capture_query", default=None)
+
+
+def prompt_sha(prompt):
+    return hashlib.sha256(prompt.encode()).hexdigest()[:16]
+
+
+class TrafficCapture:
+    def __init__(self, path=CAPTURE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "completions": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.path)
+
+    def _append(self, record):
+        line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+        with self.lock:
+            try:
+                with open(self.path, "a") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"--- Could not write capture: {e}")
+
+    def record_request(self, arrival, user_query, session, client, status, seconds):
+        self.stats["requests"] += 1
+        self._append({"type": "request", "t": round(arrival, 3), "query": user_query, "session": session,
+                      "client": client, "status": status, "ms": round(seconds * 1000, 1)})
+
+    def record_completion(self, prompt, completion):
+        """LLMClient listener: one line per answered prompt."""
+        self.stats["completions"] += 1
+        self._append({"type": "llm", "t": round(time.time(), 3), "prompt_sha": prompt_sha(prompt),
+                      "query": current_query.get(), "text": completion.text,
+                      "latency": round(completion.latency, 3)})
+
+    def snapshot(self):
+        return {"path": self.path, **self.stats}
+
+
+def load(path):
+    """(requests in arrival order, llm records) from a capture file."""
+    requests, completions = [], []
+    with open(path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            (requests if record.get("type") == "request" else completions).append(record)
+    requests.sort(key=lambda record: record["t"])
+    return requests, completions
@@ -0,0 +1,277 @@
+"""
+Chart-ready shaping of query results (shape=chart on /api/trade/query).
+
+The frontend used to receive every result row and chart it client-side.
+A daily series or a per-port breakdown could ship thousands of points that
+the browser then struggled to render. shape_chart() returns columnar series
+instead, and the payload stays bounded however large the result is:
+
+- series: the x axis is a date or a number, as in a $dateTrunc trend, a
+  "2023-01" month key or totals by year. Rows are sorted by x. Above `points` rows they are
+  downsampled, both ways vectorized with numpy:
+  - "lttb" (Largest-Triangle-Three-Buckets) keeps the visual shape;
+  - "minmax" keeps each bucket's lowest and highest point.
+  The first numeric column picks the rows, and the other columns follow it.
+- categories: the x axis is text, as in totals by port. Above `top`
+  categories, the `top` largest by the first numeric column are kept and
+  the rest are summed into one "Other" category.
+- table: there is no numeric column. The first `points` rows are returned.
+"""
+import os
+import re
+from datetime import date, datetime
+import numpy as np
+from schema_introspect import ISO_DATE_RE
+
+CHART_POINTS = int(os.getenv("CHART_POINTS", 500))
+CHART_POINTS_LIMIT = int(os.getenv("CHART_POINTS_LIMIT", 5000))
+CHART_TOP_N = int(os.getenv("CHART_TOP_N", 10))
+CHART_TOP_N_LIMIT = 100
+DOWNSAMPLERS = ("lttb", "minmax")
+OTHER = "Other"
+# Month and year keys, e.g. from {"$substrBytes": ["$created_at", 0, 7]}. Years are
+# limited to 1900-2099 so four-digit codes stay categories.
+PERIOD_RE = re.compile(r"^((?:19|20)\d{2})(?:-(0[1-9]|1[0-2]))?$")
+
+
+def chart_options(args):
+    """Validated {"points", "top", "downsample"} from query-string args; ValueError if invalid."""
+    try:
+        points = int(args.get("points", CHART_POINTS))
+        top = int(args.get("top", CHART_TOP_N))
+    except ValueError:
+        raise ValueError("points and top must be integers")
+    if not 3 <= points <= CHART_POINTS_LIMIT:
+        raise ValueError(f"points must be between 3 and {CHART_POINTS_LIMIT}")
+    if not 1 <= top <= CHART_TOP_N_LIMIT:
+        raise ValueError(f"top must be between 1 and {CHART_TOP_N_LIMIT}")
+    downsample = args.get("downsample", "lttb")
+    if downsample not in DOWNSAMPLERS:
+        raise ValueError(f"downsample must be one of {list(DOWNSAMPLERS)}")
+    return {"points": points, "top": top, "downsample": downsample}
+
+
+def chart_etag(etag, options):
+    """ETag of the chart variant of a result: one per shaping option set."""
+    return f'{etag[:-1]}-chart-{options["downsample"]}-{options["points"]}-{options["top"]}"'
+
+
+# --- downsampling ---
+def lttb(x, y, n_out):
+    """
+    Indices of n_out points picked by Largest-Triangle-Three-Buckets. Each
+    bucket keeps the point that forms the largest triangle with the point
+    kept before it and the average of the next bucket. Each bucket is one
+    vector operation, and the bucket averages come from cumulative sums.
+    """
+    n = len(x)
+    if n_out >= n:
+        return np.arange(n)
+    x = x - x[0]
+    # n_out - 2 buckets over the interior points; the first and last point are always kept.
+    edges = np.linspace(1, n - 1, n_out - 1).astype(np.int64)
+    starts, ends = edges[:-1], edges[1:]
+    sum_x = np.concatenate(([0.0], np.cumsum(x)))
+    sum_y = np.concatenate(([0.0], np.cumsum(y)))
+    mean_x = (sum_x[ends] - sum_x[starts]) / (ends - starts)
+    mean_y = (sum_y[ends] - sum_y[starts]) / (ends - starts)
+    next_x = np.append(mean_x[1:], x[-1])
+    next_y = np.append(mean_y[1:], y[-1])
+    selected = np.empty(n_out, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(n_out - 2):
+        lo, hi = starts[bucket], ends[bucket]
+        ax, ay = x[previous], y[previous]
+        area = np.abs((ax - next_x[bucket]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (next_y[bucket] - ay))
+        previous = lo + int(np.argmax(area))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def minmax(y, n_out):
+    """Indices of the minimum and maximum of (n_out - 2) // 2 equal buckets, plus both ends, in order."""
+    n = len(y)
+    if n_out >= n:
+        return np.arange(n)
+    buckets = max(1, (n_out - 2) // 2)
+    bucket = np.arange(n) * buckets // n
+    order = np.lexsort((y, bucket))   # by bucket, then by value
+    by_bucket = bucket[order]
+    first = np.searchsorted(by_bucket, np.arange(buckets), "left")
+    last = np.searchsorted(by_bucket, np.arange(buckets), "right") - 1
+    return np.unique(np.concatenate((order[first], order[last], [0, n - 1])))
+
+
+# --- columns ---
+def _flatten(row):
+    """One level of nested documents becomes dotted columns ({"_id": {"month": 1}} -> "_id.month")."""
+    flat = {}
+    for key, value in row.items():
+        if isinstance(value, dict):
+            for inner, inner_value in value.items():
+                flat[f"{key}.{inner}"] = inner_value
+        else:
+            flat[key] = value
+    return flat
+
+
+def _combine_id(columns):
+    """
+    A compound group key ({"_id": {"year": 2024, "month": 3}}) becomes one
+    "_id" column: an ISO date when it has a numeric year (with optional
+    month and day), else a "a / b" label.
+    """
+    parts = [name for name in columns if name.startswith("_id.")]
+    if len(parts) < 2:
+        return columns
+    values = [dict(zip((name[4:].lower() for name in parts), row)) for row in zip(*(columns[name] for name in parts))]
+    if all(_is_number(value.get("year")) for value in values):
+        combined = [f"{int(value['year']):04d}-{int(value.get('month') or 1):02d}-{int(value.get('day') or 1):02d}"
+                    for value in values]
+    else:
+        combined = [" / ".join(str(part) for part in value.values()) for value in values]
+    rest = {name: column for name, column in columns.items() if name not in parts}
+    return {"_id": combined, **rest}
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _is_time(value):
+    return isinstance(value, (datetime, date)) or (
+        isinstance(value, str) and (ISO_DATE_RE.match(value) is not None or PERIOD_RE.match(value) is not None))
+
+
+def _column_type(values):
+    present = [value for value in values if value is not None]
+    if not present:
+        return None
+    if all(_is_number(value) for value in present):
+        return "number"
+    if all(_is_time(value) for value in present):
+        return "time"
+    if all(isinstance(value, str) for value in present):
+        return "category"
+    return "other"   # arrays, documents or mixed values
+
+
+def _seconds(value):
+    if isinstance(value, str):
+        period = PERIOD_RE.match(value)
+        if period:
+            return datetime(int(period.group(1)), int(period.group(2) or 1), 1).timestamp()
+        value = datetime.fromisoformat(value.replace("Z", "+00:00").replace(" ", "T"))
+    if isinstance(value, datetime):
+        return value.timestamp()
+    return datetime(value.year, value.month, value.day).timestamp()
+
+
+def _json_value(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, float) and value != value:
+        return None   # NaN is not JSON
+    return value
+
+
+def _choose_axis(columns, types):
+    """(x column, its type, numeric y columns) or None for a plain table."""
+    numeric = [name for name in columns if types[name] == "number"]
+    if not numeric:
+        return None
+    for kind in ("time", "category"):
+        for name in columns:
+            if types[name] == kind:
+                return name, kind, numeric
+    # Only numbers: a numeric _id (e.g. grouped by year) is the x axis.
+    if len(numeric) > 1:
+        x = "_id" if "_id" in numeric else numeric[0]
+        return x, "number", [name for name in numeric if name != x]
+    return None
+
+
+# --- shapes ---
+def _series(columns, x, x_type, ys, options):
+    x_values = columns[x]
+    keys = np.array([np.nan if value is None else _seconds(value) if x_type == "time" else value
+                     for value in x_values], dtype=float)
+    keep = ~np.isnan(keys)
+    order = np.flatnonzero(keep)[np.argsort(keys[keep], kind="stable")]
+    points = options["points"]
+    method = None
+    if len(order) > points:
+        method = options["downsample"]
+        primary = np.array([np.nan if v is None else v for v in columns[ys[0]]], dtype=float)[order]
+        primary = np.nan_to_num(primary)   # missing values count as 0 when picking points
+        picked = lttb(keys[order], primary, points) if method == "lttb" else minmax(primary, points)
+        order = order[picked]
+    rows = order.tolist()
+    return {
+        "kind": "series",
+        "x": {"field": x, "type": x_type, "values": [_json_value(x_values[i]) for i in rows]},
+        "series": [{"field": y, "values": [_json_value(columns[y][i]) for i in rows]} for y in ys],
+        "points": len(rows),
+        "downsampled": method,
+    }
+
+
+def _categories(columns, x, ys, options):
+    top = options["top"]
+    n = len(columns[x])
+    rows = list(range(n))
+    folded = []
+    if n > top:
+        primary = columns[ys[0]]
+        rows.sort(key=lambda i: primary[i] if primary[i] is not None else float("-inf"), reverse=True)
+        rows, folded = rows[:top], rows[top:]
+    labels = [_json_value(columns[x][i]) for i in rows]
+    series = []
+    for y in ys:
+        values = [_json_value(columns[y][i]) for i in rows]
+        if folded:
+            present = [columns[y][i] for i in folded if columns[y][i] is not None]
+            values.append(sum(present) if present else None)
+        series.append({"field": y, "values": values})
+    if folded:
+        labels.append(OTHER)
+    return {
+        "kind": "categories",
+        "x": {"field": x, "type": "category", "values": labels},
+        "series": series,
+        "points": len(labels),
+        "folded": len(folded),
+    }
+
+
+def _table(columns, n, options):
+    kept = min(n, options["points"])
+    return {
+        "kind": "table",
+        "columns": [{"field": name, "values": [_json_value(v) for v in values[:kept]]}
+                    for name, values in columns.items()],
+        "points": kept,
+        "truncated": n > kept,
+    }
+
+
+def shape_chart(rows, options):
+    """Columnar, bounded chart data for result rows (options from chart_options)."""
+    flat = [_flatten(row) for row in rows if isinstance(row, dict)]
+    names = list(dict.fromkeys(name for row in flat for name in row))
+    columns = _combine_id({name: [row.get(name) for row in flat] for name in names})
+    names = list(columns)
+    types = {name: _column_type(values) for name, values in columns.items()}
+    axis = _choose_axis(names, types)
+    if axis is None:
+        shaped = _table(columns, len(flat), options)
+    else:
+        x, x_type, ys = axis
+        ys = [y for y in ys if y != x]
+        if x_type == "category":
+            shaped = _categories(columns, x, ys, options)
+        else:
+            shaped = _series(columns, x, x_type, ys, options)
+    shaped["rows"] = len(flat)
+    return shaped
@@ -1,26 +1,164 @@
 import os
 import sys
-from google import genai
+import json
+import time
+import argparse
+import urllib.parse
+import urllib.request
 from dotenv import load_dotenv
 
+MODEL = "gemini-2.5-flash"
+# Rough history budget; older turns are compacted once it is exceeded.
+HISTORY_TOKEN_BUDGET = int(os.getenv("CHAT_HISTORY_TOKENS", 4000))
+# The newest turns are always kept verbatim.
+KEEP_RECENT_TURNS = 4
+COMPACT_CHARS_PER_TURN = 160
+TRADE_API_URL = os.getenv("TRADE_API_URL", "http://localhost:5000/api/trade/query")
+TRADE_KEYWORDS = {
+    "trade", "trades", "export", "exports", "import", "imports", "commodity", "commodities",
+    "port", "ports", "population", "value", "usd", "tonnes", "crude", "lpg", "top", "total",
+}
+
+
+def estimate_tokens(text):
+    """~4 characters per token is close enough for budgeting."""
+    return len(text) // 4 + 1
+
+
+class ChatHistory:
+    """
+    Bounded multi-turn history. When the estimated token count exceeds the
+    budget, the oldest turns are folded into a single short recap turn so
+    every request stays roughly the same size. Turns are folded in
+    user/model pairs, so the history still starts with a user turn and
+    alternates, as the Gemini chat API requires.
+    """
+
+    def __init__(self, budget=HISTORY_TOKEN_BUDGET):
+        self.budget = budget
+        self.turns = []       # [{"role": "user"|"model", "parts": [{"text": ...}]}]
+        self.recap = []       # one-line summaries of compacted turns
+
+    def add(self, role, text):
+        self.turns.append({"role": role, "parts": [{"text": text}]})
+        self.compact()
+
+    def tokens(self):
+        return sum(estimate_tokens(t["parts"][0]["text"]) for t in self.turns) + \
+            sum(estimate_tokens(line) for line in self.recap)
+
+    def compact(self):
+        while self.tokens() > self.budget and len(self.turns) >= KEEP_RECENT_TURNS + 2:
+            # A user turn and the model's answer to it leave together.
+            for turn in self.turns[:2]:
+                text = " ".join(turn["parts"][0]["text"].split())
+                if len(text) > COMPACT_CHARS_PER_TURN:
+                    text = text[:COMPACT_CHARS_PER_TURN] + "..."
+                self.recap.append(f"{turn['role']}: {text}")
+            del self.turns[:2]
+        # The recap itself is bounded too: drop the oldest lines first.
+        while self.recap and self.tokens() > self.budget:
+            self.recap.pop(0)
+
+    def contents(self):
+        """Request contents: optional recap turn followed by the recent turns."""
+        if not self.recap:
+            return list(self.turns)
+        recap = "Summary of the earlier conversation:\n" + "\n".join(self.recap)
+        return [{"role": "user", "parts": [{"text": recap}]},
+                {"role": "model", "parts": [{"text": "Understood."}]}] + self.turns
+
+
+class FakeStreamingClient:
+    """Local stand-in for genai.Client: streams a canned answer word by word."""
+
+    class _Chunk:
+        def __init__(self, text):
+            self.text = text
+
+    class _Models:
+        def __init__(self, delay):
+            self.delay = delay
+
+        def list(self):
+            return []
+
+        def generate_content_stream(self, model, contents):
+            last = contents[-1]["parts"][0]["text"]
+            answer = f"(fake {model}) You said: {last[:200]} [history: {len(contents)} turn(s)]"
+            time.sleep(self.delay * 3)  # simulated time to first token
+            for word in answer.split(" "):
+                time.sleep(self.delay)
+                yield FakeStreamingClient._Chunk(word + " ")
+
+    def __init__(self, delay=0.02):
+        self.models = self._Models(delay)
+
+
+def is_data_question(text):
+    words = set(text.lower().replace("?", " ").split())
+    return bool(words & TRADE_KEYWORDS)
+
+
+def ask_trade_engine(question):
+    """Routes a data question through the trade query API; returns (rows, error)."""
+    url = f"{TRADE_API_URL}?query={urllib.parse.quote(question)}"
+    try:
+        with urllib.request.urlopen(url, timeout=60) as response:
+            data = json.loads(response.read())
+    except Exception as e:
+        return None, str(e)
+    if "error" in data:
+        return None, data["error"]
+    return data.get("results", []), None
+
+
+def stream_reply(client, history):
+    """Streams the model reply to stdout. Returns (text, time_to_first_token, total)."""
+    started = time.perf_counter()
+    first_token = None
+    pieces = []
+    print("Gemini: ", end="", flush=True)
+    for chunk in client.models.generate_content_stream(model=MODEL, contents=history.contents()):
+        text = chunk.text or ""
+        if not text:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter() - started
+        pieces.append(text)
+        print(text, end="", flush=True)
+    print()
+    return "".join(pieces), first_token or 0.0, time.perf_counter() - started
+
+
 def main():
     """
-    Starts a simple, interactive chat session with the Google Gemini API.
+    Starts an interactive, streaming chat session with the Google Gemini API.
     """
-    
+    parser = argparse.ArgumentParser(description="Streaming Gemini chat")
+    parser.add_argument("--trade", action="store_true",
+                        help="route data questions through the trade query engine")
+    parser.add_argument("--fake", action="store_true",
+                        help="use a local fake streaming provider (no API key needed)")
+    args = parser.parse_args()
+
     # --- 1. Load API Key ---
     load_dotenv()
     # Note: The 'google-ai' library automatically looks for GEMINI_API_KEY
-    if not os.getenv("GEMINI_API_KEY"):
+    if not args.fake and not os.getenv("GEMINI_API_KEY"):
         print("❌ ERROR: GEMINI_API_KEY not found in .env file.")
         print("Please create a .env file and add your API key.")
         sys.exit(1)
 
     # --- 2. Initialize Client ---
     try:
-        client = genai.Client()
+        if args.fake:
+            client = FakeStreamingClient()
+        else:
+            from google import genai
+            client = genai.Client()
         # Test the connection by listing models
-        client.models.list() 
+        client.models.list()
         print("✅ Google AI client initialized and API key is valid.")
     except Exception as e:
         print(f"❌ CRITICAL ERROR: Could not initialize Google AI client.")
@@ -29,8 +167,11 @@ def main():
         sys.exit(1)
 
     # --- 3. The Chat Loop ---
+    history = ChatHistory()
     print("\n--- 🤖 Google Gemini Chat ---")
-    print("Using model: gemini-2.5-flash")
+    print(f"Using model: {MODEL}{' (fake)' if args.fake else ''}")
+    if args.trade:
+        print(f"Trade mode: data questions go to {TRADE_API_URL}")
     print("Type 'exit' or 'quit' to end the conversation.")
     print("-----------------------------------")
 
@@ -38,24 +179,33 @@ def main():
         try:
             # 1. Get user input
             user_input = input("You: ")
-            
+
             if user_input.lower() in ['exit', 'quit']:
                 print("\n👋 Goodbye!")
                 break
-                
+
             if not user_input:
                 continue
 
-            # 2. Send to Google AI
-            print("\n...AI is thinking...\n")
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=user_input
-            )
+            # 2. Data questions: fetch rows first and give them to the model as context
+            prompt = user_input
+            if args.trade and is_data_question(user_input):
+                started = time.perf_counter()
+                rows, error = ask_trade_engine(user_input)
+                if error:
+                    print(f"⚠️  Trade engine error: {error}")
+                else:
+                    print(f"📊 {len(rows)} row(s) from the trade engine in {time.perf_counter() - started:.2f}s")
+                    sample = json.dumps(rows[:50], default=str)
+                    prompt = (f"{user_input}\n\nAnswer using these query results "
+                              f"({len(rows)} rows, first 50 shown):\n{sample}")
 
-            # 3. Get the AI's response
-            ai_response = response.text
-            print(f"Gemini: {ai_response}\n")
+            # 3. Stream the answer from Google AI
+            history.add("user", prompt)
+            ai_response, first_token, total = stream_reply(client, history)
+            history.add("model", ai_response)
+            print(f"   ⏱  first token {first_token:.2f}s, total {total:.2f}s, "
+                  f"history ~{history.tokens()} tokens\n")
 
         except KeyboardInterrupt:
             print("\n👋 Goodbye!")
@@ -65,4 +215,4 @@ def main():
             break
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,230 @@
+"""
+Per-collection data versions for precise cache invalidation.
+
+Result caches are only safe if we know when the data under them changed.
+The tracker keeps a version counter per collection, advanced by a MongoDB
+change stream when the server supports one (replica sets, including a
+local single-node one) and by polling a (count, max _id) fingerprint
+otherwise. Polling sees inserts and deletes but not in-place updates.
+
+Two values are kept per collection:
+  versions - a local counter, bumped on every change; used to wake
+             subscribers (Server-Sent Events) and for stats.
+  tokens   - an identifier of the data state that is the same in every
+             worker process (fingerprint or change cluster time), so ETags
+             and cache keys built from it agree across gunicorn workers.
+
+A logical collection backed by several physical ones (trades plus its year
+partitions and trades_ts) gets a token hashed from all of their states, so
+a change to any of them moves it.
+"""
+import os
+import json
+import hashlib
+import threading
+
+POLL_SECONDS = float(os.getenv("DATA_VERSION_POLL_SECONDS", 5))
+# How long a change stream read blocks before the stop flag is checked again.
+AWAIT_MS = 1000
+# Derived copies of a collection (trade partitions, trades_ts) and the source
+# state each one was last built from.
+SYNC_COLLECTION = "derived_copies"
+
+
+def fingerprint(collection):
+    """[count, max _id]: moves on inserts and deletes, not on in-place updates."""
+    last = collection.find_one(sort=[("_id", -1)], projection={"_id": 1})
+    return [collection.estimated_document_count(), str(last["_id"]) if last else None]
+
+
+def record_sync(db, copy, source, state):
+    """Marks copy as built from source in state (a fingerprint taken before copying)."""
+    db.get_collection(SYNC_COLLECTION).replace_one(
+        {"_id": copy}, {"_id": copy, "source": source, "fingerprint": state}, upsert=True)
+
+
+def clear_sync(db, copy):
+    db.get_collection(SYNC_COLLECTION).delete_one({"_id": copy})
+
+
+def in_sync(db, copy):
+    """True while the copy's source is still in the state the copy was built from."""
+    record = db.get_collection(SYNC_COLLECTION).find_one({"_id": copy})
+    return record is not None and record.get("fingerprint") == fingerprint(db.get_collection(record["source"]))
+
+
+def collections_read(query_data):
+    """The collection a query runs on plus every collection it joins."""
+    names = {query_data.get("collection")}
+
+    def walk(stages):
+        for stage in stages or []:
+            if not isinstance(stage, dict):
+                continue
+            lookup = stage.get("$lookup")
+            if isinstance(lookup, dict):
+                names.add(lookup.get("from"))
+                walk(lookup.get("pipeline"))
+            facet = stage.get("$facet")
+            if isinstance(facet, dict):
+                for sub in facet.values():
+                    walk(sub)
+
+    walk(query_data.get("pipeline"))
+    names.discard(None)
+    return sorted(names)
+
+
+class DataVersionTracker:
+    """Tracks per-collection data versions and notifies listeners of changes."""
+
+    def __init__(self, db, collections, poll_seconds=POLL_SECONDS, aliases=None):
+        self.db = db
+        self.collections = list(collections)
+        # Physical collection -> logical one, e.g. trades_y2023 -> trades.
+        self.aliases = dict(aliases or {})
+        self.poll_seconds = poll_seconds
+        self.condition = threading.Condition()
+        self.versions = {name: 0 for name in self.collections}
+        self.tokens = {name: None for name in self.collections}
+        self.sources = {}     # physical collection -> its own token
+        self.fingerprints = {}
+        self.mode = None      # "change_stream" | "polling"
+        self.on_change = []   # callbacks(collection_name)
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- reading ---
+    def version(self, names=None):
+        """{collection: token} for the given collections (all by default)."""
+        with self.condition:
+            return {name: self.tokens.get(name) for name in (names or self.collections)}
+
+    def counters(self, names=None):
+        with self.condition:
+            return {name: self.versions.get(name, 0) for name in (names or self.collections)}
+
+    def wait_for_change(self, names, seen, timeout):
+        """
+        Blocks until any of the collections moves past the counters in seen,
+        or the timeout passes. Returns the current counters for names.
+        """
+        def changed():
+            return any(self.versions.get(name, 0) != seen.get(name) for name in names)
+
+        with self.condition:
+            self.condition.wait_for(changed, timeout)
+            return {name: self.versions.get(name, 0) for name in names}
+
+    # --- advancing ---
+    def _set_source(self, name, physical, token):
+        """Records a physical collection's token and recombines its logical one (condition held)."""
+        self.sources[physical] = token
+        parts = {source: value for source, value in self.sources.items()
+                 if self.aliases.get(source, source) == name}
+        if len(parts) == 1:
+            self.tokens[name] = token
+        else:
+            digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode())
+            self.tokens[name] = digest.hexdigest()[:32]
+
+    def bump(self, name, token, physical=None):
+        """Advances logical collection name after physical (default: name itself) changed."""
+        if name not in self.versions:
+            return
+        with self.condition:
+            self.versions[name] += 1
+            self._set_source(name, physical or name, token)
+            self.condition.notify_all()
+        print(f"--- Data changed in '{name}' (version {self.versions[name]})")
+        for callback in self.on_change:
+            try:
+                callback(name)
+            except Exception as e:
+                print(f"--- Data change callback failed: {e}")
+
+    def _fingerprint(self, name):
+        return fingerprint(self.db.get_collection(name))
+
+    def watched(self):
+        return self.collections + [name for name in self.aliases if name not in self.collections]
+
+    def poll(self):
+        """One polling pass; bumps every collection whose fingerprint moved."""
+        for name in self.watched():
+            logical = self.aliases.get(name, name)
+            try:
+                state = self._fingerprint(name)
+            except Exception as e:
+                print(f"--- Data version poll skipped '{name}': {e}")
+                continue
+            previous = self.fingerprints.get(name)
+            self.fingerprints[name] = state
+            if previous is None:
+                with self.condition:
+                    self._set_source(logical, name, state)
+            elif previous != state:
+                self.bump(logical, state, name)
+
+    def _watch(self, stream):
+        with stream:
+            while not self._stop.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                name = change.get("ns", {}).get("coll")
+                self.bump(self.aliases.get(name, name), str(change.get("clusterTime") or stream.resume_token), name)
+
+    # --- lifecycle ---
+    def start(self, baseline=True):
+        """
+        Opens a change stream if the server supports one, otherwise polls.
+        baseline=False keeps the inherited tokens (forked gunicorn workers).
+        """
+        if baseline:
+            self.poll()
+        self._stop = threading.Event()
+        try:
+            stream = self.db.watch(
+                [{"$match": {"ns.coll": {"$in": self.watched()}}}],
+                max_await_time_ms=AWAIT_MS,
+            )
+        except Exception as e:
+            print(f"--- Change streams unavailable ({e}); polling every {self.poll_seconds}s")
+            self.mode = "polling"
+
+            def loop():
+                while not self._stop.wait(self.poll_seconds):
+                    self.poll()
+
+            self._thread = threading.Thread(target=loop, name="data-version-poll", daemon=True)
+            self._thread.start()
+            return
+
+        self.mode = "change_stream"
+
+        def watch():
+            try:
+                self._watch(stream)
+            except Exception as e:
+                if self._stop.is_set():
+                    return
+                # The stream died (failover, network): poll from here on so
+                # changes are never missed.
+                print(f"--- Change stream closed ({e}); falling back to polling")
+                self.mode = "polling"
+                while not self._stop.wait(self.poll_seconds):
+                    self.poll()
+
+        self._thread = threading.Thread(target=watch, name="data-version-watch", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Signals the thread to exit; with a timeout, also waits for it (before
+        fork). Returns False if the thread is still running afterwards.
+        """
+        self._stop.set()
+        if timeout is not None and self._thread is not None:
+            self._thread.join(timeout)
+        return self._thread is None or not self._thread.is_alive()
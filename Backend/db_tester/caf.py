@@ -1,79 +1,360 @@
+"""
+Profiler for the Trade database.
+
+    python caf.py profile                      # JSON report on stdout
+    python caf.py profile --output report.json --append history.jsonl
+    python caf.py profile --collections trades --sample-size 5000 --no-benchmarks
+    python caf.py browse                       # print the first documents of a collection
+
+The report covers, per collection: document counts, document sizes
+(average and percentiles), field presence/types/cardinality and value
+distributions, index sizes and $indexStats usage; orphaned foreign keys in
+trades; and the timing of a fixed set of benchmark aggregations. Field and
+size statistics come from a $sample, so a run stays fast on large
+collections. Append each run to a JSONL history to track data growth and
+query-cost drift over time.
+"""
 import os
-import pymongo
+import sys
+import json
+import time
 import pprint
+import argparse
+import datetime
+import statistics
+from collections import Counter
+import bson
+import pymongo
 from dotenv import load_dotenv
 
-def main():
-    """
-    Connects to the MongoDB Atlas cluster and fetches data from
-    the collection specified by the user.
-    """
+DATABASE = "Trade"
+SAMPLE_SIZE = 2000
+# Distinct values listed per field; fields with more are reported by cardinality only.
+TOP_VALUES = 10
+# Fields whose full value distribution is always reported.
+DISTRIBUTION_FIELDS = {
+    "trades": ["trade_type", "port", "currency"],
+    "impexp": ["product", "import_export_quantity_in_000_metric_tonnes"],
+}
+FOREIGN_KEYS = {
+    "trades": {"country_id": "countries", "commodity_id": "commodities", "year_id": "years"},
+}
+ORPHAN_EXAMPLES = 5
+SIZE_PERCENTILES = (50, 90, 99)
+BENCHMARK_REPEAT = 3
+# Representative query shapes; the same names across runs make timings comparable.
+BENCHMARKS = [
+    ("trades_count_by_type", "trades", [
+        {"$group": {"_id": "$trade_type", "count": {"$sum": 1}}},
+    ]),
+    ("trades_value_by_port", "trades", [
+        {"$group": {"_id": "$port", "total_usd": {"$sum": "$value_usd"}}},
+        {"$sort": {"total_usd": -1}},
+    ]),
+    ("trades_top_countries_with_lookup", "trades", [
+        {"$group": {"_id": "$country_id", "total_usd": {"$sum": "$value_usd"}}},
+        {"$sort": {"total_usd": -1}},
+        {"$limit": 10},
+        {"$lookup": {"from": "countries", "localField": "_id", "foreignField": "_id", "as": "country_doc"}},
+        {"$unwind": "$country_doc"},
+    ]),
+    ("trades_exports_by_year_with_lookup", "trades", [
+        {"$lookup": {"from": "years", "localField": "year_id", "foreignField": "_id", "as": "year_doc"}},
+        {"$unwind": "$year_doc"},
+        {"$match": {"trade_type": "Export"}},
+        {"$group": {"_id": "$year_doc.year", "total_usd": {"$sum": "$value_usd"}}},
+        {"$sort": {"_id": 1}},
+    ]),
+    ("trades_monthly_trend", "trades", [
+        {"$group": {"_id": {"$substrBytes": ["$created_at", 0, 7]}, "total_usd": {"$sum": "$value_usd"}}},
+        {"$sort": {"_id": 1}},
+    ]),
+    ("impexp_crude_oil_imports", "impexp", [
+        {"$match": {"product": "CRUDE OIL", "import_export_quantity_in_000_metric_tonnes": "IMPORT"}},
+    ]),
+]
+
+
+def log(message):
+    """Progress goes to stderr so stdout stays machine-readable."""
+    print(message, file=sys.stderr)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+def type_name(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, str):
+        return "string"
+    if isinstance(value, bson.ObjectId):
+        return "objectId"
+    if isinstance(value, datetime.datetime):
+        return "date"
+    if isinstance(value, list):
+        return "array"
+    if isinstance(value, dict):
+        return "object"
+    return "null" if value is None else type(value).__name__
+
+
+def flatten(document, prefix=""):
+    """Dotted field paths to values, one level into embedded documents."""
+    fields = {}
+    for key, value in document.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict) and not prefix:
+            fields.update(flatten(value, f"{path}."))
+        else:
+            fields[path] = value
+    return fields
+
+
+def sample(collection, size):
+    """Up to size random documents; the whole collection when it is smaller."""
+    return list(collection.aggregate([{"$sample": {"size": size}}], allowDiskUse=True))
+
+
+# --- Sections ---
+def profile_sizes(documents, stats):
+    sizes = sorted(len(bson.encode(document)) for document in documents)
+    report = {
+        "sampled_avg_bytes": round(statistics.fmean(sizes), 1) if sizes else None,
+        "sampled_max_bytes": sizes[-1] if sizes else None,
+    }
+    for p in SIZE_PERCENTILES:
+        report[f"p{p}_bytes"] = percentile(sizes, p / 100)
+    if stats:
+        report.update({
+            "avg_obj_bytes": stats.get("avgObjSize"),
+            "data_bytes": stats.get("size"),
+            "storage_bytes": stats.get("storageSize"),
+        })
+    return report
+
+
+def profile_fields(documents, count, distribution_fields):
+    """Presence, types, sample cardinality and value distributions per field."""
+    values = {}
+    for document in documents:
+        for path, value in flatten(document).items():
+            values.setdefault(path, []).append(value)
+    n = len(documents)
+    fields = {}
+    for path, observed in sorted(values.items()):
+        counts = Counter(json.dumps(value, default=str, sort_keys=True) for value in observed)
+        distinct = len(counts)
+        field = {
+            "present": round(len(observed) / n, 4),
+            "types": dict(Counter(type_name(value) for value in observed)),
+            "distinct_in_sample": distinct,
+            # Every sampled value different: treat as (near) unique, e.g. _id.
+            "likely_unique": distinct == len(observed) and len(observed) > 1,
+        }
+        if path in distribution_fields or distinct <= TOP_VALUES:
+            field["distribution"] = [
+                {"value": json.loads(value), "share": round(c / n, 4), "estimated_count": round(c / n * count)}
+                for value, c in counts.most_common(TOP_VALUES if path not in distribution_fields else None)
+            ]
+        fields[path] = field
+    return fields
+
+
+def profile_orphans(db, documents, count, foreign_keys):
+    """Sampled trades whose foreign keys point at no document in the dimension collection."""
+    report = {}
+    n = len(documents)
+    for field, target in foreign_keys.items():
+        known = {document["_id"] for document in db.get_collection(target).find({}, {"_id": 1})}
+        missing = [document.get(field) for document in documents if document.get(field) is None]
+        orphans = [document[field] for document in documents
+                   if document.get(field) is not None and document[field] not in known]
+        report[field] = {
+            "references": target,
+            "missing_in_sample": len(missing),
+            "orphans_in_sample": len(orphans),
+            "orphan_rate": round(len(orphans) / n, 4) if n else None,
+            "estimated_orphans": round(len(orphans) / n * count) if n else None,
+            "examples": [str(value) for value in list(dict.fromkeys(orphans))[:ORPHAN_EXAMPLES]],
+        }
+    return report
+
+
+def profile_indexes(collection, stats):
+    sizes = (stats or {}).get("indexSizes", {})
+    indexes = {name: {"keys": info.get("key"), "unique": info.get("unique", False), "bytes": sizes.get(name)}
+               for name, info in collection.index_information().items()}
     try:
-       
-        load_dotenv()
-        MONGO_URI = os.getenv("MONGO_ATLAS_URI")
-        
-        if not MONGO_URI:
-            print("ERROR: MONGO_ATLAS_URI not found in .env file.")
-            print("Please create a .env file with your connection string.")
-            return
-
-       
-        print("Connecting to MongoDB Atlas...")
-        client = pymongo.MongoClient(MONGO_URI)
-        
-       
-        client.admin.command('ping')
-        print("✅ MongoDB connection successful!")
-        
-        
-        db = client.get_database("Trade")
-        print(f"Accessing database: '{db.name}'")
-        
-        
-        collection_names = db.list_collection_names()
-        print(f"Found collections: {collection_names}")
-        
-        if not collection_names:
-            print("ERROR: No collections found in this database.")
-            return
-
-     
-        while True:
-            print("\n-------------------------------------------------")
-            collection_name = input(f"Enter a collection name to fetch (or 'exit' to quit): \n{collection_names}\n> ")
-            
-            if collection_name == "exit":
+        for usage in collection.aggregate([{"$indexStats": {}}]):
+            if usage["name"] in indexes:
+                accesses = usage.get("accesses", {})
+                since = accesses.get("since")
+                indexes[usage["name"]].update({
+                    "ops": accesses.get("ops"),
+                    "ops_since": since.isoformat() if isinstance(since, datetime.datetime) else since,
+                })
+    except Exception as e:
+        # $indexStats needs a real server and the indexStats privilege.
+        log(f"  $indexStats unavailable on '{collection.name}': {e}")
+    return {"total_bytes": (stats or {}).get("totalIndexSize"), "indexes": indexes}
+
+
+def collection_stats(db, name):
+    try:
+        return db.command("collStats", name)
+    except Exception as e:
+        log(f"  collStats unavailable on '{name}': {e}")
+        return None
+
+
+def profile_collection(db, name, sample_size, exact_counts):
+    collection = db.get_collection(name)
+    started = time.perf_counter()
+    count = collection.count_documents({}) if exact_counts else collection.estimated_document_count()
+    stats = collection_stats(db, name)
+    documents = sample(collection, sample_size)
+    report = {
+        "count": count,
+        "count_exact": exact_counts,
+        "sampled": len(documents),
+        "sizes": profile_sizes(documents, stats),
+        "fields": profile_fields(documents, count, DISTRIBUTION_FIELDS.get(name, [])),
+        "indexes": profile_indexes(collection, stats),
+    }
+    if name in FOREIGN_KEYS:
+        report["orphans"] = profile_orphans(db, documents, count, FOREIGN_KEYS[name])
+    report["profile_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return report
+
+
+def run_benchmarks(db, collections, repeat):
+    """Best and median wall time of each standard aggregation."""
+    results = {}
+    for name, collection_name, pipeline in BENCHMARKS:
+        if collection_name not in collections:
+            continue
+        timings, rows, error = [], None, None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            try:
+                rows = len(list(db.get_collection(collection_name).aggregate(pipeline, allowDiskUse=True)))
+            except Exception as e:
+                error = str(e)
                 break
-                
-            if collection_name not in collection_names:
-                print(f"ERROR: Collection '{collection_name}' does not exist.")
-                continue
-
-            
-            print(f"Fetching first 5 documents from '{collection_name}'...")
-            collection = db.get_collection(collection_name)
-            
-            
-            documents = list(collection.find().limit(5))
-            
-            if not documents:
-                print(f"No documents found in '{collection_name}'.")
-            else:
-                print(f"--- Found {len(documents)} documents ---")
-             
-                pprint.pprint(documents)
+            timings.append((time.perf_counter() - started) * 1000)
+        results[name] = {
+            "collection": collection_name,
+            "rows": rows,
+            "min_ms": round(min(timings), 2) if timings else None,
+            "median_ms": round(statistics.median(timings), 2) if timings else None,
+            "runs": len(timings),
+            "error": error,
+        }
+        log(f"  {name}: {error or str(results[name]['median_ms']) + ' ms'}")
+    return results
+
 
+def profile(db, collections=None, sample_size=SAMPLE_SIZE, exact_counts=False, benchmarks=True,
+            repeat=BENCHMARK_REPEAT):
+    existing = db.list_collection_names()
+    collections = [name for name in (collections or sorted(existing)) if name in existing]
+    try:
+        server_version = db.client.server_info().get("version")
+    except Exception:
+        server_version = None
+    report = {
+        "generated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="seconds"),
+        "database": db.name,
+        "server_version": server_version,
+        "sample_size": sample_size,
+        "collections": {},
+    }
+    for name in collections:
+        log(f"Profiling '{name}' ...")
+        report["collections"][name] = profile_collection(db, name, sample_size, exact_counts)
+    if benchmarks:
+        log("Running benchmark aggregations ...")
+        report["benchmarks"] = run_benchmarks(db, collections, repeat)
+    return report
+
+
+# --- Interactive browsing (the original caf.py behaviour) ---
+def browse(db):
+    collection_names = db.list_collection_names()
+    print(f"Found collections: {collection_names}")
+    if not collection_names:
+        print("ERROR: No collections found in this database.")
+        return
+    while True:
+        print("\n-------------------------------------------------")
+        collection_name = input(f"Enter a collection name to fetch (or 'exit' to quit): \n{collection_names}\n> ")
+        if collection_name == "exit":
+            break
+        if collection_name not in collection_names:
+            print(f"ERROR: Collection '{collection_name}' does not exist.")
+            continue
+        print(f"Fetching first 5 documents from '{collection_name}'...")
+        documents = list(db.get_collection(collection_name).find().limit(5))
+        if not documents:
+            print(f"No documents found in '{collection_name}'.")
+        else:
+            print(f"--- Found {len(documents)} documents ---")
+            pprint.pprint(documents)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=f"Profile the {DATABASE} database")
+    sub = parser.add_subparsers(dest="command")
+    profile_parser = sub.add_parser("profile", help="JSON profile: counts, sizes, fields, orphans, indexes, benchmarks")
+    profile_parser.add_argument("--collections", help="comma-separated collections (default: all)")
+    profile_parser.add_argument("--sample-size", type=int, default=SAMPLE_SIZE)
+    profile_parser.add_argument("--exact-counts", action="store_true", help="count_documents instead of metadata counts")
+    profile_parser.add_argument("--no-benchmarks", action="store_true")
+    profile_parser.add_argument("--repeat", type=int, default=BENCHMARK_REPEAT, help="runs per benchmark")
+    profile_parser.add_argument("--output", help="write the report here instead of stdout")
+    profile_parser.add_argument("--append", metavar="HISTORY", help="also append the report as one JSON line")
+    sub.add_parser("browse", help="print the first documents of a collection")
+    args = parser.parse_args()
+
+    load_dotenv()
+    mongo_uri = os.getenv("MONGO_ATLAS_URI")
+    if not mongo_uri:
+        print("ERROR: MONGO_ATLAS_URI not found in .env file.", file=sys.stderr)
+        print("Please create a .env file with your connection string.", file=sys.stderr)
+        return 1
+    client = pymongo.MongoClient(mongo_uri)
+    try:
+        client.admin.command('ping')
+        db = client.get_database(DATABASE)
+        if args.command != "profile":
+            browse(db)
+            return 0
+        report = profile(db, args.collections.split(",") if args.collections else None, args.sample_size,
+                         args.exact_counts, not args.no_benchmarks, args.repeat)
+        text = json.dumps(report, indent=2, default=str)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+        if args.append:
+            with open(args.append, "a") as f:
+                f.write(json.dumps(report, separators=(",", ":"), default=str) + "\n")
+        return 0
     except pymongo.errors.ConfigurationError:
-        print("ERROR: Invalid connection string. Check your .env file.")
+        print("ERROR: Invalid connection string. Check your .env file.", file=sys.stderr)
     except pymongo.errors.OperationFailure as e:
-        print(f"ERROR: MongoDB operation failed (check username/password): {e.details}")
-    except Exception as e:
-        print(f"An unexpected error occurred: {e}")
+        print(f"ERROR: MongoDB operation failed (check username/password): {e.details}", file=sys.stderr)
     finally:
-        if 'client' in locals():
-            client.close()
-            print("MongoDB connection closed.")
+        client.close()
+    return 1
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -1,11 +1,33 @@
 import os
 import json
-from flask import Flask, jsonify, request
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 import pymongo
 from bson import ObjectId
-from openai import OpenAI
+from pipeline_validator import validate_and_repair, build_repair_prompt, PipelineValidationError
+from schema_introspect import SchemaCache
+from entity_index import EntityIndex, DIMENSIONS
+from data_version import DataVersionTracker, collections_read, SYNC_COLLECTION
+from partitioning import PartitionCatalog, PartitionRouter
+import timeseries
+from approximate import Approximator
+from query_log import QueryLog, CacheWarmer
+from chart_shape import chart_options, chart_etag, shape_chart
+from suggest import SuggestIndex, SUGGEST_LIMIT, SUGGEST_LIMIT_MAX, KINDS as SUGGEST_KINDS
+from stream_parser import IncrementalQueryParser, StreamAborted
+from prompts import SCHEMA_PROMPT_TEMPLATE, prompt_examples
+from capture import TrafficCapture, current_query
+from speculation import Speculator, normalize_query
+from refinement import QueryStateStore, looks_like_followup, parse_followup, apply_edits, local_result, build_edit_prompt
+from export import FORMATS, DEFAULT_BATCH_SIZE, MAX_BATCH_SIZE, available_formats, export_stream
+from llm_providers import LLMClient, providers_from_spec
+from model_router import ModelRouter, SIMPLE, COMPLEX
+from admission import AdmissionController, Overloaded, budget_from_env, caller, INTERACTIVE, BATCH
+from response_cache import (CachedBody, generated_queries, result_bodies, stale_results, make_etag, encoded_etag,
+                            revalidate, negotiate_encoding)
 
 
 load_dotenv()
@@ -13,116 +35,293 @@ app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "http://localhost:5173"}})
 
 MONGO_URI = os.getenv("MONGO_ATLAS_URI")
-client = pymongo.MongoClient(MONGO_URI)
-db = client.get_database("Trade")
-trades_collection = db.get_collection("trades")
-impexp_collection = db.get_collection("impexp")
-countries_collection = db.get_collection("countries")
-commodities_collection = db.get_collection("commodities")
-years_collection = db.get_collection("years")
 
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-llm_client = OpenAI(api_key=OPENAI_API_KEY)
+def connect_database():
+    """
+    (Re)creates the MongoClient and collection handles. MongoClient is not
+    fork-safe, so each forked worker calls this again (see reset_after_fork).
+    """
+    global client, db, COLLECTION_MAP
+    client = pymongo.MongoClient(MONGO_URI)
+    db = client.get_database("Trade")
+    COLLECTION_MAP = {
+        "trades": db.get_collection("trades"),
+        "impexp": db.get_collection("impexp"),
+        "countries": db.get_collection("countries"),
+        "commodities": db.get_collection("commodities"),
+        "years": db.get_collection("years")
+    }
+
+
+connect_database()
+
+# Introspected schema: feeds the prompt and the validator, refreshed in the background.
+schema_cache = SchemaCache(db)
+# Dimension lookups (country/commodity/year names -> ids), rebuilt when the data changes.
+entity_index = EntityIndex(db)
+schema_cache.on_change.append(entity_index.refresh)
+try:
+    entity_index.refresh()
+except Exception as e:
+    print(f"--- Entity index not loaded: {e}")
+SCHEMA_REFRESH_SECONDS = int(os.getenv("SCHEMA_REFRESH_SECONDS", 300))
+schema_cache.start(interval_seconds=SCHEMA_REFRESH_SECONDS)
+# Year-partitioned trades (partitioning.py migrate): used once the catalog exists.
+partition_catalog = PartitionCatalog(db)
+if os.getenv("TRADES_PARTITIONS", "auto") != "off":
+    try:
+        partition_catalog.refresh()
+    except Exception as e:
+        print(f"--- Partition catalog not loaded: {e}")
+partition_router = PartitionRouter(db, partition_catalog)
+# Native-date copy of trades (timeseries.py migrate): serves date-range and trend queries.
+# It is only queried while it matches trades (see trades_copies_changed).
+try:
+    TIMESERIES_CONFIGURED = os.getenv("TRADES_TIMESERIES", "auto") != "off" and timeseries.available(db)
+    TIMESERIES_ENABLED = TIMESERIES_CONFIGURED and timeseries.usable(db)
+    if TIMESERIES_CONFIGURED and not TIMESERIES_ENABLED:
+        print(f"--- '{timeseries.TS_COLLECTION}' is out of sync with trades; run `timeseries.py migrate`")
+except Exception as e:
+    print(f"--- Time-series collection not checked: {e}")
+    TIMESERIES_CONFIGURED = TIMESERIES_ENABLED = False
+# Sampled estimates for big trade aggregations, streamed before the exact result.
+approximator = Approximator(db)
+try:
+    approximator.refresh()
+except Exception as e:
+    print(f"--- Sample strata not loaded: {e}")
+# Background query work: exact results behind a progressive response, and
+# preparation while a generated query is still streaming in.
+exact_pool = ThreadPoolExecutor(max_workers=int(os.getenv("EXACT_WORKERS", 8)), thread_name_prefix="exact")
+
+# Per-collection data versions (change streams, else polling): cache keys and SSE pushes.
+# The derived trade copies and their sync records count as trades.
+data_versions = DataVersionTracker(db, list(COLLECTION_MAP),
+                                   aliases={name: "trades" for name in partition_catalog.collections()
+                                            + ([timeseries.TS_COLLECTION] if TIMESERIES_CONFIGURED else [])
+                                            + [SYNC_COLLECTION]})
+
+
+def trades_copies_changed(name):
+    """Routing to the partitions and trades_ts stops as soon as trades no longer matches them."""
+    global TIMESERIES_ENABLED
+    if name != "trades":
+        return
+    if partition_catalog.partitions:
+        partition_catalog.refresh()
+    if TIMESERIES_CONFIGURED:
+        TIMESERIES_ENABLED = timeseries.usable(db)
+
 
-def get_openai_generated_query(user_query: str) -> dict | None:
+data_versions.on_change.append(trades_copies_changed)
+data_versions.on_change.append(lambda name: entity_index.refresh() if name in DIMENSIONS else None)
+data_versions.start()
+# Typeahead names for /api/suggest, served from memory; each source reloads when its data changes.
+suggest_index = SuggestIndex(db)
+try:
+    suggest_index.refresh()
+except Exception as e:
+    print(f"--- Suggestion index not loaded: {e}")
+data_versions.on_change.append(suggest_index.changed)
+suggest_index.start()
+
+
+# Every LLM call takes a slot first: rate budgets, priorities, fair queuing, shedding.
+admission = AdmissionController({
+    "openai": budget_from_env("openai", rpm=500, tpm=30000),
+    "gemini": budget_from_env("gemini", rpm=1000, tpm=1000000),
+})
+# Ordered providers: the first is primary, the second is the hedge target.
+# e.g. LLM_PROVIDERS="openai:gpt-4o,gemini:gemini-2.5-flash" or "fake" for local runs.
+LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "openai:gpt-4o")
+# Small, fast tier tried first for simple questions (see model_router.py).
+LLM_PROVIDERS_SMALL = os.getenv(
+    "LLM_PROVIDERS_SMALL", "openai:gpt-4o-mini" if LLM_PROVIDERS.startswith("openai") else LLM_PROVIDERS)
+
+
+# CAPTURE_PATH records query traffic and LLM answers for replay (see capture.py).
+traffic_capture = TrafficCapture()
+
+
+def build_llm_clients() -> tuple[LLMClient, LLMClient]:
+    """(small tier, large tier) clients sharing one admission controller."""
+    clients = (LLMClient(providers_from_spec(LLM_PROVIDERS_SMALL), admission=admission),
+               LLMClient(providers_from_spec(LLM_PROVIDERS), admission=admission))
+    if traffic_capture.enabled:
+        for client in clients:
+            client.listeners.append(traffic_capture.record_completion)
+    return clients
+
+
+llm_small, llm = build_llm_clients()
+router = ModelRouter(llm_small, llm, entity_index)
+
+
+def reset_after_fork():
+    """
+    Called in each gunicorn worker (gunicorn.conf.py post_fork). The warm
+    caches built in the parent - schema summary, entity index, compiled
+    prompt - are inherited copy-on-write; only connections and background
+    threads, which do not survive fork, are recreated.
+    """
+    global llm, llm_small
+    connect_database()
+    schema_cache.db = db
+    entity_index.db = db
+    schema_cache.start(interval_seconds=SCHEMA_REFRESH_SECONDS, refresh_now=False)
+    partition_catalog.db = db
+    partition_router.db = db
+    approximator.db = db
+    data_versions.db = db
+    data_versions.start(baseline=False)
+    suggest_index.db = db
+    suggest_index.start()
+    llm_small, llm = build_llm_clients()
+    router.small, router.large = llm_small, llm
+    if CACHE_WARMUP:
+        warmer.start()
+
+
+_compiled_prompts = {}
+
+
+def compiled_prompt() -> str:
+    """Static prompt prefix for the current schema version."""
+    key = schema_cache.content_hash
+    prompt = _compiled_prompts.get(key)
+    if prompt is None:
+        prompt = SCHEMA_PROMPT_TEMPLATE.format(schema_summary=schema_cache.summary)
+        _compiled_prompts.clear()
+        _compiled_prompts[key] = prompt
+    return prompt
+
+
+def validated(response_text: str):
+    return validate_and_repair(response_text, schema_cache.schemas)
+
+
+# Generation streams: the answer is parsed while it arrives (stream_parser.py).
+LLM_STREAMING = os.getenv("LLM_STREAMING", "on") != "off"
+stream_stats = {"streams": 0, "aborted": 0, "connections_warmed": 0, "stages_resolved": 0, "stages_invalid": 0}
+
+
+def warm_connection():
+    """One round trip on the pooled MongoDB connection while the model is still writing."""
+    client.admin.command("ping")
+    stream_stats["connections_warmed"] += 1
+
+
+def resolve_stages(collection: str, stages: list):
+    """
+    Resolves entity predicates of the stages so far; EntityIndex memoizes
+    them for execution. The stages are validated (and repaired) first, the
+    way the whole answer will be, so only predicates that can reach
+    execution are resolved.
+    """
+    try:
+        query_data, _ = validate_and_repair({"collection": collection, "pipeline": stages}, schema_cache.schemas)
+        entity_index.rewrite_pipeline(query_data["collection"], query_data["pipeline"])
+    except PipelineValidationError as e:
+        # The full answer is validated (and re-asked) as usual.
+        stream_stats["stages_invalid"] += 1
+        print(f"--- Streamed stages not resolved ahead of the answer: {e.errors}")
+        return
+    except Exception as e:
+        print(f"--- Resolving streamed stages failed: {e}")
+        return
+    stream_stats["stages_resolved"] += 1
+
+
+def prepare_from_stream(parser: IncrementalQueryParser, event: tuple):
+    kind = event[0]
+    if kind == "collection":
+        exact_pool.submit(warm_connection)
+    elif kind == "stage" and any(name.lstrip("$").lower() == "match" for name in event[2]):
+        exact_pool.submit(resolve_stages, parser.collection, list(parser.stages))
+
+
+def stream_preparer():
+    """
+    stream= factory for LLMClient.complete: each attempt gets a fresh
+    incremental parser that prepares execution from the parts already
+    received and aborts the stream on structurally invalid output.
     """
-    Calls OpenAI API to generate the query. 
+    def start():
+        parser = IncrementalQueryParser()
+        stream_stats["streams"] += 1
+
+        def on_chunk(text):
+            try:
+                events = parser.feed(text)
+            except StreamAborted as e:
+                stream_stats["aborted"] += 1
+                print(f"--- Aborting generation after {len(parser.text)} chars: {e}")
+                raise
+            for event in events:
+                prepare_from_stream(parser, event)
+        return on_chunk
+    return start
+
+
+def generate_on_tier(tier: str, user_query: str, prompt: str):
+    """One tier's attempt; only the large tier gets the targeted re-ask."""
+    client = router.client(tier)
+    stream = stream_preparer() if LLM_STREAMING else None
+    started = time.perf_counter()
+    try:
+        try:
+            # Validation is the acceptance test: with hedging, the first valid answer wins.
+            (query_data, repairs), completion = client.complete(prompt, parse=validated, stream=stream)
+        except PipelineValidationError as e:
+            if tier == SIMPLE:
+                raise
+            # One targeted re-ask with only the failing output and the problems found.
+            print("--- Pipeline failed validation, re-asking once:", e.errors)
+            retry_prompt = build_repair_prompt(user_query, e.query_data, e.errors, schema_cache.schemas)
+            (query_data, repairs), completion = client.complete(retry_prompt, parse=validated, stream=stream)
+    except Exception:
+        router.record(tier, time.perf_counter() - started, error=True)
+        raise
+    router.record(tier, time.perf_counter() - started)
+    print(f"--- Generated by {completion.provider} ({tier} tier) in {completion.latency:.2f}s")
+    if repairs:
+        print("--- Pipeline auto-repairs:", repairs)
+    return query_data
+
+
+def get_llm_generated_query(user_query: str) -> dict | None:
+    """
+    Calls the configured LLM provider(s) to generate the query: the small
+    tier for simple questions, escalating to the large one if its answer
+    does not validate.
     Returns dict: {"collection": "...", "pipeline": [...] }
     """
-    # IMPORTANT: This is your refined schema prompt
-    schema_instructions = f"""
-You are a MongoDB aggregation expert.  
-Your job is to convert the user's plain-English question into a concise valid JSON object with these top-level fields only:
-{{"collection": "<collection>", "pipeline": [...]}}
-
-The database is named 'Trade' (exact case). It contains these collections and relationships:
-
-1. trades:
-   - Fields: _id, country_id (ObjectId), commodity_id (ObjectId), year_id (ObjectId), trade_type ("Export"|"Import"), quantity (Number), value_usd (Number), currency ("USD"), unit_price (Number), port (String), created_at (ISODate)
-   - Relationships:
-     - trades.country_id → countries._id
-     - trades.commodity_id → commodities._id
-     - trades.year_id → years._id
-
-2. countries:
-   - _id, country_code, country_name, region, sub_region, iso3, currency, population (Number)
-
-3. commodities:
-   - _id, hs_code, commodity_name, category, unit, description
-
-4. years:
-   - _id, year (Number), description
-
-5. impexp:
-   - _id, import_export_quantity_in_000_metric_tonnes ("IMPORT"|"EXPORT"), product (String), april, may, june, july, august, september, october, november, december, january, february, march, total (all Numbers)
-     (product is equivalent to commodities.commodity_name)
-
-Instructions:
-- Choose 'trades' for queries about: specific trade lines, USD values, units, ports, trades by country/commodity/year, or "top N by value". Always join related info using $lookup and $unwind as needed.
-- Choose 'impexp' for: monthly/annual import/export totals, queries using words like "metric tonnes", or product-based aggregated import/export (e.g. LPG, MS, HSD, CRUDE OIL).
-- Only use fields exactly as shown (no guessing keys). Only output a JSON object with keys: collection and pipeline.
-
-EXAMPLES:
-
-User: "exports from india"
-{{"collection": "trades", "pipeline": [
-  {{"$lookup": {{"from": "countries", "localField": "country_id", "foreignField": "_id", "as": "country_doc"}}}},
-  {{"$unwind": "$country_doc"}},
-  {{"$match": {{"country_doc.country_name": "India", "trade_type": "Export"}}}}
-]}}
-
-User: "top 3 commodities by value last year"
-{{"collection": "trades", "pipeline": [
-  {{"$lookup": {{"from": "years", "localField": "year_id", "foreignField": "_id", "as": "year_doc"}}}},
-  {{"$unwind": "$year_doc"}},
-  {{"$lookup": {{"from": "commodities", "localField": "commodity_id", "foreignField": "_id", "as": "commodity_doc"}}}},
-  {{"$unwind": "$commodity_doc"}},
-  {{"$match": {{"year_doc.year": 2024}}}},
-  {{"$group": {{"_id": "$commodity_doc.commodity_name", "total_value": {{"$sum": "$value_usd"}}}}}},
-  {{"$sort": {{"total_value": -1}}}},
-  {{"$limit": 3}}
-]}}
-
-User: "monthly import of crude oil"
-{{"collection": "impexp", "pipeline": [
-  {{"$match": {{"product": "CRUDE OIL", "import_export_quantity_in_000_metric_tonnes": "IMPORT"}}}},
-  {{"$project": {{"_id": 0, "product": 1, "april": 1, "may": 1, "june": 1, "july": 1, "august": 1, "september": 1, "october": 1, "november": 1, "december": 1, "january": 1, "february": 1, "march": 1, "total": 1}}}}
-]}}
-
-User: "total exports by port"
-{{"collection": "trades", "pipeline": [
-  {{"$match": {{"trade_type": "Export"}}}},
-  {{"$group": {{"_id": "$port", "total_usd": {{"$sum": "$value_usd"}}}}}},
-  {{"$sort": {{"total_usd": -1}}}}
-]}}
-
-ALWAYS generate only valid JSON using double quotes. Only allowed values for "collection" are: trades, impexp, countries, commodities, years. Ignore any unrelated collections or fields.  
-Now, output the JSON query object for this (verbatim) user request:
-"{user_query}"
-"""
+    schema_instructions = compiled_prompt() + f'"{user_query}"\n'
+    tier = router.route(user_query)
     try:
-        completion = llm_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[{"role": "system", "content": schema_instructions}],
-            response_format={"type": "json_object"},
-            temperature=0.0
-        )
-        response_text = completion.choices[0].message.content
-        query_data = json.loads(response_text)
-        if "collection" not in query_data or "pipeline" not in query_data:
-            raise ValueError("AI response missing 'collection' or 'pipeline' key.")
-        if not isinstance(query_data["pipeline"], list):
-            if isinstance(query_data["pipeline"], dict):
-                query_data["pipeline"] = [query_data["pipeline"]]
-            else:
-                raise TypeError("AI 'pipeline' value is not a list or dict.")
-        return query_data
+        if tier == SIMPLE:
+            try:
+                return generate_on_tier(SIMPLE, user_query, schema_instructions)
+            except Overloaded:
+                raise
+            except Exception as e:
+                print(f"--- Small tier failed ({e}), escalating to the large tier")
+                router.escalated()
+        return generate_on_tier(COMPLEX, user_query, schema_instructions)
+    except Overloaded:
+        raise
     except Exception as e:
-        print("!!!!!!!! OpenAI query generation error:", e)
+        print("!!!!!!!! LLM query generation error:", e)
         return None
 
 
+def complete_json(prompt: str) -> str:
+    """Sends a single system prompt and returns the raw JSON response text."""
+    text, _ = llm.complete(prompt)
+    return text
+
+
 def convert_objectids(doc):
     if isinstance(doc, list):
         return [convert_objectids(item) for item in doc]
@@ -135,48 +334,524 @@ def convert_objectids(doc):
     return doc
 
 
+def open_cursor(query_data: dict, batch_size: int | None = None):
+    """Starts a validated query on its collection and returns the cursor."""
+    collection_name = query_data.get("collection")
+    pipeline_to_execute = query_data.get("pipeline")
+    target_collection = COLLECTION_MAP.get(collection_name)
+    if target_collection is None:
+        raise ValueError(f"Collection not valid: {collection_name}")
+    print(f"--- Executing pipeline on '{collection_name}' ---")
+    print(json.dumps(pipeline_to_execute, indent=2))
+    # Resolve name/regex predicates on joined dimensions to indexed id matches.
+    execution_pipeline, rewrites = entity_index.rewrite_pipeline(collection_name, pipeline_to_execute)
+    if rewrites:
+        print("--- Entity rewrites:", rewrites)
+    options = {"allowDiskUse": True, "batchSize": batch_size} if batch_size else {}
+    if collection_name == "trades" and timeseries.uses_dates(execution_pipeline):
+        # created_at is an ISO string in trades and a native date in trades_ts.
+        if TIMESERIES_ENABLED:
+            execution_pipeline, date_rewrites = timeseries.rewrite_for_native(execution_pipeline)
+            print("--- Routed to time-series collection; date rewrites:", date_rewrites)
+            return db.get_collection(timeseries.TS_COLLECTION).aggregate(execution_pipeline, **options)
+        execution_pipeline, date_rewrites = timeseries.rewrite_for_strings(execution_pipeline)
+        if date_rewrites:
+            print("--- Date rewrites:", date_rewrites)
+    if collection_name == "trades" and partition_catalog.enabled:
+        return partition_router.aggregate(execution_pipeline, batch_size)
+    return target_collection.aggregate(execution_pipeline, **options)
+
+
+def approximate_result(query_data: dict) -> dict | None:
+    """Sampled estimate with error bounds for a trades aggregation, or None."""
+    if query_data.get("collection") != "trades":
+        return None
+    pipeline, _ = entity_index.rewrite_pipeline("trades", query_data.get("pipeline"))
+    if timeseries.uses_dates(pipeline):
+        # The sample keeps the string-stored created_at of trades.
+        pipeline, _ = timeseries.rewrite_for_strings(pipeline)
+    estimate = approximator.estimate(pipeline)
+    return convert_objectids(estimate) if estimate is not None else None
+
+
+def execute_query(query_data: dict) -> list:
+    """Runs a validated query on its collection and returns JSON-safe rows."""
+    return convert_objectids(list(open_cursor(query_data)))
+
+
+def speculative_job(user_query: str, final: bool = False):
+    """Generates (and optionally executes) a query ahead of the final transcript."""
+    # Partials are best-effort and queue behind real interactive queries; a
+    # final transcript is what the user is about to wait for.
+    caller.set(("speculation", INTERACTIVE if final else BATCH))
+    query_data = get_llm_generated_query(user_query)
+    if query_data is None:
+        return None
+    results = execute_query(query_data) if SPECULATIVE_EXECUTE else None
+    return query_data, results
+
+
+SPECULATIVE_EXECUTE = os.getenv("SPECULATIVE_EXECUTE", "0") == "1"
+speculator = Speculator(speculative_job)
+# Last query per conversation session, for incremental follow-ups.
+query_states = QueryStateStore()
+
+
+def refine_previous_query(previous: dict, user_query: str):
+    """
+    Applies a follow-up to the session's previous query.
+    Returns (query_data, results_or_None, how) or None if it is not a follow-up.
+    """
+    if not looks_like_followup(user_query, previous):
+        return None
+    edits = parse_followup(user_query, previous["query_data"]["collection"], previous["query"],
+                           entity_index.mentions(user_query))
+    if edits:
+        query_data = apply_edits(previous["query_data"], edits)
+        # Cached rows are only reusable while the data under them is unchanged.
+        fresh = previous.get("version") == data_version(previous["query_data"])
+        return query_data, local_result(previous, edits) if fresh else None, f"local edits {edits}"
+    # Parser did not understand it: a short edit prompt instead of the full schema prompt.
+    fields = list(schema_cache.schemas.get(previous["query_data"]["collection"], {}))
+    try:
+        query_data, _ = validate_and_repair(
+            complete_json(build_edit_prompt(previous, user_query, fields)), schema_cache.schemas)
+    except Overloaded:
+        raise
+    except Exception as e:
+        print(f"--- Follow-up edit failed, falling back to full generation: {e}")
+        return None
+    return query_data, None, "LLM pipeline edit"
+
+
+def generate_query_cached(user_query: str) -> dict | None:
+    """LLM generation, skipped for queries already generated (temperature 0)."""
+    key = normalize_query(user_query)
+    query_data = generated_queries.get(key)
+    if query_data is None:
+        query_data = get_llm_generated_query(user_query)
+        if query_data is not None:
+            generated_queries.put(key, query_data)
+    return query_data
+
+
+def data_version(query_data: dict) -> dict:
+    """Version of exactly the collections a query reads; part of its ETag."""
+    return data_versions.version(collections_read(query_data))
+
+
+def entity_substitutions(query_data: dict) -> dict:
+    """
+    {"substitutions": [...]} when names in the query were not found and were
+    resolved to the closest existing name ("Indai" -> "India"), else {}.
+    The lookup is memoized by the entity index.
+    """
+    substitutions = []
+    entity_index.rewrite_pipeline(query_data.get("collection"), query_data.get("pipeline") or [], substitutions)
+    return {"substitutions": substitutions} if substitutions else {}
+
+
+def cached_result(user_query: str, query_data: dict, results: list | None = None, shared: bool = True):
+    """
+    Returns (etag, CachedBody) for a query, executing it only on a cache miss.
+    shared=False (a session's refined follow-up) keeps the result out of the
+    stale store, which is keyed by question text alone.
+    """
+    etag = make_etag(query_data, data_version(query_data), user_query)
+    cached = result_bodies.get(etag)
+    if cached is None:
+        final_results = results if results is not None else execute_query(query_data)
+        body = json.dumps({
+            "query": user_query,
+            "pipeline": query_data.get("pipeline"),
+            "collection_queried": query_data.get("collection"),
+            **entity_substitutions(query_data),
+            "results": final_results
+        }, default=str).encode()
+        cached = CachedBody(body, final_results)
+        result_bodies.put(etag, cached)
+        if shared:
+            stale_results.put(normalize_query(user_query), cached)
+    return etag, cached
+
+
+def chart_result(etag: str, cached: CachedBody, user_query: str, query_data: dict, options: dict):
+    """(etag, CachedBody) of the chart-shaped variant of a cached result."""
+    etag = chart_etag(etag, options)
+    shaped = result_bodies.get(etag)
+    if shaped is None:
+        body = json.dumps({
+            "query": user_query,
+            "pipeline": query_data.get("pipeline"),
+            "collection_queried": query_data.get("collection"),
+            **entity_substitutions(query_data),
+            "chart": shape_chart(cached.rows, options)
+        }, default=str).encode()
+        shaped = CachedBody(body, cached.rows)
+        result_bodies.put(etag, shaped)
+    return etag, shaped
+
+
+def warm_query(user_query: str, known=None) -> bool:
+    """
+    Puts one query into the generation and result caches. A known pipeline
+    (logged or from the prompt examples) is reused if it still validates
+    against the current schema; otherwise the LLM generates it.
+    """
+    caller.set(("warmup", BATCH))
+    key = normalize_query(user_query)
+    if known is not None and key not in generated_queries:
+        try:
+            query_data, _ = validated(known if isinstance(known, str) else json.dumps(known))
+            generated_queries.put(key, query_data)
+        except PipelineValidationError as e:
+            print(f"--- Known pipeline for '{user_query}' no longer validates, regenerating: {e}")
+    query_data = generate_query_cached(user_query)
+    if query_data is None or query_data.get("collection") not in COLLECTION_MAP:
+        return False
+    cached_result(user_query, query_data)
+    return True
+
+
+def is_warm(user_query: str) -> bool:
+    """Both the generated query and its current result are cached."""
+    query_data = generated_queries.peek(normalize_query(user_query))
+    if query_data is None:
+        return False
+    return make_etag(query_data, data_version(query_data), user_query) in result_bodies
+
+
+# Popular queries survive restarts in the query log; the warmer replays them
+# (and the prompt examples) into the caches at startup and periodically.
+query_log = QueryLog()
+try:
+    query_log.compact()
+except Exception as e:
+    print(f"--- Query log not loaded: {e}")
+# Logged questions seed the popularity ranking of typeahead suggestions.
+for entry in query_log.top(len(query_log)):
+    suggest_index.observe(entry["query"], entry["count"])
+suggest_index.build()
+CACHE_WARMUP = os.getenv("CACHE_WARMUP", "on") != "off"
+warmer = CacheWarmer(query_log, warm_query, is_warm, examples=prompt_examples())
+# The gunicorn master only builds the shared state; its caches are not the
+# workers', so each worker starts its own warmer in reset_after_fork.
+if CACHE_WARMUP and os.getenv("PREFORK_MASTER") != "1":
+    warmer.start()
+
+
+def admit_as(priority: int):
+    """Tags this request's LLM calls with its client (session or address) and class."""
+    client_key = request.args.get('session') or request.headers.get('X-Session-Id') or request.remote_addr
+    caller.set((client_key, priority))
+
+
+@app.before_request
+def start_capture():
+    """Tags the LLM calls of a captured query request with its question."""
+    if traffic_capture.enabled:
+        current_query.set(request.args.get('query') if request.endpoint == "get_trade_data" else None)
+        g.capture_arrival, g.capture_started = time.time(), time.perf_counter()
+
+
+@app.after_request
+def finish_capture(response):
+    if traffic_capture.enabled and request.endpoint == "get_trade_data":
+        traffic_capture.record_request(
+            g.capture_arrival, request.args.get('query'),
+            request.args.get('session') or request.headers.get('X-Session-Id'),
+            request.remote_addr, response.status_code, time.perf_counter() - g.capture_started)
+    return response
+
+
+def unavailable(user_query: str, retry_after: int):
+    """Saturated LLM queue: the last known result (marked stale) or a fast 503."""
+    stale = stale_results.get(normalize_query(user_query))
+    if stale is None:
+        return jsonify({"error": "Server is busy, please retry shortly."}), 503, {"Retry-After": str(retry_after)}
+    payload, encoding = stale.encoded(negotiate_encoding(request.headers.get('Accept-Encoding')))
+    response = Response(payload, mimetype="application/json")
+    response.headers["Warning"] = '110 - "Response is Stale"'
+    response.headers["X-Cache"] = "stale"
+    response.headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        response.headers["Content-Encoding"] = encoding
+    return response
+
+
+@app.route('/api/health', methods=['GET'])
+def health_check():
+    """Cheap endpoint for load balancers and load tests: no Mongo or LLM work."""
+    return jsonify({
+        "status": "healthy",
+        "pid": os.getpid(),
+        "schema_hash": schema_cache.content_hash,
+        "entities": len(entity_index.entities),
+        "data_versions": data_versions.counters(),
+        "data_version_mode": data_versions.mode,
+        "admission": admission.snapshot(),
+        "llm": {"small": llm_small.snapshot(), "large": llm.snapshot()},
+        "routing": router.snapshot(),
+        "approximate": approximator.snapshot(),
+        "warmup": warmer.snapshot(),
+        "suggest": suggest_index.snapshot(),
+        "streaming": stream_stats if LLM_STREAMING else None,
+        "capture": traffic_capture.snapshot() if traffic_capture.enabled else None,
+    })
+
+
+@app.route('/api/trade/speculate', methods=['POST'])
+def speculate():
+    """Partial/final transcripts posted by assemblyai_proxy.py for a voice session."""
+    data = request.get_json(silent=True) or {}
+    if not data.get("session") or not data.get("transcript"):
+        return jsonify({"error": "session and transcript are required"}), 400
+    speculator.observe(data["session"], data["transcript"], final=bool(data.get("final")))
+    return jsonify({"accepted": True, "stats": speculator.stats}), 202
+
+
+@app.route('/api/suggest', methods=['GET'])
+def suggest_names():
+    """Typeahead for the name being typed into the search bar, from memory only."""
+    text = request.args.get('q', '')
+    try:
+        limit = min(int(request.args.get('limit', SUGGEST_LIMIT)), SUGGEST_LIMIT_MAX)
+    except ValueError:
+        return jsonify({"error": "limit must be an integer"}), 400
+    kinds = [kind for kind in request.args.get('kinds', '').split(',') if kind] or None
+    unknown = set(kinds or ()) - set(SUGGEST_KINDS)
+    if unknown:
+        return jsonify({"error": f"unknown kinds {sorted(unknown)} (known: {list(SUGGEST_KINDS)})"}), 400
+    started = time.perf_counter()
+    suggestions = suggest_index.suggest(text[:200], limit, kinds)
+    response = jsonify({"query": text, "suggestions": suggestions,
+                        "ms": round((time.perf_counter() - started) * 1000, 3)})
+    # Rankings move slowly; a short shared cache absorbs keystroke bursts.
+    response.headers["Cache-Control"] = "public, max-age=30"
+    return response
+
+
 @app.route('/api/trade/query', methods=['GET'])
 def get_trade_data():
     user_query = request.args.get('query')
     if not user_query:
         return jsonify({"error": "Query parameter is required"}), 400
+    chart = None
+    if request.args.get('shape') == "chart":
+        try:
+            chart = chart_options(request.args)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-    query_data = get_openai_generated_query(user_query)
+    session_id = request.args.get('session') or request.headers.get('X-Session-Id')
+    started = time.perf_counter()
+    admit_as(INTERACTIVE)
+    previous = query_states.get(session_id) if session_id else None
+    try:
+        refined = refine_previous_query(previous, user_query) if previous else None
+        results = None
+        speculated = speculator.take(user_query) if refined is None else None
+        if refined is not None:
+            query_data, results, how = refined
+            print(f"--- Refined previous query ({how}), cached rows used: {results is not None}")
+        elif speculated is not None:
+            query_data, results = speculated
+            print(f"--- Reusing speculative query for '{user_query}'")
+        elif (admission.saturated() and normalize_query(user_query) not in generated_queries
+              and normalize_query(user_query) in stale_results):
+            # Would queue for long: answer from the last known result instead.
+            return unavailable(user_query, admission.retry_after())
+        else:
+            query_data = generate_query_cached(user_query)
+    except Overloaded as e:
+        print(f"--- LLM admission refused: {e}")
+        return unavailable(user_query, e.retry_after)
     if query_data is None:
         return jsonify({"error": "AI failed to generate a valid query. See server logs."}), 500
 
     collection_name = query_data.get("collection")
-    pipeline_to_execute = query_data.get("pipeline")
-    """ if collection_name == "trades":
-        target_collection = trades_collection
-    elif collection_name == "impexp":
-        target_collection = impexp_collection
-    else:
-        return jsonify({"error": f"Collection not valid: {collection_name}"}), 500 """
-    COLLECTION_MAP = {
-    "trades": trades_collection,
-    "impexp": impexp_collection,
-    "countries": countries_collection,
-    "commodities": commodities_collection,
-    "years": years_collection
-}
+    if collection_name not in COLLECTION_MAP:
+        return jsonify({"error": f"Collection not valid: {collection_name}"}), 500
 
-    target_collection = COLLECTION_MAP.get(collection_name)
-    if target_collection is None:
+    # Conditional GET: the ETag is known before anything is executed or serialized.
+    version = data_version(query_data)
+    etag = make_etag(query_data, version, user_query)
+    # The session moves on to this query even when the client only revalidates.
+    known = result_bodies.get(etag)
+    rows = known.rows if known is not None else results
+    if session_id:
+        query_states.put(session_id, user_query, query_data, rows, version)
+    if chart is not None:
+        etag = chart_etag(etag, chart)
+    # A refined follow-up ("now only 2023") means one session's edited pipeline:
+    # it stays out of the popularity log and the text-keyed stores shared by everyone.
+    shared = refined is None
+    # Each content-coding has its own strong ETag (encoded_etag).
+    encoding = negotiate_encoding(request.headers.get('Accept-Encoding'))
+    validator = revalidate(request.headers.get('If-None-Match'), etag, encoding, result_bodies.peek(etag))
+    if validator is not None:
+        if shared:
+            query_log.record(user_query, query_data, time.perf_counter() - started)
+            suggest_index.observe(user_query)
+        return Response(status=304, headers={"ETag": validator, "Vary": "Accept-Encoding"})
+    try:
+        etag, cached = cached_result(user_query, query_data, results, shared)
+        if session_id and rows is None:
+            query_states.put(session_id, user_query, query_data, cached.rows, version)
+        if chart is not None:
+            etag, cached = chart_result(etag, cached, user_query, query_data, chart)
+        if shared:
+            query_log.record(user_query, query_data, time.perf_counter() - started)
+            suggest_index.observe(user_query)
+        payload, encoding = cached.encoded(encoding)
+        response = Response(payload, mimetype="application/json")
+        response.headers["ETag"] = encoded_etag(etag, encoding)
+        response.headers["Vary"] = "Accept-Encoding"
+        # Clients may keep the body but must revalidate; a 304 costs no query.
+        response.headers["Cache-Control"] = "no-cache"
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        return response
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+
+SSE_HEARTBEAT_SECONDS = 15
+
+
+@app.route('/api/trade/subscribe', methods=['GET'])
+def subscribe_trade_data():
+    """
+    Server-Sent Events: pushes the result of a question now and again every
+    time one of the collections it reads changes, instead of client polling.
+    """
+    user_query = request.args.get('query')
+    if not user_query:
+        return jsonify({"error": "Query parameter is required"}), 400
+    admit_as(INTERACTIVE)
+    try:
+        query_data = generate_query_cached(user_query)
+    except Overloaded as e:
+        return jsonify({"error": "Server is busy, please retry shortly."}), 503, {"Retry-After": str(e.retry_after)}
+    if query_data is None:
+        return jsonify({"error": "AI failed to generate a valid query. See server logs."}), 500
+    if query_data.get("collection") not in COLLECTION_MAP:
+        return jsonify({"error": f"Collection not valid: {query_data.get('collection')}"}), 500
+    names = collections_read(query_data)
+
+    def events():
+        seen = None
+        while True:
+            if seen is None:
+                counters = data_versions.counters(names)
+            else:
+                counters = data_versions.wait_for_change(names, seen, SSE_HEARTBEAT_SECONDS)
+            if counters == seen:
+                yield ": keep-alive\n\n"
+                continue
+            seen = counters
+            try:
+                etag, cached = cached_result(user_query, query_data)
+                yield f"event: result\nid: {etag}\ndata: {cached.variants[None].decode()}\n\n"
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/api/trade/progressive', methods=['GET'])
+def progressive_trade_data():
+    """
+    Server-Sent Events: an `approximate` event with sampled estimates and
+    their confidence intervals as soon as the sample is aggregated, then
+    an `exact` event with the full result. Cached results, small
+    collections and non-decomposable pipelines send only `exact`.
+    """
+    user_query = request.args.get('query')
+    if not user_query:
+        return jsonify({"error": "Query parameter is required"}), 400
+    admit_as(INTERACTIVE)
+    try:
+        query_data = generate_query_cached(user_query)
+    except Overloaded as e:
+        return jsonify({"error": "Server is busy, please retry shortly."}), 503, {"Retry-After": str(e.retry_after)}
+    if query_data is None:
+        return jsonify({"error": "AI failed to generate a valid query. See server logs."}), 500
+    if query_data.get("collection") not in COLLECTION_MAP:
+        return jsonify({"error": f"Collection not valid: {query_data.get('collection')}"}), 500
+    etag = make_etag(query_data, data_version(query_data), user_query)
+
+    def events():
+        cached = result_bodies.get(etag)
+        if cached is None:
+            exact = exact_pool.submit(cached_result, user_query, query_data)
+            try:
+                estimate = approximate_result(query_data)
+            except Exception as e:
+                print(f"--- Approximate answer failed: {e}")
+                estimate = None
+            if estimate is not None and not exact.done():
+                estimate.update({"query": user_query, "pipeline": query_data.get("pipeline"),
+                                 "collection_queried": query_data.get("collection")})
+                yield f"event: approximate\ndata: {json.dumps(estimate, default=str)}\n\n"
+            try:
+                _, cached = exact.result()
+            except Exception as e:
+                yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+                return
+        yield f"event: exact\nid: {etag}\ndata: {cached.variants[None].decode()}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route('/api/trade/export', methods=['GET'])
+def export_trade_data():
+    """
+    Streams the full result of a question (or of a session's last query) as
+    CSV, Parquet or Arrow IPC, batch by batch from the cursor.
+    """
+    user_query = request.args.get('query')
+    session_id = request.args.get('session') or request.headers.get('X-Session-Id')
+    fmt = request.args.get('format', 'csv').lower()
+    if fmt not in available_formats():
+        return jsonify({"error": f"Unsupported format '{fmt}'. Available: {available_formats()}"}), 400
+    try:
+        batch_size = min(int(request.args.get('batch_size', DEFAULT_BATCH_SIZE)), MAX_BATCH_SIZE)
+    except ValueError:
+        return jsonify({"error": "batch_size must be an integer"}), 400
+
+    if user_query:
+        # Bulk exports are batch work: interactive queries are served first.
+        admit_as(BATCH)
+        try:
+            query_data = generate_query_cached(user_query)
+        except Overloaded as e:
+            return jsonify({"error": "Server is busy, please retry shortly."}), 503, {"Retry-After": str(e.retry_after)}
+    else:
+        previous = query_states.get(session_id) if session_id else None
+        if previous is None:
+            return jsonify({"error": "Query parameter or an active session is required"}), 400
+        query_data = previous["query_data"]
+    if query_data is None:
+        return jsonify({"error": "AI failed to generate a valid query. See server logs."}), 500
+    collection_name = query_data.get("collection")
+    if collection_name not in COLLECTION_MAP:
         return jsonify({"error": f"Collection not valid: {collection_name}"}), 500
-    print(f"--- Executing pipeline on '{collection_name}' ---")
-    print(json.dumps(pipeline_to_execute, indent=2))
+
     try:
-        results = list(target_collection.aggregate(pipeline_to_execute))
-        final_results = convert_objectids(results)
-        return jsonify({
-            "query": user_query,
-            "pipeline": pipeline_to_execute,
-            "collection_queried": collection_name,
-            "results": final_results
-        })
+        cursor = open_cursor(query_data, batch_size)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    mimetype, extension, _ = FORMATS[fmt]
+    return Response(
+        stream_with_context(export_stream(cursor, collection_name, fmt, batch_size, query_data["pipeline"])),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{collection_name}-export.{extension}"'},
+    )
 
 if __name__ == '__main__':
+    # Development server only. For production use the pre-fork launcher:
+    #   gunicorn -c gunicorn.conf.py dperp1:app
     app.run(debug=True, port=5000)
@@ -0,0 +1,292 @@
+"""
+In-memory entity-resolution index over the small dimension collections.
+
+Generated pipelines often filter on a joined name, e.g.
+{"commodity_doc.commodity_name": {"$regex": "oil", "$options": "i"}}, which
+forces MongoDB to $lookup every trade and then run an unindexed regex. The
+dimension tables are tiny, so we evaluate such predicates here and rewrite
+them into {"commodity_id": {"$in": [...]}} placed at the front of the
+pipeline, where the indexed equality match runs before any $lookup.
+
+Equality on a name that does not exist, even ignoring case, falls back to
+the closest indexed name ("Indai" -> "India"). That answers for a
+different value than the one asked for, so every such substitution is
+reported to the caller, which shows it in the response.
+"""
+import re
+import json
+import bisect
+import difflib
+import threading
+
+# Dimension collections and the fields worth indexing for lookups/typeahead.
+DIMENSIONS = {
+    "countries": ["country_name", "country_code", "iso3"],
+    "commodities": ["commodity_name", "hs_code", "category"],
+    "years": ["year"],
+}
+# impexp has no dimension table: products are resolved to exact names.
+PRODUCT_FIELD = ("impexp", "product")
+# Fields whose values count as an entity mention in free text (codes like "IN" do not).
+NAME_FIELDS = {"country_name", "commodity_name", "year", "product"}
+MAX_MENTION_WORDS = 4
+
+# Stages that keep the original trade documents intact, so a $match after
+# them can be hoisted in front of the $lookups.
+ROW_PRESERVING_STAGES = {"$lookup", "$unwind", "$match"}
+
+REGEX_FLAGS = {"i": re.IGNORECASE, "m": re.MULTILINE, "s": re.DOTALL, "x": re.VERBOSE}
+FUZZY_CUTOFF = 0.8
+# Memoized predicate results; cleared on rebuild or when full.
+MATCH_CACHE_ENTRIES = 4096
+
+
+def _grams(text, n=3):
+    text = f"  {text.lower()} "
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class EntityIndex:
+    """
+    Holds every dimension row plus n-gram and prefix indexes over its
+    searchable fields. Rebuilt wholesale by refresh(); lookups are lock-free
+    reads of the current snapshot.
+    """
+
+    def __init__(self, db=None):
+        self.db = db
+        self.lock = threading.Lock()
+        self.entities = []      # [{"collection", "_id", "fields": {...}}]
+        self.values = {}        # (collection, field) -> {value: [entity index]}
+        self.grams = {}         # trigram -> set(entity index)
+        self.prefixes = []      # sorted [(lowered term, entity index)]
+        self.names = {}         # lowered name -> collection
+        self.matched = {}       # (collection, field, predicate JSON) -> (entities, substitutions)
+
+    # --- building ---
+    def refresh(self):
+        """Reloads the dimension rows and impexp products from MongoDB."""
+        rows = {}
+        for collection, fields in DIMENSIONS.items():
+            projection = {field: 1 for field in fields}
+            rows[collection] = list(self.db.get_collection(collection).find({}, projection))
+        collection, field = PRODUCT_FIELD
+        rows[collection] = [{"_id": None, field: product}
+                            for product in self.db.get_collection(collection).distinct(field)]
+        self.build(rows)
+
+    def build(self, rows):
+        """Builds the indexes from {collection: [documents]}."""
+        entities, values, grams, prefixes, names = [], {}, {}, [], {}
+        for collection, documents in rows.items():
+            fields = DIMENSIONS.get(collection, [PRODUCT_FIELD[1]])
+            for doc in documents:
+                index = len(entities)
+                entity = {"collection": collection, "_id": doc.get("_id"),
+                          "fields": {field: doc[field] for field in fields if doc.get(field) is not None}}
+                entities.append(entity)
+                for field, value in entity["fields"].items():
+                    values.setdefault((collection, field), {}).setdefault(value, []).append(index)
+                    term = str(value).lower()
+                    if field in NAME_FIELDS:
+                        names[term] = collection
+                    prefixes.append((term, index))
+                    for word in term.split()[1:]:
+                        prefixes.append((word, index))
+                    for gram in _grams(term):
+                        grams.setdefault(gram, set()).add(index)
+        prefixes.sort()
+        with self.lock:
+            self.entities, self.values, self.grams, self.prefixes = entities, values, grams, prefixes
+            self.names = names
+            self.matched = {}
+
+    # --- lookups ---
+    def prefix(self, text, limit=10):
+        """Entities with a field (or a word in it) starting with text."""
+        text = text.lower()
+        prefixes = self.prefixes
+        start = bisect.bisect_left(prefixes, (text, -1))
+        found = []
+        for term, index in prefixes[start:]:
+            if not term.startswith(text):
+                break
+            if index not in found:
+                found.append(index)
+                if len(found) >= limit:
+                    break
+        return [self.entities[index] for index in found]
+
+    def mentions(self, text):
+        """Known entity names appearing verbatim in text, as [(collection, name)]."""
+        words = re.findall(r"[\w&.-]+", text.lower())
+        names = self.names
+        found = []
+        for start in range(len(words)):
+            for size in range(min(MAX_MENTION_WORDS, len(words) - start), 0, -1):
+                phrase = " ".join(words[start:start + size])
+                if phrase in names:
+                    found.append((names[phrase], phrase))
+                    break
+        return found
+
+    def search(self, text, collection=None, limit=10):
+        """Prefix hits first, then trigram/fuzzy matches ranked by similarity."""
+        text = text.strip()
+        if not text:
+            return []
+        results = [e for e in self.prefix(text, limit * 2) if collection in (None, e["collection"])]
+        seen = {id(e) for e in results}
+        query_grams = _grams(text)
+        scores = {}
+        for gram in query_grams:
+            for index in self.grams.get(gram, ()):
+                scores[index] = scores.get(index, 0) + 1
+        ranked = []
+        for index, shared in scores.items():
+            entity = self.entities[index]
+            if collection not in (None, entity["collection"]) or id(entity) in seen:
+                continue
+            best = max(difflib.SequenceMatcher(None, text.lower(), str(v).lower()).ratio()
+                       for v in entity["fields"].values())
+            ranked.append((max(best, shared / len(query_grams)), entity))
+        ranked.sort(key=lambda pair: -pair[0])
+        results.extend(entity for score, entity in ranked if score >= FUZZY_CUTOFF)
+        return results[:limit]
+
+    def match(self, collection, field, predicate, substitutions=None):
+        """
+        Evaluates a $match predicate against one dimension field.
+        Returns the matching entities, or None if the predicate shape is not
+        one we can evaluate exactly (the caller then leaves it alone).
+        Fuzzy resolutions of missing names are appended to substitutions as
+        {"collection", "field", "requested", "resolved"}.
+        Results are memoized, so resolving a predicate early (while the
+        query is still streaming in) makes the later rewrite free.
+        """
+        key = (collection, field, json.dumps(predicate, sort_keys=True, default=str))
+        matched = self.matched
+        found = matched.get(key)
+        if found is None:
+            found = self._match(collection, field, predicate)
+            if len(matched) >= MATCH_CACHE_ENTRIES:
+                matched.clear()
+            matched[key] = found
+        entities, substituted = found
+        if substitutions is not None:
+            substitutions.extend(substituted)
+        return entities
+
+    def _match(self, collection, field, predicate):
+        table = self.values.get((collection, field))
+        if table is None:
+            return None, []
+        substituted = []
+
+        def equal(value):
+            keys = self._equal(table, value)
+            if keys and str(keys[0]).lower() != str(value).lower():
+                substituted.append({"collection": collection, "field": field,
+                                    "requested": value, "resolved": keys[0]})
+            return keys
+
+        if isinstance(predicate, dict):
+            if set(predicate) <= {"$regex", "$options"} and isinstance(predicate.get("$regex"), str):
+                flags = 0
+                for option in predicate.get("$options", ""):
+                    flags |= REGEX_FLAGS.get(option, 0)
+                try:
+                    pattern = re.compile(predicate["$regex"], flags)
+                except re.error:
+                    return None, []
+                keys = [value for value in table if pattern.search(str(value))]
+            elif set(predicate) == {"$eq"}:
+                keys = equal(predicate["$eq"])
+            elif set(predicate) == {"$in"} and isinstance(predicate["$in"], list):
+                keys = [key for item in predicate["$in"] for key in equal(item)]
+            else:
+                return None, []
+        elif isinstance(predicate, (str, int, float)):
+            keys = equal(predicate)
+        else:
+            return None, []
+        return [self.entities[index] for key in keys for index in table[key]], substituted
+
+    def _equal(self, table, value):
+        """The exact key, else the same name in another case, else the closest existing name."""
+        if value in table:
+            return [value]
+        lowered = {str(key).lower(): key for key in table}
+        if str(value).lower() in lowered:
+            return [lowered[str(value).lower()]]
+        # Fuzzy fallback for near-miss names ("Indai", "Crude oils"); reported by _match.
+        close = difflib.get_close_matches(str(value).lower(), list(lowered), n=1, cutoff=FUZZY_CUTOFF)
+        if close:
+            print(f"--- Entity index: {value!r} not found, resolved to {lowered[close[0]]!r}")
+            return [lowered[close[0]]]
+        return []
+
+    # --- pipeline rewriting ---
+    def rewrite_pipeline(self, collection, pipeline, substitutions=None):
+        """
+        Returns (pipeline, rewrites). Predicates on joined dimension fields
+        are turned into a leading {"<local>_id": {"$in": [...]}} match, and
+        impexp product regexes into exact {"product": {"$in": [...]}}.
+        Names resolved to a different existing name are appended to
+        substitutions (see match()).
+        """
+        if not self.entities:
+            return pipeline, []
+        if collection == PRODUCT_FIELD[0]:
+            return self._rewrite_products(pipeline, substitutions)
+
+        aliases = {}
+        hoisted = {}
+        rewrites = []
+        rewritten = []
+        for position, stage in enumerate(pipeline):
+            (name, body), = stage.items()
+            if name not in ROW_PRESERVING_STAGES:
+                rewritten.extend(pipeline[position:])
+                break
+            if name == "$lookup" and body.get("foreignField") == "_id" and body.get("from") in DIMENSIONS:
+                aliases[body["as"]] = (body["from"], body["localField"])
+            if name == "$match" and isinstance(body, dict):
+                remaining = {}
+                for key, predicate in body.items():
+                    alias, _, field = key.partition(".")
+                    entities = None
+                    if alias in aliases and field and "." not in field:
+                        dimension, local_field = aliases[alias]
+                        entities = self.match(dimension, field, predicate, substitutions)
+                    if entities is None:
+                        remaining[key] = predicate
+                        continue
+                    ids = [e["_id"] for e in entities]
+                    if local_field in hoisted:
+                        # Two predicates on the same dimension: intersect.
+                        ids = [i for i in hoisted[local_field] if i in ids]
+                    hoisted[local_field] = ids
+                    rewrites.append(f"{key} -> {local_field} $in {len(ids)} id(s)")
+                if not remaining:
+                    continue
+                stage = {"$match": remaining}
+            rewritten.append(stage)
+        if not hoisted:
+            return pipeline, []
+        leading = {"$match": {field: {"$in": ids} for field, ids in hoisted.items()}}
+        return [leading] + rewritten, rewrites
+
+    def _rewrite_products(self, pipeline, substitutions=None):
+        rewrites = []
+        rewritten = []
+        for stage in pipeline:
+            (name, body), = stage.items()
+            if name == "$match" and isinstance(body, dict) and isinstance(body.get("product"), dict):
+                entities = self.match(*PRODUCT_FIELD, body["product"], substitutions)
+                if entities is not None:
+                    products = [e["fields"]["product"] for e in entities]
+                    stage = {"$match": dict(body, product={"$in": products})}
+                    rewrites.append(f"product {body['product']} -> $in {products}")
+            rewritten.append(stage)
+        return rewritten, rewrites
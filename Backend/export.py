@@ -0,0 +1,261 @@
+"""
+Columnar bulk export of query results as CSV, Parquet or Arrow IPC.
+
+/api/trade/query materializes every row in a Python list and one JSON
+body, which does not scale to analyst-sized extracts. Here the aggregation
+cursor is consumed in fixed-size batches and each batch is encoded and
+yielded immediately, so memory stays bounded by the batch size no matter
+how many rows the pipeline produces.
+
+The column layout is fixed before the first row is written: nested
+documents (joined dimensions) are flattened to dotted names. Columns come
+from the first batch plus the fields the pipeline's output shape declares
+(pipeline_validator.output_shape), so a column empty in the first batch is
+still there. Types come from the sampled values, falling back to the
+declared collection schema. When the shape has computed fields that could
+turn up later under new names, an EXTRA_COLUMN holds any such fields as a
+JSON object, so no value is dropped. A value that does not fit its column
+type stops the export with ExportError rather than being written as null.
+pyarrow is only needed for Parquet and Arrow.
+"""
+import io
+import csv
+import json
+import itertools
+from datetime import datetime
+from bson import ObjectId
+from pipeline_validator import COLLECTION_SCHEMAS, output_shape
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+DEFAULT_BATCH_SIZE = 10000
+MAX_BATCH_SIZE = 100000
+# Fields outside the planned columns, as JSON, for pipelines with an open-ended shape.
+EXTRA_COLUMN = "_extra"
+
+# format -> (mimetype, file extension, needs pyarrow)
+FORMATS = {
+    "csv": ("text/csv", "csv", False),
+    "parquet": ("application/vnd.apache.parquet", "parquet", True),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows", True),
+}
+
+
+class ExportError(ValueError):
+    """A row that cannot be written without losing data."""
+
+
+def available_formats():
+    return [name for name, (_, _, needs_arrow) in FORMATS.items() if pa is not None or not needs_arrow]
+
+
+# --- Rows and schema ---
+def flatten(doc, prefix=""):
+    """{"country": {"name": "India"}} -> {"country.name": "India"}; lists become JSON text."""
+    flat = {}
+    for key, value in doc.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, list):
+            flat[name] = json.dumps(value, default=str)
+        elif isinstance(value, ObjectId):
+            flat[name] = str(value)
+        else:
+            flat[name] = value
+    return flat
+
+
+def _value_kind(value):
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    if isinstance(value, datetime):
+        return "date"
+    return "string"
+
+
+DECLARED_KINDS = {"objectId": "string", "string": "string", "number": "float", "date": "date"}
+
+
+def infer_columns(collection, rows):
+    """Returns [(column, kind)] for a batch of flattened rows, in first-seen order."""
+    declared = COLLECTION_SCHEMAS.get(collection, {})
+    kinds = {}
+    for row in rows:
+        for column, value in row.items():
+            seen = kinds.setdefault(column, set())
+            if value is not None:
+                seen.add(_value_kind(value))
+    columns = []
+    for column, seen in kinds.items():
+        if not seen:
+            kind = DECLARED_KINDS.get(declared.get(column), "string")
+        elif seen <= {"int"}:
+            kind = "float" if declared.get(column) == "number" else "int"
+        elif seen <= {"int", "float"}:
+            kind = "float"
+        elif len(seen) == 1:
+            kind = next(iter(seen))
+        else:
+            kind = "string"
+        columns.append((column, kind))
+    return columns
+
+
+def plan_columns(collection, pipeline, batch):
+    """
+    ([(column, kind)], open_ended) for the whole export. open_ended means
+    rows may carry fields outside the columns (they go to EXTRA_COLUMN).
+    """
+    columns = infer_columns(collection, batch)
+    names = {column for column, _ in columns}
+    shape = output_shape(collection, pipeline) if pipeline is not None else None
+    if shape is None:
+        return columns, True
+    open_ended = False
+
+    def walk(node, prefix):
+        nonlocal open_ended
+        for key, value in node.items():
+            name = f"{prefix}{key}"
+            if name in names:
+                continue   # as sampled (a joined array is one JSON column)
+            if isinstance(value, dict):
+                walk(value, f"{name}.")
+            elif value is None:
+                # Computed and not sampled: a scalar, or a document with unknown fields.
+                open_ended = True
+            else:
+                columns.append((name, DECLARED_KINDS.get(value, "string")))
+
+    walk(shape, "")
+    return columns, open_ended
+
+
+def _coerce(value, kind, column):
+    """Fits a value from a later batch into the column type fixed by the first one."""
+    if value is None:
+        return None
+    if kind == "string":
+        return value if isinstance(value, str) else str(value)
+    number = isinstance(value, (int, float)) and not isinstance(value, bool)
+    if kind == "float" and number:
+        return float(value)
+    if kind == "int" and number and float(value).is_integer():
+        return int(value)
+    if kind == "bool" and isinstance(value, bool):
+        return value
+    if kind == "date" and isinstance(value, datetime):
+        return value
+    raise ExportError(f"column '{column}' is {kind}, but a later row has {value!r}; "
+                      f"export as CSV or cast the field in the pipeline")
+
+
+def _extra(row, names):
+    extra = {key: value for key, value in row.items() if key not in names}
+    return json.dumps(extra, default=str) if extra else None
+
+
+def arrow_schema(columns):
+    types = {"string": pa.string(), "int": pa.int64(), "float": pa.float64(),
+             "bool": pa.bool_(), "date": pa.timestamp("ms")}
+    return pa.schema([(column, types[kind]) for column, kind in columns])
+
+
+# --- Writers ---
+class _Sink(io.RawIOBase):
+    """Write-only file object whose contents are drained after every batch."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def _batches(cursor, batch_size):
+    while True:
+        batch = [flatten(doc) for doc in itertools.islice(cursor, batch_size)]
+        if not batch:
+            return
+        yield batch
+
+
+def export_stream(cursor, collection, fmt, batch_size=DEFAULT_BATCH_SIZE, pipeline=None):
+    """
+    Generator of encoded bytes for a Flask streaming response. pipeline (the
+    validated one the cursor runs) plans the columns. The cursor is closed
+    when the export finishes or the client disconnects.
+    """
+    if FORMATS[fmt][2] and pa is None:
+        raise RuntimeError(f"Export format '{fmt}' requires pyarrow")
+    sink = _Sink()
+    writer = None
+    columns = None
+    rows_written = 0
+    try:
+        for batch in _batches(cursor, batch_size):
+            if columns is None:
+                columns, open_ended = plan_columns(collection, pipeline, batch)
+                names = [column for column, _ in columns]
+                known = set(names)
+                header = names + ([EXTRA_COLUMN] if open_ended else [])
+                if fmt == "csv":
+                    writer = csv.writer(io.TextIOWrapper(sink, encoding="utf-8", newline="", write_through=True))
+                    writer.writerow(header)
+                else:
+                    schema = arrow_schema(columns + ([(EXTRA_COLUMN, "string")] if open_ended else []))
+                    if fmt == "parquet":
+                        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+                    else:
+                        writer = pa.ipc.new_stream(sink, schema)
+            if not open_ended:
+                unplanned = {key for row in batch for key in row} - known
+                if unplanned:
+                    raise ExportError(f"columns {sorted(unplanned)} are not in the pipeline's output shape")
+            if fmt == "csv":
+                writer.writerows([[row.get(column) for column in names] + ([_extra(row, known)] if open_ended else [])
+                                  for row in batch])
+            else:
+                arrays = [pa.array([_coerce(row.get(column), kind, column) for row in batch], type=schema.field(column).type)
+                          for column, kind in columns]
+                if open_ended:
+                    arrays.append(pa.array([_extra(row, known) for row in batch], type=pa.string()))
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            rows_written += len(batch)
+            yield sink.drain()
+        if columns is None and fmt != "csv":
+            # No rows: still emit a valid (empty) file.
+            writer = pq.ParquetWriter(sink, pa.schema([])) if fmt == "parquet" else pa.ipc.new_stream(sink, pa.schema([]))
+        if fmt != "csv" and writer is not None:
+            writer.close()
+        yield sink.drain()
+        print(f"--- Export finished: {rows_written} rows as {fmt}")
+    except ExportError as e:
+        print(f"--- Export stopped after {rows_written} rows: {e}")
+        raise
+    finally:
+        cursor.close()
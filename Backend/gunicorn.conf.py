@@ -0,0 +1,69 @@
+"""
+Production launcher config for the query API (pre-fork, multi-worker).
+
+    gunicorn -c gunicorn.conf.py dperp1:app
+
+The app is imported once in the master (preload_app), so the schema
+summary, entity index and compiled prompt are built before fork and shared
+copy-on-write by every worker. Each worker then opens its own MongoClient
+(see dperp1.reset_after_fork).
+
+Signals:
+    HUP   recycle all workers with the already-loaded code (graceful)
+    USR2  start a new master with new code; then QUIT the old one (deploys)
+    TTIN / TTOU  add / remove a worker
+"""
+import gc
+import os
+import multiprocessing
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+# Requests spend most of their time waiting on the LLM and MongoDB, so a few
+# processes with several threads each beat one thread per process.
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() + 1))
+# The LLM admission limits are split between the workers (admission.py).
+os.environ["WEB_CONCURRENCY"] = str(workers)
+# Tells dperp1 it is being imported by the pre-fork master, which must not
+# start the cache warmer: each worker warms its own caches (post_fork).
+os.environ["PREFORK_MASTER"] = "1"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+worker_class = "gthread"
+preload_app = True
+
+# LLM generation can take tens of seconds.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers periodically to bound memory growth; jitter avoids all
+# workers restarting at once.
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = 200
+# How long the master waits for each background thread to finish before forking.
+STOP_TIMEOUT_SECONDS = 10
+
+
+def when_ready(server):
+    import dperp1
+
+    # Build the prompt for the current schema before fork, then move every
+    # object created so far out of the GC's reach so collections in the
+    # workers do not touch (and un-share) the inherited pages.
+    dperp1.compiled_prompt()
+    # The master serves nothing. Its background threads (schema refresh,
+    # data-version watch, suggestion refresh) are stopped and joined so none
+    # is inside pymongo or holding a lock at fork time, and its MongoClient
+    # is closed. post_fork starts them, and the cache warmer, in each worker.
+    for service in (dperp1.schema_cache, dperp1.data_versions, dperp1.warmer, dperp1.suggest_index):
+        if not service.stop(timeout=STOP_TIMEOUT_SECONDS):
+            server.log.warning("%s thread still running after %ss; forking anyway",
+                               type(service).__name__, STOP_TIMEOUT_SECONDS)
+    dperp1.client.close()
+    gc.freeze()
+    server.log.info("Warm caches ready (schema %s); forking workers", (dperp1.schema_cache.content_hash or "")[:12])
+
+
+def post_fork(server, worker):
+    import dperp1
+
+    dperp1.reset_after_fork()
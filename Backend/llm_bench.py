@@ -0,0 +1,111 @@
+"""
+Benchmark query generation per provider: latency, throughput and how many
+answers pass validation, through the same LLMClient policy the server uses.
+
+    python llm_bench.py ollama:llama3 openai:gpt-4o-mini -n 40 -c 4
+    python ollama_standin.py &   # fully offline
+    python llm_bench.py ollama:llama3 fake -n 40 -c 8 --json
+
+Prompts are built from prompts.SCHEMA_PROMPT_TEMPLATE with the cached
+schema summary (schema_introspect falls back to the declared schemas), so
+no database is needed. Questions cycle through the prompt's examples and
+BENCH_QUESTIONS. For Ollama providers the report also includes what the
+local server did: connections opened and reused, batches and slot wait.
+"""
+import sys
+import json
+import time
+import argparse
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from llm_providers import LLMClient, providers_from_spec
+from pipeline_validator import validate_and_repair
+from prompts import SCHEMA_PROMPT_TEMPLATE, prompt_examples
+from schema_introspect import SchemaCache
+from loadtest import percentile
+
+BENCH_QUESTIONS = [
+    "imports from china in 2023",
+    "top 5 ports by export value",
+    "total value of exports by commodity",
+    "monthly export of LPG",
+    "how many trades per country",
+]
+
+
+def run(spec, prompt, questions, requests, concurrency, schemas):
+    client = LLMClient(providers_from_spec(spec), hedge=False)
+    latencies, valid, errors, tokens = [], 0, [], 0
+
+    def one(question):
+        started = time.perf_counter()
+        try:
+            text, completion = client.complete(prompt + f'"{question}"\n')
+            validate_and_repair(text, schemas)
+            return time.perf_counter() - started, True, completion.tokens or 0, None
+        except Exception as e:
+            return time.perf_counter() - started, False, 0, f"{type(e).__name__}: {e}"
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for seconds, ok, used, error in pool.map(one, itertools.islice(itertools.cycle(questions), requests)):
+            latencies.append(seconds)
+            valid += ok
+            tokens += used
+            if error:
+                errors.append(error)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    report = {
+        "provider": spec,
+        "requests": requests,
+        "concurrency": concurrency,
+        "valid": valid,
+        "errors": len(errors),
+        "seconds": round(elapsed, 2),
+        "throughput_rps": round(requests / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "max_ms": round(latencies[-1] * 1000, 1) if latencies else 0.0,
+        "tokens": tokens,
+    }
+    if errors:
+        report["first_error"] = errors[0]
+    servers = client.snapshot()["servers"]
+    if servers:
+        report["server"] = next(iter(servers.values()))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark LLM providers on the query-generation prompt")
+    parser.add_argument("providers", nargs="+", help="provider specs, e.g. ollama:llama3 openai:gpt-4o-mini fake")
+    parser.add_argument("-n", "--requests", type=int, default=20)
+    parser.add_argument("-c", "--concurrency", type=int, default=4)
+    parser.add_argument("--warmup", type=int, default=1, help="untimed calls per provider first (model load)")
+    parser.add_argument("--json", action="store_true", help="also print the reports as JSON")
+    args = parser.parse_args()
+
+    schema = SchemaCache(None)
+    prompt = SCHEMA_PROMPT_TEMPLATE.format(schema_summary=schema.summary)
+    questions = [question for question, _ in prompt_examples()] + BENCH_QUESTIONS
+    reports = []
+    for spec in args.providers:
+        if args.warmup:
+            run(spec, prompt, questions, args.warmup, 1, schema.schemas)
+        report = run(spec, prompt, questions, args.requests, args.concurrency, schema.schemas)
+        reports.append(report)
+        print(f"{spec:28} {report['valid']:>4}/{report['requests']} valid  {report['errors']:>3} errors  "
+              f"{report['throughput_rps']:>7.2f} req/s  p50 {report['p50_ms']:>8.1f} ms  "
+              f"p95 {report['p95_ms']:>8.1f} ms  max {report['max_ms']:>8.1f} ms", file=sys.stderr)
+        if "server" in report:
+            server = report["server"]
+            print(f"{'':28} connections {server['connections']}  requests {server['requests']} for "
+                  f"{server['calls']} calls  batches {server['batches']}  "
+                  f"slot wait {server['slot_wait_seconds']}s", file=sys.stderr)
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,548 @@
+"""
+One provider interface for query generation: OpenAI, Gemini and Ollama.
+
+Each server file used to call its own model with its own client and no
+timeout or retry policy. Providers here share a single complete(prompt,
+timeout) call, and LLMClient adds the policy on top:
+
+- a deadline for the whole call, split into per-attempt timeouts;
+- retries with full-jitter exponential backoff, for transient errors only
+  (timeouts, connection errors, 429 and 5xx);
+- optional hedging: if the primary has not answered after its observed
+  p95 latency, the same prompt goes to the next provider and the first
+  answer that parses/validates wins. The loser is cancelled at once: a
+  queued or streaming attempt stops, and its admission slot is freed even
+  when a non-streamed request cannot be interrupted;
+- latency and error stats per provider, for routing decisions;
+- optional streaming: complete(..., stream=factory) hands every chunk of
+  the answer to an on_chunk callback as it arrives, which may raise to
+  abort a generation that has already gone wrong.
+
+OllamaProvider runs a local model offline (local_model.py batches its calls);
+FakeProvider stands in for a real model in tests and local runs;
+ReplayProvider answers from a traffic capture (capture.py) for load tests.
+"""
+import os
+import json
+import time
+import random
+import threading
+import contextvars
+import urllib.error
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+import capture
+from admission import Cancelled, estimate_tokens
+from local_model import OllamaServer, OLLAMA_URL, OLLAMA_PRELOAD, split_prompt
+
+DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", 30))
+RETRIES = int(os.getenv("LLM_RETRIES", 2))
+BACKOFF_SECONDS = 0.5
+# Hedge after this long until a provider has enough samples for a real p95.
+HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", 8))
+MIN_SAMPLES_FOR_P95 = 20
+STATS_WINDOW = 200
+# Characters per chunk when the local providers imitate a token stream.
+FAKE_CHUNK_CHARS = 16
+
+
+class ProviderError(Exception):
+    pass
+
+
+class DeadlineExceeded(ProviderError):
+    pass
+
+
+class Completion:
+    def __init__(self, text, provider, latency, tokens=None):
+        self.text = text
+        self.provider = provider
+        self.latency = latency
+        self.tokens = tokens
+
+
+def is_retryable(error):
+    """Transient failures worth another attempt; bad requests and auth errors are not."""
+    if isinstance(error, (DeadlineExceeded, TimeoutError, ConnectionError, urllib.error.URLError)):
+        return True
+    name = type(error).__name__
+    if "Timeout" in name or "Connection" in name:
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    return isinstance(status, int) and (status == 429 or status >= 500)
+
+
+# --- Providers ---
+class Provider:
+    """
+    complete(prompt, timeout, on_chunk=None) -> Completion; budget_key names
+    its admission budget. With on_chunk the answer is streamed: on_chunk(text)
+    gets each piece as it arrives, and an exception from it closes the stream.
+    """
+    kind = "base"
+
+    def __init__(self, model):
+        self.model = model
+        self.name = f"{self.kind}:{model}"
+        self.budget_key = self.kind
+
+    def complete(self, prompt, timeout, on_chunk=None):
+        raise NotImplementedError
+
+
+def _emit(text, latency, on_chunk):
+    """Waits latency; with on_chunk, spreads it over pieces of text like a token stream."""
+    if on_chunk is None:
+        time.sleep(latency)
+        return
+    pieces = [text[i:i + FAKE_CHUNK_CHARS] for i in range(0, len(text), FAKE_CHUNK_CHARS)] or [""]
+    for piece in pieces:
+        time.sleep(latency / len(pieces))
+        on_chunk(piece)
+
+
+class OpenAIProvider(Provider):
+    kind = "openai"
+
+    def __init__(self, model="gpt-4o", api_key=None):
+        super().__init__(model)
+        from openai import OpenAI
+        # Retries are ours (jittered, deadline-aware), not the SDK's.
+        self.client = OpenAI(api_key=api_key or os.getenv("OPENAI_API_KEY"), max_retries=0)
+
+    def complete(self, prompt, timeout, on_chunk=None):
+        started = time.perf_counter()
+        request = dict(
+            model=self.model,
+            messages=[{"role": "system", "content": prompt}],
+            response_format={"type": "json_object"},
+            temperature=0.0,
+            timeout=timeout,
+        )
+        if on_chunk is None:
+            completion = self.client.chat.completions.create(**request)
+            tokens = completion.usage.total_tokens if completion.usage is not None else None
+            return Completion(completion.choices[0].message.content, self.name,
+                              time.perf_counter() - started, tokens)
+        parts, tokens = [], None
+        stream = self.client.chat.completions.create(**request, stream=True, stream_options={"include_usage": True})
+        # Leaving the block early (on_chunk raised) closes the connection and stops generation.
+        with stream:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    tokens = chunk.usage.total_tokens
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    on_chunk(delta)
+        return Completion("".join(parts), self.name, time.perf_counter() - started, tokens)
+
+
+class GeminiProvider(Provider):
+    kind = "gemini"
+
+    def __init__(self, model="gemini-2.5-flash"):
+        super().__init__(model)
+        from google import genai
+        self.genai = genai
+        self.client = genai.Client()
+
+    def complete(self, prompt, timeout, on_chunk=None):
+        started = time.perf_counter()
+        types = self.genai.types
+        request = dict(
+            model=self.model,
+            contents=prompt,
+            config=types.GenerateContentConfig(
+                temperature=0.0,
+                response_mime_type="application/json",
+                http_options=types.HttpOptions(timeout=int(timeout * 1000)),
+            ),
+        )
+        if on_chunk is None:
+            response = self.client.models.generate_content(**request)
+            usage = getattr(response, "usage_metadata", None)
+            tokens = getattr(usage, "total_token_count", None) if usage is not None else None
+            return Completion(response.text, self.name, time.perf_counter() - started, tokens)
+        parts, tokens = [], None
+        stream = self.client.models.generate_content_stream(**request)
+        try:
+            for response in stream:
+                usage = getattr(response, "usage_metadata", None)
+                tokens = getattr(usage, "total_token_count", None) or tokens
+                if response.text:
+                    parts.append(response.text)
+                    on_chunk(response.text)
+        finally:
+            close = getattr(stream, "close", None)
+            if close is not None:
+                close()
+        return Completion("".join(parts), self.name, time.perf_counter() - started, tokens)
+
+
+class OllamaProvider(Provider):
+    """
+    A local model behind Ollama. Providers for the same server share one
+    local_model.OllamaServer (keep-alive connections, concurrency limit,
+    micro-batching); the model is preloaded and kept resident.
+    """
+    kind = "ollama"
+
+    def __init__(self, model="llama3", url=None):
+        super().__init__(model)
+        self.server = OllamaServer.shared(url or OLLAMA_URL)
+        if OLLAMA_PRELOAD:
+            self.server.preload(model)
+
+    def complete(self, prompt, timeout, on_chunk=None):
+        started = time.perf_counter()
+        text, tokens = self.server.generate(self.model, prompt, timeout, on_chunk)
+        return Completion(text, self.name, time.perf_counter() - started, tokens or None)
+
+    def snapshot(self):
+        return self.server.snapshot()
+
+
+class FakeProvider(Provider):
+    """
+    Local stand-in: answers with responder(prompt) (a fixed string or a
+    callable) after `latency` seconds; the first `failures` calls raise a
+    retryable error.
+    """
+    kind = "fake"
+
+    def __init__(self, model="fake", responder='{"collection": "countries", "pipeline": [{"$limit": 5}]}',
+                 latency=0.05, failures=0):
+        super().__init__(model)
+        self.responder = responder
+        self.latency = latency
+        self.failures = failures
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def complete(self, prompt, timeout, on_chunk=None):
+        with self.lock:
+            self.calls += 1
+            fail = self.calls <= self.failures
+        started = time.perf_counter()
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency > timeout:
+            time.sleep(timeout)
+            raise DeadlineExceeded(f"{self.name} timed out after {timeout:.2f}s")
+        if fail:
+            time.sleep(latency)
+            raise ConnectionError(f"{self.name} simulated failure")
+        text = self.responder(prompt) if callable(self.responder) else self.responder
+        _emit(text, latency, on_chunk)
+        return Completion(text, self.name, time.perf_counter() - started, len(prompt) // 4 + len(text) // 4)
+
+
+class ReplayProvider(Provider):
+    """
+    Answers from a capture file: the completions recorded for the same
+    prompt in turn (a small-tier answer, then the escalated one), else one
+    recorded for exactly the question the prompt asks, after the recorded
+    latency (LLM_REPLAY_LATENCY=0 answers at once).
+    """
+    kind = "replay"
+
+    def __init__(self, model=None):
+        super().__init__(model or os.getenv("LLM_REPLAY_PATH") or capture.CAPTURE_PATH)
+        _, completions = capture.load(self.model)
+        self.by_prompt = {}
+        self.by_query = {}
+        for record in completions:
+            self.by_prompt.setdefault(record["prompt_sha"], []).append(record)
+            if record.get("query"):
+                self.by_query.setdefault(self._normalize(record["query"]), record)
+        self.replay_latency = os.getenv("LLM_REPLAY_LATENCY", "1") != "0"
+        self.turns = {}
+        self.lock = threading.Lock()
+        self.stats = {"by_prompt": 0, "by_query": 0, "missing": 0}
+        print(f"--- Replaying {len(completions)} recorded completion(s) from {self.model}")
+
+    @staticmethod
+    def _normalize(question):
+        return " ".join(question.strip().strip('"').lower().split())
+
+    @classmethod
+    def question(cls, prompt):
+        """
+        The question a generation prompt asks: its last line, quoted. Only that
+        line is matched; the prompt's examples contain other questions.
+        """
+        return cls._normalize(split_prompt(prompt)[1])
+
+    def complete(self, prompt, timeout, on_chunk=None):
+        started = time.perf_counter()
+        key = capture.prompt_sha(prompt)
+        recorded = self.by_prompt.get(key)
+        if recorded:
+            with self.lock:
+                turn = self.turns.get(key, 0)
+                self.turns[key] = turn + 1
+                self.stats["by_prompt"] += 1
+            record = recorded[turn % len(recorded)]
+        else:
+            record = self.by_query.get(self.question(prompt))
+            if record is None:
+                self.stats["missing"] += 1
+                raise ProviderError(f"{self.name}: no recorded completion for this prompt")
+            self.stats["by_query"] += 1
+        latency = record["latency"] if self.replay_latency else 0.0
+        if latency > timeout:
+            time.sleep(timeout)
+            raise DeadlineExceeded(f"{self.name} timed out after {timeout:.2f}s")
+        text = record["text"]
+        _emit(text, latency, on_chunk)
+        return Completion(text, self.name, time.perf_counter() - started, len(prompt) // 4 + len(text) // 4)
+
+
+PROVIDER_CLASSES = {cls.kind: cls for cls in (OpenAIProvider, GeminiProvider, OllamaProvider, FakeProvider,
+                                              ReplayProvider)}
+
+
+def providers_from_spec(spec):
+    """'openai:gpt-4o,gemini:gemini-2.5-flash' -> [OpenAIProvider, GeminiProvider]."""
+    providers = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        kind, _, model = item.partition(":")
+        cls = PROVIDER_CLASSES.get(kind)
+        if cls is None:
+            raise ValueError(f"Unknown LLM provider '{kind}' (known: {sorted(PROVIDER_CLASSES)})")
+        providers.append(cls(model) if model else cls())
+    return providers
+
+
+# --- Stats ---
+class LatencyStats:
+    """Rolling latency window and error count for one provider."""
+
+    def __init__(self, window=STATS_WINDOW):
+        self.latencies = deque(maxlen=window)
+        self.calls = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency=None, error=False):
+        with self.lock:
+            self.calls += 1
+            if error:
+                self.errors += 1
+            else:
+                self.latencies.append(latency)
+
+    def percentile(self, fraction):
+        with self.lock:
+            ordered = sorted(self.latencies)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def snapshot(self):
+        p50, p95 = self.percentile(0.5), self.percentile(0.95)
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "p50_ms": round(p50 * 1000) if p50 is not None else None,
+            "p95_ms": round(p95 * 1000) if p95 is not None else None,
+        }
+
+
+# --- Policy ---
+class _Race:
+    """The attempts of one hedged call; cancel() stops the losers once a winner returns."""
+
+    def __init__(self, admission):
+        self.admission = admission
+        self.cancelled = threading.Event()
+        self.lock = threading.Lock()
+        self.slots = set()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise Cancelled("another provider answered first")
+
+    def hold(self, slot):
+        with self.lock:
+            self.slots.add(slot)
+        if self.cancelled.is_set():
+            slot.release()
+
+    def drop(self, slot):
+        with self.lock:
+            self.slots.discard(slot)
+
+    def guard(self, on_chunk):
+        """Wraps a streaming callback so a cancelled attempt aborts at its next chunk."""
+        if on_chunk is None:
+            return None
+
+        def checked(text):
+            self.check()
+            on_chunk(text)
+        return checked
+
+    def cancel(self):
+        self.cancelled.set()
+        with self.lock:
+            slots = list(self.slots)
+        for slot in slots:
+            slot.release()
+        if self.admission is not None:
+            self.admission.wake()   # queued attempts leave the queue
+
+
+class LLMClient:
+    """
+    Deadline, retry and hedging policy over an ordered list of providers.
+    providers[0] is the primary; providers[1] is the hedge target.
+    """
+
+    def __init__(self, providers, admission=None, deadline=DEADLINE_SECONDS, retries=RETRIES, hedge=True):
+        if not providers:
+            raise ValueError("LLMClient needs at least one provider")
+        self.providers = providers
+        self.admission = admission
+        self.deadline = deadline
+        self.retries = retries
+        self.hedge = hedge and len(providers) > 1
+        self.stats = {provider.name: LatencyStats() for provider in providers}
+        self.hedges = {"fired": 0, "won": 0}
+        # listener(prompt, completion) for every answered call, e.g. traffic capture.
+        self.listeners = []
+        self.pool = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm")
+
+    def hedge_after(self, provider):
+        stats = self.stats[provider.name]
+        if len(stats.latencies) < MIN_SAMPLES_FOR_P95:
+            return HEDGE_AFTER_SECONDS
+        return stats.percentile(0.95)
+
+    def _call(self, provider, prompt, deadline, stream=None, race=None):
+        """
+        One provider with retries; returns a Completion or raises the last
+        error. A cancelled race raises Cancelled instead of retrying.
+        """
+        attempt = 0
+        while True:
+            if race is not None:
+                race.check()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise DeadlineExceeded(f"{provider.name}: deadline exceeded")
+            # Each attempt streams into a fresh callback (and parser state).
+            on_chunk = stream() if stream is not None else None
+            if race is not None:
+                on_chunk = race.guard(on_chunk)
+            try:
+                if self.admission is not None:
+                    cancelled = race.cancelled if race is not None else None
+                    with self.admission.slot(provider.budget_key, estimate_tokens(prompt),
+                                             cancelled=cancelled, deadline=deadline) as slot:
+                        if race is not None:
+                            race.hold(slot)
+                        # The queue wait came out of the deadline.
+                        remaining = deadline - time.monotonic()
+                        try:
+                            if remaining <= 0:
+                                raise DeadlineExceeded(f"{provider.name}: deadline exceeded in the admission queue")
+                            completion = provider.complete(prompt, remaining, on_chunk)
+                        finally:
+                            if race is not None:
+                                race.drop(slot)
+                        if completion.tokens is not None:
+                            slot.used(completion.tokens)
+                else:
+                    completion = provider.complete(prompt, remaining, on_chunk)
+            except Exception as e:
+                if race is not None and race.cancelled.is_set():
+                    # Lost the race: not the provider's fault.
+                    raise Cancelled(f"{provider.name}: cancelled") from e
+                self.stats[provider.name].record(error=True)
+                if attempt >= self.retries or not is_retryable(e):
+                    raise
+                # Full jitter: spreads retries of a burst instead of synchronizing them.
+                backoff = random.uniform(0, BACKOFF_SECONDS * 2 ** attempt)
+                attempt += 1
+                print(f"--- {provider.name} failed ({e}); retry {attempt} in {backoff:.2f}s")
+                time.sleep(min(backoff, max(0.0, deadline - time.monotonic())))
+                continue
+            self.stats[provider.name].record(completion.latency)
+            # Every raw answer, including ones that later fail validation.
+            self._notify(prompt, completion)
+            return completion
+
+    def _notify(self, prompt, completion):
+        for listener in self.listeners:
+            try:
+                listener(prompt, completion)
+            except Exception as e:
+                print(f"--- LLM listener failed: {e}")
+
+    def _attempt(self, provider, prompt, deadline, parse, stream, race=None):
+        completion = self._call(provider, prompt, deadline, stream, race)
+        return (parse(completion.text) if parse else completion.text), completion
+
+    def complete(self, prompt, parse=None, stream=None):
+        """
+        Returns (value, completion). value is parse(text) when parse is given;
+        a parse error counts as a failed answer, so a hedged call can still win.
+        stream, if given, is called once per attempt and returns the
+        on_chunk callback for that attempt's streamed answer.
+        """
+        deadline = time.monotonic() + self.deadline
+        primary = self.providers[0]
+        if not self.hedge:
+            return self._attempt(primary, prompt, deadline, parse, stream)
+
+        # Attempts run on pool threads with a copy of the caller's context (admission class, capture tags).
+        race = _Race(self.admission)
+        futures = [self.pool.submit(contextvars.copy_context().run, self._attempt,
+                                    primary, prompt, deadline, parse, stream, race)]
+        done, _ = wait_futures(futures, timeout=self.hedge_after(primary))
+        if not done or futures[0].exception() is not None:
+            # Slower than its p95, or already failed: the second provider gets the same prompt.
+            self.hedges["fired"] += 1
+            print(f"--- {primary.name} {'failed' if done else 'slower than its p95'}, hedging to {self.providers[1].name}")
+            futures.append(self.pool.submit(contextvars.copy_context().run, self._attempt,
+                                            self.providers[1], prompt, deadline, parse, stream, race))
+        try:
+            return self._first(futures, deadline)
+        finally:
+            # Whether one answered or none did in time, the others stop here.
+            race.cancel()
+
+    def _first(self, futures, deadline):
+        """The first successful (value, completion); the primary's error otherwise."""
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait_futures(pending, timeout=max(0.0, deadline - time.monotonic()),
+                                         return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                try:
+                    value, completion = future.result()
+                except Exception as e:
+                    # The primary's error is the one worth reporting.
+                    error = e if future is futures[0] else error or e
+                    continue
+                if future is not futures[0]:
+                    self.hedges["won"] += 1
+                return value, completion
+        raise error or DeadlineExceeded("all providers exceeded the deadline")
+
+    def snapshot(self):
+        return {
+            "providers": {name: stats.snapshot() for name, stats in self.stats.items()},
+            "hedges": dict(self.hedges),
+            # Local servers (batching, connection reuse) for providers that report them.
+            "servers": {provider.name: provider.snapshot() for provider in self.providers
+                        if hasattr(provider, "snapshot")},
+        }
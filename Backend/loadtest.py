@@ -0,0 +1,217 @@
+"""
+Load generator for the query API: closed-loop for comparing server modes,
+open-loop replay of captured traffic for sizing deployments.
+
+    python loadtest.py http://localhost:5000/api/health -n 2000 -c 32
+    python loadtest.py "http://localhost:5000/api/trade/query?query=exports%20from%20india" -n 200 -c 16
+
+Run it once against the dev server (python dperp1.py) and once against the
+pre-fork launcher (gunicorn -c gunicorn.conf.py dperp1:app) with the same
+arguments to compare throughput and tail latency.
+
+Replay a capture (CAPTURE_PATH, see capture.py) against a server started
+with LLM_PROVIDERS=replay:<capture> so no real model is called:
+
+    python loadtest.py http://localhost:5000 --replay capture.jsonl            # recorded timing
+    python loadtest.py http://localhost:5000 --replay capture.jsonl --speed 4  # 4x faster
+    python loadtest.py http://localhost:5000 --replay capture.jsonl --rate 20  # 20 req/s open loop
+    python loadtest.py http://localhost:5000 --replay capture.jsonl --ramp 5:60:5 --step-seconds 30
+
+Open loop: requests start on schedule whether or not earlier ones have
+finished, and latency is measured from the scheduled start, so a server
+that falls behind shows it in the percentiles. --ramp steps the arrival
+rate and reports the first step where the server saturates.
+"""
+import sys
+import json
+import time
+import argparse
+import itertools
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from capture import load as load_capture
+
+# A ramp step is saturated when p95 grows past this multiple of the first
+# step's, errors exceed this rate, or throughput falls below this share of offered.
+SATURATION_P95_FACTOR = 3.0
+SATURATION_ERROR_RATE = 0.01
+SATURATION_THROUGHPUT_SHARE = 0.9
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def fetch(url, timeout):
+    started = time.perf_counter()
+    status = fetch_status(url, timeout)
+    return status is not None and status < 500, time.perf_counter() - started
+
+
+def fetch_status(url, timeout):
+    """HTTP status of a GET, or None when no response arrived."""
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+    except Exception:
+        return None
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "throughput_rps": round(total / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "max_ms": round((latencies[-1] if latencies else 0) * 1000, 1),
+    }
+
+
+# --- Replay ---
+def replay_url(base_url, record):
+    params = {"query": record["query"]}
+    if record.get("session"):
+        params["session"] = record["session"]
+    return f"{base_url.rstrip('/')}/api/trade/query?{urllib.parse.urlencode(params)}"
+
+
+def schedule(records, speed=None, rate=None, duration=None):
+    """[(offset seconds, record)]: recorded gaps scaled by speed, or a fixed rate cycling the records."""
+    if rate:
+        count = int(rate * duration) if duration else len(records)
+        return [(i / rate, record) for i, record in zip(range(count), itertools.cycle(records))]
+    first = records[0]["t"]
+    return [((record["t"] - first) / (speed or 1.0), record) for record in records]
+
+
+def run_open_loop(base_url, planned, timeout, max_in_flight):
+    """Starts each request at its offset; returns (summary, statuses)."""
+    results = []
+    lock = threading.Lock()
+    late = 0
+
+    def one(scheduled, record):
+        status = fetch_status(replay_url(base_url, record), timeout)
+        # From the scheduled start: time spent waiting for a free client thread counts too.
+        with lock:
+            results.append((status, time.perf_counter() - scheduled))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_in_flight) as pool:
+        for offset, record in planned:
+            scheduled = started + offset
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -0.01:
+                late += 1
+            pool.submit(one, scheduled, record)
+    elapsed = time.perf_counter() - started
+    statuses = {}
+    for status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    latencies = [latency for status, latency in results if status is not None and status < 500]
+    summary = summarize(latencies, len(results) - len(latencies), elapsed)
+    span = planned[-1][0] if planned else 0.0
+    summary["offered_rps"] = round(len(planned) / span, 1) if span else None
+    summary["late_starts"] = late
+    summary["shed_503"] = statuses.get("503", 0)
+    return summary, statuses
+
+
+def saturated(step, baseline):
+    if step["error_rate"] > SATURATION_ERROR_RATE:
+        return "error rate"
+    if baseline["p95_ms"] and step["p95_ms"] > SATURATION_P95_FACTOR * baseline["p95_ms"]:
+        return "p95 latency"
+    if step["offered_rps"] and step["throughput_rps"] < SATURATION_THROUGHPUT_SHARE * step["offered_rps"]:
+        return "throughput"
+    return None
+
+
+def replay(args):
+    records, completions = load_capture(args.replay)
+    if not records:
+        print(f"No requests in {args.replay}")
+        return 1
+    print(f"Replaying {len(records)} request(s), {len(completions)} recorded LLM answer(s) -> {args.url}")
+    if not args.ramp:
+        summary, statuses = run_open_loop(args.url, schedule(records, args.speed, args.rate, args.duration),
+                                          args.timeout, args.max_in_flight)
+        report = {**summary, "statuses": statuses}
+        print(json.dumps(report, indent=2) if args.json else "\n".join(f"{k:>15}: {v}" for k, v in report.items()))
+        return 1 if summary["errors"] == summary["requests"] else 0
+
+    start, stop, step = (float(part) for part in args.ramp.split(":"))
+    steps, saturation, baseline = [], None, None
+    rate = start
+    while rate <= stop:
+        summary, statuses = run_open_loop(args.url, schedule(records, rate=rate, duration=args.step_seconds),
+                                          args.timeout, args.max_in_flight)
+        baseline = baseline or summary
+        reason = saturated(summary, baseline)
+        steps.append({"rate": rate, **summary, "saturated": reason})
+        print(f"{rate:>8.1f} req/s  p50 {summary['p50_ms']:>8} ms  p95 {summary['p95_ms']:>8} ms  "
+              f"p99 {summary['p99_ms']:>8} ms  errors {summary['error_rate']:.2%}  "
+              f"throughput {summary['throughput_rps']} req/s{'  <- ' + reason if reason else ''}")
+        if reason:
+            saturation = {"rate": rate, "reason": reason}
+            break
+        rate += step
+    if saturation:
+        print(f"Saturated at {saturation['rate']} req/s ({saturation['reason']}).")
+    else:
+        print(f"No saturation up to {stop} req/s.")
+    if args.json:
+        print(json.dumps({"steps": steps, "saturation": saturation}, indent=2))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="HTTP load test: closed loop, or open-loop replay of a capture")
+    parser.add_argument("url", help="URL to load (closed loop) or server base URL (--replay)")
+    parser.add_argument("-n", "--requests", type=int, default=1000)
+    parser.add_argument("-c", "--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--replay", metavar="CAPTURE", help="replay /api/trade/query requests from a capture file")
+    parser.add_argument("--speed", type=float, help="replay recorded timing this many times faster")
+    parser.add_argument("--rate", type=float, help="fixed open-loop arrival rate (req/s) instead of recorded timing")
+    parser.add_argument("--duration", type=float, help="seconds to run at --rate (default: one pass over the capture)")
+    parser.add_argument("--ramp", metavar="START:STOP:STEP", help="step the arrival rate to find saturation")
+    parser.add_argument("--step-seconds", type=float, default=30, help="duration of each --ramp step")
+    parser.add_argument("--max-in-flight", type=int, default=256, help="client threads for open-loop replay")
+    parser.add_argument("--json", action="store_true", help="also print the report as JSON")
+    args = parser.parse_args()
+    if args.replay:
+        return replay(args)
+
+    latencies, errors = [], 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for ok, latency in pool.map(lambda _: fetch(args.url, args.timeout), range(args.requests)):
+            if ok:
+                latencies.append(latency)
+            else:
+                errors += 1
+    result = summarize(latencies, errors, time.perf_counter() - started)
+    for key, value in result.items():
+        print(f"{key:>15}: {value}")
+    return 1 if errors == result["requests"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
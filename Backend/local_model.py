@@ -0,0 +1,355 @@
+"""
+Local query generation through Ollama: offline, with no per-call fees.
+
+A local model on CPU has different costs than a remote API. Loading the
+model takes seconds, and so does evaluating the long schema prompt. Parallel
+calls compete for the same cores. OllamaServer handles those costs for every
+OllamaProvider that points at the same server:
+
+- KeepAliveSession keeps HTTP/1.1 connections open between calls instead
+  of opening a new one per call.
+- Every request sends keep_alive (OLLAMA_KEEP_ALIVE), and providers preload
+  their model at startup. The model stays in memory between calls instead
+  of being unloaded after Ollama's five-minute default.
+- The static prompt prefix (schema and examples) is sent as an identical
+  system message, and only the question is sent as the user message.
+  Ollama's prompt cache then reuses the evaluated prefix, so only the
+  question is prefilled.
+- At most OLLAMA_MAX_CONCURRENCY requests run at once (the default comes
+  from the CPU count). Further calls wait for a free slot.
+- Micro-batching: calls with the same prefix that arrive within
+  OLLAMA_BATCH_WINDOW_MS share one request. Identical questions are
+  answered once. Distinct questions are asked together, and a JSON schema
+  constrains the reply to {"answers": [...]}. If that reply does not hold
+  one object per question, each question is asked on its own.
+
+ollama_standin.py imitates the Ollama API, so all of this can run offline.
+llm_bench.py compares local generation with the remote providers.
+"""
+import os
+import json
+import time
+import threading
+import http.client
+import urllib.error
+import urllib.parse
+
+OLLAMA_URL = os.getenv("OLLAMA_URL", "http://localhost:11434/api/chat")
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_PRELOAD = os.getenv("OLLAMA_PRELOAD", "on") != "off"
+# One CPU generation already uses most cores, so only large machines gain from running several at once.
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", max(1, min(4, (os.cpu_count() or 1) // 8))))
+OLLAMA_BATCH_SIZE = int(os.getenv("OLLAMA_BATCH_SIZE", 4))
+OLLAMA_BATCH_WINDOW_SECONDS = float(os.getenv("OLLAMA_BATCH_WINDOW_MS", 15)) / 1000
+
+BATCH_INSTRUCTIONS = (
+    "Answer each of the following {count} requests independently, in order. Return one JSON object "
+    '{{"answers": [...]}} whose answers array holds exactly one query object per request.\n'
+)
+
+
+def split_prompt(prompt):
+    """(static prefix, request): the request is the prompt's last line."""
+    head, _, last = prompt.rstrip("\n").rpartition("\n")
+    return (head + "\n" if head else ""), last
+
+
+def batch_format(count):
+    """JSON schema for a merged answer (Ollama structured outputs)."""
+    return {
+        "type": "object",
+        "properties": {"answers": {"type": "array", "items": {"type": "object"},
+                                   "minItems": count, "maxItems": count}},
+        "required": ["answers"],
+    }
+
+
+class KeepAliveSession:
+    """Persistent HTTP/1.1 connections to one server, reused across calls."""
+
+    def __init__(self, url, max_idle=8):
+        parts = urllib.parse.urlsplit(url)
+        self.url = url
+        self.host = parts.netloc
+        self.connection_class = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        self.max_idle = max_idle
+        self.idle = []
+        self.lock = threading.Lock()
+        self.stats = {"opened": 0, "reused": 0}
+
+    def _checkout(self, timeout):
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is None:
+            self.stats["opened"] += 1
+            return self.connection_class(self.host, timeout=timeout), False
+        self.stats["reused"] += 1
+        connection.timeout = timeout
+        if connection.sock is not None:
+            connection.sock.settimeout(timeout)
+        return connection, True
+
+    def _checkin(self, connection):
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(connection)
+                return
+        connection.close()
+
+    def post(self, path, payload, timeout, on_line=None):
+        """
+        POSTs JSON and returns the decoded response. With on_line, the
+        response is an NDJSON stream: on_line gets each decoded line, and the
+        last one is returned.
+        """
+        body = json.dumps(payload).encode()
+        deadline = time.monotonic() + timeout
+        while True:
+            connection, reused = self._checkout(max(0.001, deadline - time.monotonic()))
+            try:
+                connection.request("POST", path, body, {"Content-Type": "application/json"})
+                response = connection.getresponse()
+            except (http.client.HTTPException, ConnectionError) as e:
+                connection.close()
+                if reused:
+                    continue   # the server closed an idle connection; try the next one
+                raise ConnectionError(f"{self.url}: {e}") from e
+            except BaseException:
+                connection.close()
+                raise
+            try:
+                if response.status >= 400:
+                    detail = response.read()[:200].decode(errors="replace")
+                    raise urllib.error.HTTPError(self.url, response.status, f"{response.reason}: {detail}",
+                                                 response.headers, None)
+                if on_line is None:
+                    result = json.loads(response.read())
+                else:
+                    result = {}
+                    for line in response:
+                        if line.strip():
+                            result = json.loads(line)
+                            on_line(result)
+            except BaseException:
+                # Stopped mid-response: the connection cannot carry another request.
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self._checkin(connection)
+            return result
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for connection in idle:
+            connection.close()
+
+
+class _Call:
+    """One question waiting in a batch."""
+
+    def __init__(self, question, timeout):
+        self.question = question
+        self.deadline = time.monotonic() + timeout
+        self.done = threading.Event()
+        self.text = None
+        self.tokens = None
+        self.error = None
+        self.alone = False   # ask on its own (a batch of one, or a merged answer that did not split)
+
+
+class _Batch:
+    def __init__(self):
+        self.calls = []
+        self.full = threading.Event()
+
+
+class OllamaServer:
+    """Connections, concurrency limit and batching for one Ollama server."""
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    @classmethod
+    def shared(cls, url=OLLAMA_URL):
+        with cls._shared_lock:
+            server = cls._shared.get(url)
+            if server is None:
+                server = cls._shared[url] = cls(url)
+            return server
+
+    def __init__(self, url=OLLAMA_URL, keep_alive=OLLAMA_KEEP_ALIVE, max_concurrency=OLLAMA_MAX_CONCURRENCY,
+                 batch_size=OLLAMA_BATCH_SIZE, batch_window_seconds=OLLAMA_BATCH_WINDOW_SECONDS):
+        self.url = url
+        self.path = urllib.parse.urlsplit(url).path or "/api/chat"
+        self.keep_alive = keep_alive
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self.batch_window_seconds = batch_window_seconds
+        self.session = KeepAliveSession(url, max_idle=max_concurrency * 2)
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.lock = threading.Lock()
+        self.open = {}   # (model, prefix) -> _Batch still accepting calls
+        self.in_flight = 0
+        self.waiting = 0
+        self.preloaded = set()
+        self.stats = {"calls": 0, "requests": 0, "batches": 0, "batched_calls": 0, "deduplicated": 0,
+                      "split": 0, "slot_wait_seconds": 0.0}
+
+    # --- requests ---
+    def _request(self, model, prefix, user, timeout, response_format="json", on_chunk=None):
+        """One /api/chat request on a free slot; returns (text, tokens)."""
+        deadline = time.monotonic() + timeout
+        started = time.perf_counter()
+        with self.lock:
+            self.waiting += 1
+        try:
+            acquired = self.slots.acquire(timeout=timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if not acquired:
+            raise TimeoutError(f"{self.url}: no free local model slot within {timeout:.2f}s")
+        self.stats["slot_wait_seconds"] += time.perf_counter() - started
+        with self.lock:
+            self.in_flight += 1
+            self.stats["requests"] += 1
+        try:
+            messages = ([{"role": "system", "content": prefix}] if prefix else []) + [{"role": "user", "content": user}]
+            payload = {
+                "model": model,
+                "messages": messages,
+                "format": response_format,
+                "stream": on_chunk is not None,
+                "keep_alive": self.keep_alive,
+                "options": {"temperature": 0},
+            }
+            remaining = max(0.001, deadline - time.monotonic())
+            if on_chunk is None:
+                data = self.session.post(self.path, payload, remaining)
+                text = data["message"]["content"]
+            else:
+                parts = []
+
+                def on_line(line):
+                    delta = line.get("message", {}).get("content")
+                    if delta:
+                        parts.append(delta)
+                        on_chunk(delta)
+                # The last line ("done": true) carries the token counts.
+                data = self.session.post(self.path, payload, remaining, on_line)
+                text = "".join(parts)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+            self.slots.release()
+        return text, (data.get("prompt_eval_count") or 0) + (data.get("eval_count") or 0)
+
+    def _merged(self, model, prefix, questions, timeout):
+        """{question: answer text} for several questions in one request."""
+        user = BATCH_INSTRUCTIONS.format(count=len(questions)) + "\n".join(
+            f"{number}. {question}" for number, question in enumerate(questions, 1))
+        text, tokens = self._request(model, prefix, user, timeout, response_format=batch_format(len(questions)))
+        answers = json.loads(text).get("answers")
+        if not isinstance(answers, list) or len(answers) != len(questions) \
+                or not all(isinstance(answer, dict) for answer in answers):
+            raise ValueError(f"expected {len(questions)} answers, got {text[:80]!r}")
+        return {question: json.dumps(answer) for question, answer in zip(questions, answers)}, tokens
+
+    def _run(self, model, prefix, calls):
+        """Answers a closed batch of two or more calls, on the first caller's thread."""
+        questions = list(dict.fromkeys(call.question for call in calls))
+        self.stats["batches"] += 1
+        self.stats["batched_calls"] += len(calls)
+        self.stats["deduplicated"] += len(calls) - len(questions)
+        timeout = max(0.001, min(call.deadline for call in calls) - time.monotonic())
+        try:
+            if len(questions) == 1:
+                text, tokens = self._request(model, prefix, questions[0], timeout)
+                answers = {questions[0]: text}
+            else:
+                answers, tokens = self._merged(model, prefix, questions, timeout)
+        except ValueError as e:
+            self.stats["split"] += 1
+            print(f"--- Merged local answer did not split ({e}); asking {len(questions)} question(s) separately")
+            for call in calls:
+                call.alone = True
+        except Exception as e:
+            for call in calls:
+                call.error = e
+        else:
+            for call in calls:
+                call.text = answers[call.question]
+                call.tokens = tokens // len(calls)
+        finally:
+            for call in calls:
+                call.done.set()
+
+    def generate(self, model, prompt, timeout, on_chunk=None):
+        """(text, tokens) for one prompt, batched with concurrent calls sharing its prefix."""
+        self.stats["calls"] += 1
+        prefix, question = split_prompt(prompt)
+        if not prefix or self.batch_size <= 1:
+            return self._request(model, prefix, question, timeout, on_chunk=on_chunk)
+        call = _Call(question, timeout)
+        key = (model, prefix)
+        with self.lock:
+            batch = self.open.get(key)
+            leader = batch is None
+            if leader:
+                batch = self.open[key] = _Batch()
+            batch.calls.append(call)
+            if len(batch.calls) >= self.batch_size:
+                del self.open[key]
+                batch.full.set()
+        if leader:
+            batch.full.wait(self.batch_window_seconds)
+            with self.lock:
+                if self.open.get(key) is batch:
+                    del self.open[key]
+            if len(batch.calls) == 1:
+                call.alone = True
+            else:
+                self._run(model, prefix, batch.calls)
+        elif not call.done.wait(max(0.0, call.deadline - time.monotonic())):
+            raise TimeoutError(f"{self.url}: batched local call timed out")
+        if call.alone:
+            # Only a call answered on its own is streamed token by token.
+            return self._request(model, prefix, question, max(0.001, call.deadline - time.monotonic()),
+                                 on_chunk=on_chunk)
+        if call.error is not None:
+            raise call.error
+        if on_chunk is not None:
+            on_chunk(call.text)
+        return call.text, call.tokens
+
+    # --- residency ---
+    def preload(self, model):
+        """Loads the model in the background, so the first question does not pay for it."""
+        with self.lock:
+            if model in self.preloaded:
+                return
+            self.preloaded.add(model)
+
+        def load():
+            try:
+                self.session.post(self.path, {"model": model, "messages": [], "keep_alive": self.keep_alive}, 300)
+                print(f"--- Local model '{model}' loaded (keep_alive {self.keep_alive})")
+            except Exception as e:
+                print(f"--- Could not preload local model '{model}': {e}")
+
+        threading.Thread(target=load, name="ollama-preload", daemon=True).start()
+
+    def snapshot(self):
+        return {
+            "url": self.url,
+            "max_concurrency": self.max_concurrency,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "batch_size": self.batch_size,
+            "batch_window_ms": round(self.batch_window_seconds * 1000),
+            "connections": dict(self.session.stats),
+            **{key: round(value, 3) if isinstance(value, float) else value for key, value in self.stats.items()},
+        }
@@ -0,0 +1,95 @@
+"""
+Adaptive model routing: a small fast model first, the large one when needed.
+
+Every question used to go to the large model, even "all countries
+population". The router classifies the question locally from three
+signals - how many entities it names, whether it compares or ranks, and
+how many dimensions (and so $lookups) it needs - and sends simple ones to
+the small tier. A small-tier answer that fails validation is escalated to
+the large tier, so quality is bounded by the large model while most
+questions pay only the small model's latency.
+"""
+import re
+import threading
+from llm_providers import LatencyStats
+
+SIMPLE = "small"
+COMPLEX = "large"
+
+COMPARISON_RE = re.compile(
+    r"\b(compare|comparison|versus|vs|than|difference|between|growth|grew|change|trend|ratio|share|"
+    r"percent(age)?|rank(ed|ing)?|top|bottom|highest|lowest|most|least|average|each|per|breakdown|"
+    r"month(ly)?|year over year|yoy|both)\b", re.I)
+# Words that name a dimension without naming a specific entity.
+DIMENSION_WORDS = {
+    "countries": re.compile(r"\b(country|countries|nation|region|population|partner)s?\b", re.I),
+    "commodities": re.compile(r"\b(commodit(y|ies)|product|goods|hs code|category)\b", re.I),
+    "years": re.compile(r"\b(year|years|annual|yearly|(19|20)\d{2})\b", re.I),
+    "ports": re.compile(r"\bports?\b", re.I),
+}
+# Score at or above which a question goes straight to the large model.
+COMPLEX_SCORE = 3
+
+
+def classify(user_query, entity_index=None):
+    """Returns (tier, score, reasons) for a question."""
+    mentions = entity_index.mentions(user_query) if entity_index is not None else []
+    dimensions = {collection for collection, _ in mentions}
+    dimensions |= {name for name, pattern in DIMENSION_WORDS.items() if pattern.search(user_query)}
+    comparisons = {match.group(0).lower() for match in COMPARISON_RE.finditer(user_query)}
+
+    reasons = []
+    score = 0
+    if len(mentions) >= 2:
+        score += len(mentions) - 1
+        reasons.append(f"{len(mentions)} entities")
+    if comparisons:
+        score += 1 if len(comparisons) == 1 else 2
+        reasons.append(f"comparison words {sorted(comparisons)}")
+    # Each extra dimension is another $lookup for a trades query.
+    if len(dimensions) >= 2:
+        score += len(dimensions) - 1
+        reasons.append(f"joins {sorted(dimensions)}")
+    return (COMPLEX if score >= COMPLEX_SCORE else SIMPLE), score, reasons
+
+
+class ModelRouter:
+    """
+    Routes generation between two LLMClients and records per-tier latency
+    and how often the small tier had to be escalated.
+    """
+
+    def __init__(self, small, large, entity_index=None):
+        self.small = small
+        self.large = large
+        self.entity_index = entity_index
+        self.lock = threading.Lock()
+        self.latency = {SIMPLE: LatencyStats(), COMPLEX: LatencyStats()}
+        self.counts = {"routed_small": 0, "routed_large": 0, "escalated": 0}
+
+    def route(self, user_query):
+        tier, score, reasons = classify(user_query, self.entity_index)
+        with self.lock:
+            self.counts[f"routed_{tier}"] += 1
+        print(f"--- Routed to {tier} tier (score {score}: {', '.join(reasons) or 'simple'})")
+        return tier
+
+    def client(self, tier):
+        return self.small if tier == SIMPLE else self.large
+
+    def record(self, tier, seconds, error=False):
+        self.latency[tier].record(seconds, error=error)
+
+    def escalated(self):
+        with self.lock:
+            self.counts["escalated"] += 1
+
+    def snapshot(self):
+        with self.lock:
+            counts = dict(self.counts)
+        small = counts["routed_small"]
+        return {
+            **counts,
+            "escalation_rate": round(counts["escalated"] / small, 3) if small else None,
+            "latency": {tier: stats.snapshot() for tier, stats in self.latency.items()},
+        }
@@ -0,0 +1,227 @@
+"""
+Offline stand-in for the Ollama API. It runs the local-model path
+(local_model.py) and llm_bench.py with no Ollama install and no model
+download.
+
+    python ollama_standin.py --port 11434
+    LLM_PROVIDERS=ollama:llama3 python dperp1.py
+
+POST /api/chat takes about as long as a small CPU model would. It models
+the costs that local_model.py works around:
+
+- loading the model on first use, and again once keep_alive has expired
+  (--load-seconds);
+- prefilling the prompt (--prefill-ms per 1000 characters), except for a
+  system prefix still cached from an earlier request;
+- generating tokens (--token-ms per token, about 4 characters each);
+- running at most --parallel requests at once, like OLLAMA_NUM_PARALLEL.
+  The rest queue.
+
+Answers are the prompt's EXAMPLES for their own questions, and a fixed
+valid query for any other question. A request whose format schema asks
+for "answers" (a merged batch) gets one answer per numbered request. The
+server speaks HTTP/1.1 keep-alive and NDJSON streaming. GET /api/tags and
+/api/ps list the models, and GET /stats shows what the server saw.
+"""
+import re
+import json
+import time
+import argparse
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from prompts import prompt_examples
+
+DEFAULT_ANSWER = {"collection": "countries", "pipeline": [{"$limit": 5}]}
+NUMBERED_REQUEST = re.compile(r'^\d+\.\s*(.+)$', re.M)
+CHARS_PER_TOKEN = 4
+
+
+def parse_duration(value, default=300.0):
+    """Ollama keep_alive ("30m", "300s", 600, "-1") in seconds; negative means forever."""
+    if value is None:
+        return default
+    if isinstance(value, (int, float)):
+        return float(value)
+    match = re.fullmatch(r"(-?\d+(?:\.\d+)?)\s*(ms|s|m|h)?", str(value).strip())
+    if not match:
+        return default
+    number, unit = float(match.group(1)), match.group(2) or "s"
+    return number * {"ms": 0.001, "s": 1, "m": 60, "h": 3600}[unit]
+
+
+def unquote(question):
+    return question.strip().strip('"').strip()
+
+
+class StandIn:
+    """Model residency, prompt cache and slots shared by all handler threads."""
+
+    def __init__(self, load_seconds=2.0, prefill_ms=40.0, token_ms=15.0, parallel=1, cache_slots=4):
+        self.load_seconds = load_seconds
+        self.prefill_ms = prefill_ms
+        self.token_ms = token_ms
+        self.slots = threading.BoundedSemaphore(parallel)
+        self.lock = threading.Lock()
+        self.loading = threading.Lock()
+        self.loaded = {}   # model -> expiry (monotonic seconds, None = forever)
+        self.cached_prefixes = deque(maxlen=cache_slots)
+        self.answers = {question.lower(): json.dumps(json.loads(text)) for question, text in prompt_examples()}
+        self.stats = {"connections": 0, "requests": 0, "loads": 0, "prefix_hits": 0, "prefix_misses": 0,
+                      "merged_requests": 0, "answers": 0}
+
+    def answer(self, question):
+        return self.answers.get(unquote(question).lower(), json.dumps(DEFAULT_ANSWER))
+
+    def _ensure_loaded(self, model, keep_alive):
+        # Requests that arrive during a load wait for it, as with Ollama.
+        with self.loading:
+            with self.lock:
+                expiry = self.loaded.get(model, 0)
+                resident = model in self.loaded and (expiry is None or expiry > time.monotonic())
+            if not resident:
+                self.stats["loads"] += 1
+                time.sleep(self.load_seconds)
+                with self.lock:
+                    self.loaded[model] = time.monotonic() + parse_duration(None)
+        seconds = parse_duration(keep_alive)
+        with self.lock:
+            if seconds == 0:
+                self.loaded.pop(model, None)
+            else:
+                self.loaded[model] = None if seconds < 0 else time.monotonic() + seconds
+
+    def _prefill_seconds(self, system, user):
+        with self.lock:
+            hit = bool(system) and system in self.cached_prefixes
+            if system and not hit:
+                self.cached_prefixes.append(system)
+        if system:
+            self.stats["prefix_hits" if hit else "prefix_misses"] += 1
+        characters = len(user) + (0 if hit else len(system))
+        return characters / 1000 * self.prefill_ms / 1000
+
+    def chat(self, body):
+        """(answer text, prompt tokens) after sleeping for load and prefill; the caller holds a slot."""
+        model = body.get("model", "llama3")
+        messages = body.get("messages") or []
+        self.stats["requests"] += 1
+        self._ensure_loaded(model, body.get("keep_alive"))
+        if not messages:
+            return None, 0
+        system = "".join(m.get("content", "") for m in messages if m.get("role") == "system")
+        user = "".join(m.get("content", "") for m in messages if m.get("role") != "system")
+        time.sleep(self._prefill_seconds(system, user))
+        schema = body.get("format")
+        if isinstance(schema, dict) and "answers" in schema.get("properties", {}):
+            self.stats["merged_requests"] += 1
+            questions = NUMBERED_REQUEST.findall(user)
+            text = json.dumps({"answers": [json.loads(self.answer(question)) for question in questions]})
+            self.stats["answers"] += len(questions)
+        else:
+            # A whole prompt in one message ends with the question, like dperp1's.
+            text = self.answer(user.rstrip("\n").rpartition("\n")[2])
+            self.stats["answers"] += 1
+        return text, (len(system) + len(user)) // CHARS_PER_TOKEN
+
+    def models(self):
+        with self.lock:
+            return [{"name": model, "model": model} for model in self.loaded]
+
+
+def make_handler(standin):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            standin.stats["connections"] += 1
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, payload, status=200):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _send_chunk(self, payload):
+            data = json.dumps(payload).encode() + b"\n"
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def do_GET(self):
+            if self.path in ("/api/tags", "/api/ps"):
+                self._send_json({"models": standin.models()})
+            elif self.path == "/stats":
+                self._send_json(standin.stats)
+            else:
+                self._send_json({"error": "not found"}, 404)
+
+        def do_POST(self):
+            # A slot covers the whole request, generation included.
+            with standin.slots:
+                self._chat()
+
+        def _chat(self):
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError:
+                return self._send_json({"error": "invalid JSON body"}, 400)
+            if self.path != "/api/chat":
+                return self._send_json({"error": "not found"}, 404)
+            model = body.get("model", "llama3")
+            started = time.perf_counter()
+            text, prompt_tokens = standin.chat(body)
+            if text is None:
+                return self._send_json({"model": model, "done": True, "done_reason": "load"})
+            pieces = [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+            final = {"model": model, "done": True, "done_reason": "stop", "prompt_eval_count": prompt_tokens,
+                     "eval_count": len(pieces)}
+            if not body.get("stream", True):
+                time.sleep(len(pieces) * standin.token_ms / 1000)
+                final["total_duration"] = int((time.perf_counter() - started) * 1e9)
+                return self._send_json({**final, "message": {"role": "assistant", "content": text}})
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                for piece in pieces:
+                    time.sleep(standin.token_ms / 1000)
+                    self._send_chunk({"model": model, "message": {"role": "assistant", "content": piece},
+                                      "done": False})
+                final["total_duration"] = int((time.perf_counter() - started) * 1e9)
+                self._send_chunk({**final, "message": {"role": "assistant", "content": ""}})
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True   # the client aborted the stream
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline stand-in for the Ollama chat API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--load-seconds", type=float, default=2.0, help="model load time when not resident")
+    parser.add_argument("--prefill-ms", type=float, default=40.0, help="prompt evaluation per 1000 characters")
+    parser.add_argument("--token-ms", type=float, default=15.0, help="generation time per output token")
+    parser.add_argument("--parallel", type=int, default=1, help="requests processed at once")
+    args = parser.parse_args()
+    standin = StandIn(args.load_seconds, args.prefill_ms, args.token_ms, args.parallel)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(standin))
+    server.daemon_threads = True
+    print(f"--- Ollama stand-in on http://{args.host}:{args.port}/api/chat "
+          f"({len(standin.answers)} example answer(s), {args.parallel} parallel)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+Year-partitioned storage for trades, with a fan-out query router.
+
+Nearly every trade query filters or groups by year, yet all history lives
+in one `trades` collection, so every scan grows with total history. In
+partitioned mode each year's trades live in their own collection
+(trades_y2023, ...), listed in the `trades_partitions` catalog. The router
+in front of the executor:
+
+- prunes partitions using the year predicate (year_id, or <years alias>.year);
+- runs decomposable pipelines per partition, in parallel: a row-level
+  prefix ($match/$lookup/$unwind/...) followed by nothing, $count,
+  $sort+$limit, or a $group whose accumulators merge ($sum/$min/$max/$avg/$count);
+- merges partial groups, counts and top-N heaps in Python;
+- runs anything else as one pipeline over the chosen partitions via $unionWith.
+
+The partitions are a derived copy: `trades` stays the collection every
+writer and the other readers use. The copy records the trades fingerprint
+it was built from (data_version.record_sync), and the router is only used
+while trades still matches it. Once trades changes, queries go back to
+trades until the partitions are rebuilt.
+
+Build or resync the partitions with:  python partitioning.py migrate
+"""
+import os
+import sys
+import json
+import heapq
+import argparse
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from data_version import fingerprint, record_sync, clear_sync, in_sync
+
+CATALOG = "trades_partitions"
+SOURCE = "trades"
+PARTITION_PREFIX = "trades_y"
+UNKNOWN_PARTITION = "trades_yunknown"
+PARTITION_INDEXES = ["country_id", "commodity_id", "trade_type"]
+WORKERS = int(os.getenv("PARTITION_WORKERS", 8))
+
+# Per-document stages: running them per partition gives the same rows.
+ROW_LEVEL_STAGES = {"$match", "$lookup", "$unwind", "$addFields", "$set", "$project", "$unset"}
+MERGEABLE_ACCUMULATORS = {"$sum", "$min", "$max", "$avg", "$count"}
+# Post-merge stages evaluated in Python; anything else goes back to MongoDB.
+PYTHON_TAIL_STAGES = {"$sort", "$limit", "$skip"}
+
+
+def partition_name(year):
+    return f"{PARTITION_PREFIX}{year}" if year is not None else UNKNOWN_PARTITION
+
+
+class PartitionCatalog:
+    """year_id -> partition collection, loaded from the catalog collection."""
+
+    def __init__(self, db):
+        self.db = db
+        self.partitions = []   # [{"year_id", "year", "collection", "count"}]
+        self.in_sync = False
+
+    def refresh(self):
+        partitions = list(self.db.get_collection(CATALOG).find({}, {"_id": 0}).sort("year", 1))
+        synced = bool(partitions) and in_sync(self.db, CATALOG)
+        if partitions and not synced and (self.in_sync or not self.partitions):
+            print(f"--- Trade partitions out of sync with '{SOURCE}'; querying '{SOURCE}' "
+                  f"until `partitioning.py migrate` runs again")
+        self.partitions, self.in_sync = partitions, synced
+        return self.partitions
+
+    @property
+    def enabled(self):
+        return bool(self.partitions) and self.in_sync
+
+    def collections(self):
+        return [p["collection"] for p in self.partitions]
+
+
+# --- Sorting helpers (MongoDB order: null < numbers < strings < others) ---
+def _sort_value(value):
+    if value is None:
+        return (0, 0)
+    if isinstance(value, bool):
+        return (4, value)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, str(value))
+
+
+def _get_path(doc, path):
+    for part in path.split("."):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(part)
+    return doc
+
+
+def sort_key(spec):
+    """A key function for a $sort spec like {"total": -1, "_id": 1}."""
+    def compare(a, b):
+        for field, direction in spec.items():
+            left, right = _sort_value(_get_path(a, field)), _sort_value(_get_path(b, field))
+            if left != right:
+                return (-1 if left < right else 1) * (1 if direction == 1 else -1)
+        return 0
+    return functools.cmp_to_key(compare)
+
+
+def _group_key(value):
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+# --- Router ---
+class PartitionRouter:
+    def __init__(self, db, catalog, workers=WORKERS):
+        self.db = db
+        self.catalog = catalog
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="partition")
+
+    # --- pruning ---
+    def prune(self, pipeline):
+        """Partitions that can hold rows matching the leading year predicates."""
+        partitions = list(self.catalog.partitions)
+        year_aliases = set()
+        for stage in pipeline:
+            (name, body), = stage.items()
+            # Past a reshaping stage a ".year" key may no longer be the joined year.
+            if name not in ("$match", "$lookup", "$unwind"):
+                break
+            if name == "$lookup" and body.get("from") == "years" and body.get("foreignField") == "_id":
+                year_aliases.add(body.get("as"))
+            if name != "$match" or not isinstance(body, dict):
+                continue
+            for key, predicate in body.items():
+                if key == "year_id":
+                    partitions = [p for p in partitions if self._matches(str(p["year_id"]), predicate, str)]
+                elif key.partition(".")[0] in year_aliases and key.endswith(".year"):
+                    partitions = [p for p in partitions if self._matches(p["year"], predicate, None)]
+        return partitions
+
+    @staticmethod
+    def _matches(value, predicate, cast):
+        """Conservative evaluation: anything not understood keeps the partition."""
+        convert = cast or (lambda v: v)
+        if not isinstance(predicate, dict):
+            return value == convert(predicate)
+        try:
+            for operator, operand in predicate.items():
+                if operator == "$eq" and value != convert(operand):
+                    return False
+                if operator == "$in" and value not in [convert(v) for v in operand]:
+                    return False
+                if operator == "$ne" and value == convert(operand):
+                    return False
+                if value is None:
+                    continue
+                if operator == "$gt" and not value > operand:
+                    return False
+                if operator == "$gte" and not value >= operand:
+                    return False
+                if operator == "$lt" and not value < operand:
+                    return False
+                if operator == "$lte" and not value <= operand:
+                    return False
+        except TypeError:
+            return True
+        return True
+
+    # --- planning ---
+    @staticmethod
+    def split(pipeline):
+        """(row-level prefix, tail)."""
+        for position, stage in enumerate(pipeline):
+            if next(iter(stage)) not in ROW_LEVEL_STAGES:
+                return pipeline[:position], pipeline[position:]
+        return pipeline, []
+
+    @staticmethod
+    def partial_group(group):
+        """
+        Rewrites a $group into per-partition partials, or None if it does not
+        decompose. Returns (partial $group body, {field: merge op}).
+        """
+        partial = {"_id": group["_id"]}
+        merges = {}
+        for field, accumulator in group.items():
+            if field == "_id":
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                return None
+            (operator, expression), = accumulator.items()
+            if operator not in MERGEABLE_ACCUMULATORS:
+                return None
+            if operator == "$count":
+                partial[field] = {"$sum": 1}
+                merges[field] = "$sum"
+            elif operator == "$avg":
+                partial[f"{field}__sum"] = {"$sum": expression}
+                partial[f"{field}__n"] = {"$sum": {"$cond": [{"$isNumber": expression}, 1, 0]}}
+                merges[field] = "$avg"
+            else:
+                partial[field] = {operator: expression}
+                merges[field] = operator
+        return partial, merges
+
+    def plan(self, pipeline):
+        prefix, tail = self.split(pipeline)
+        if not tail:
+            return "concat", prefix, []
+        head = next(iter(tail[0]))
+        if head == "$count":
+            return ("count", prefix, tail) if len(tail) == 1 else ("union", pipeline, [])
+        tail_stages = [next(iter(s)) for s in tail]
+        if (head == "$sort" and "$limit" in tail_stages and tail_stages.count("$sort") == 1
+                and set(tail_stages) <= PYTHON_TAIL_STAGES):
+            return "topn", prefix, tail
+        if head == "$group" and self.partial_group(tail[0]["$group"]) is not None:
+            return "group", prefix, tail
+        return "union", pipeline, []
+
+    # --- execution ---
+    def aggregate(self, pipeline, batch_size=None):
+        """Runs a trades pipeline over the pruned partitions; returns an iterable with close()."""
+        partitions = self.prune(pipeline)
+        names = [p["collection"] for p in partitions]
+        kind, prefix, tail = self.plan(pipeline)
+        print(f"--- Partition plan '{kind}' over {len(names)}/{len(self.catalog.partitions)} partition(s): {names}")
+        if not names:
+            return ResultCursor([])
+        options = {"allowDiskUse": True, "batchSize": batch_size} if batch_size else {}
+        if len(names) == 1:
+            return self.db.get_collection(names[0]).aggregate(pipeline, **options)
+        if kind == "concat":
+            # Streamed one partition after another: memory stays bounded for exports.
+            return ResultCursor(itertools.chain.from_iterable(
+                self.db.get_collection(name).aggregate(prefix, **options) for name in names))
+        if kind == "union":
+            unions = [{"$unionWith": {"coll": name}} for name in names[1:]]
+            return self.db.get_collection(names[0]).aggregate(unions + pipeline, **options)
+        if kind == "count":
+            field = tail[0]["$count"]
+            total = sum(row[field] for rows in self._fan_out(names, prefix + tail) for row in rows)
+            return ResultCursor([{field: total}] if total else [])
+        if kind == "topn":
+            return ResultCursor(self._top_n(names, prefix, tail))
+        return ResultCursor(self._grouped(names, prefix, tail))
+
+    def _fan_out(self, names, pipeline):
+        futures = [self.pool.submit(lambda n: list(self.db.get_collection(n).aggregate(pipeline)), name)
+                   for name in names]
+        return [future.result() for future in futures]
+
+    @staticmethod
+    def top_bound(stages):
+        """Rows of the sorted input that $skip/$limit stages can reach: the tightest skip+limit prefix."""
+        offset, bound = 0, None
+        for stage in stages:
+            (name, value), = stage.items()
+            if name == "$skip":
+                offset += value
+            elif name == "$limit":
+                bound = offset + value if bound is None else min(bound, offset + value)
+        return bound
+
+    def _top_n(self, names, prefix, tail):
+        spec = tail[0]["$sort"]
+        bound = self.top_bound(tail[1:])
+        # Each partition only needs its own first `bound` rows.
+        per_partition = prefix + [{"$sort": spec}, {"$limit": bound}]
+        rows = itertools.chain.from_iterable(self._fan_out(names, per_partition))
+        return self._tail(heapq.nsmallest(bound, rows, key=sort_key(spec)), tail[1:])
+
+    def _grouped(self, names, prefix, tail):
+        partial, merges = self.partial_group(tail[0]["$group"])
+        merged = {}
+        for rows in self._fan_out(names, prefix + [{"$group": partial}]):
+            for row in rows:
+                key = _group_key(row["_id"])
+                current = merged.get(key)
+                if current is None:
+                    merged[key] = row
+                    continue
+                for field, operator in merges.items():
+                    if operator == "$avg":
+                        for part in (f"{field}__sum", f"{field}__n"):
+                            current[part] = (current.get(part) or 0) + (row.get(part) or 0)
+                    elif operator == "$sum":
+                        current[field] = (current.get(field) or 0) + (row.get(field) or 0)
+                    else:
+                        values = [v for v in (current.get(field), row.get(field)) if v is not None]
+                        if values:
+                            current[field] = (min if operator == "$min" else max)(values, key=_sort_value)
+        results = []
+        for row in merged.values():
+            for field, operator in merges.items():
+                if operator == "$avg":
+                    total, count = row.pop(f"{field}__sum"), row.pop(f"{field}__n")
+                    row[field] = total / count if count else None
+            results.append(row)
+        return self._tail(results, tail[1:])
+
+    def _tail(self, rows, stages):
+        """Post-merge stages: sort/skip/limit in Python, anything else in MongoDB."""
+        if all(next(iter(stage)) in PYTHON_TAIL_STAGES for stage in stages):
+            for stage in stages:
+                (name, body), = stage.items()
+                if name == "$sort":
+                    rows.sort(key=sort_key(body))
+                elif name == "$skip":
+                    rows = rows[body:]
+                else:
+                    rows = rows[:body]
+            return rows
+        # e.g. a $project after the $group: the merged groups are few, so let
+        # MongoDB apply the rest of the pipeline to them directly.
+        return list(self.db.aggregate([{"$documents": rows}] + stages))
+
+
+class ResultCursor:
+    """Iterable with the close() the executor and export stream expect."""
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+
+    def __iter__(self):
+        return self.rows
+
+    def __next__(self):
+        return next(self.rows)
+
+    def close(self):
+        close = getattr(self.rows, "close", None)
+        if close is not None:
+            close()
+
+
+# --- Migration ---
+def migrate(db):
+    """
+    (Re)builds one collection per year from trades and writes the catalog.
+    Each partition is replaced whole ($out), so re-running it resyncs the
+    partitions after trades changed, deletions included.
+    """
+    source = db.get_collection(SOURCE)
+    # Queries leave the partitions while they are rebuilt; the state is taken
+    # first, so writes during the copy leave them out of sync.
+    clear_sync(db, CATALOG)
+    state = fingerprint(source)
+    years = {year["_id"]: year.get("year") for year in db.get_collection("years").find({}, {"year": 1})}
+    catalog = db.get_collection(CATALOG)
+    by_partition = {}
+    for year_id in source.distinct("year_id"):
+        by_partition.setdefault(partition_name(years.get(year_id)), []).append(year_id)
+    for name, year_ids in by_partition.items():
+        print(f"Copying year_id(s) {year_ids} -> {name} ...")
+        # Server-side copy that replaces the partition atomically.
+        source.aggregate([{"$match": {"year_id": {"$in": year_ids}}}, {"$out": name}])
+        partition = db.get_collection(name)
+        for field in PARTITION_INDEXES:
+            partition.create_index(field)
+        count = partition.count_documents({})
+        for year_id in year_ids:
+            catalog.replace_one({"year_id": year_id}, {"year_id": year_id, "year": years.get(year_id),
+                                                       "collection": name, "count": count}, upsert=True)
+        print(f"  {count} document(s)")
+    year_ids = [year_id for ids in by_partition.values() for year_id in ids]
+    for stale in catalog.find({"year_id": {"$nin": year_ids}}):
+        catalog.delete_one({"_id": stale["_id"]})
+        if stale["collection"] not in by_partition:
+            db.drop_collection(stale["collection"])
+        print(f"Removed year_id {stale['year_id']} from the catalog (no trades left).")
+    total = sum(db.get_collection(name).count_documents({}) for name in by_partition)
+    source_count = source.count_documents({})
+    print(f"Partitioned {total} of {source_count} trade(s) into {len(by_partition)} partition(s).")
+    if total != source_count:
+        print(f"Counts differ; '{SOURCE}' changed during the copy. Run migrate again.")
+        return False
+    record_sync(db, CATALOG, SOURCE, state)
+    return True
+
+
+def main():
+    from dotenv import load_dotenv
+    import pymongo
+
+    parser = argparse.ArgumentParser(description="Year-partitioned trades storage")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="copy trades into per-year partitions (re-run to resync)")
+    sub.add_parser("status", help="list partitions from the catalog")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = pymongo.MongoClient(os.getenv("MONGO_ATLAS_URI")).get_database("Trade")
+    if args.command == "migrate":
+        sys.exit(0 if migrate(db) else 1)
+    catalog = PartitionCatalog(db)
+    for partition in catalog.refresh():
+        print(f"{partition['year']}\t{partition['collection']}\t{partition['count']}")
+    print("in sync" if catalog.in_sync else f"out of sync with '{SOURCE}': run migrate")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,519 @@
+"""
+Local validator and auto-repair for LLM-generated aggregation pipelines.
+
+Malformed model output used to fail only when MongoDB rejected it, after a
+full LLM + network round trip. This module checks the generated
+{"collection": ..., "pipeline": [...]} object locally against a stage
+whitelist and the field layout of the five 'Trade' collections, fixes the
+mistakes that can be fixed deterministically, and reports the rest so the
+caller can re-ask the model once with a targeted correction prompt.
+"""
+import json
+import difflib
+
+# --- Collection schemas (field -> type) ---
+# Types are coarse: "objectId", "string", "number", "date". They are only
+# used to coerce string-quoted numbers and to resolve dotted field paths.
+MONTH_FIELDS = [
+    "april", "may", "june", "july", "august", "september",
+    "october", "november", "december", "january", "february", "march",
+]
+
+COLLECTION_SCHEMAS = {
+    "trades": {
+        "_id": "objectId", "country_id": "objectId", "commodity_id": "objectId",
+        "year_id": "objectId", "trade_type": "string", "quantity": "number",
+        "value_usd": "number", "currency": "string", "unit_price": "number",
+        "port": "string", "created_at": "date",
+    },
+    "countries": {
+        "_id": "objectId", "country_code": "string", "country_name": "string",
+        "region": "string", "sub_region": "string", "iso3": "string",
+        "currency": "string", "population": "number",
+    },
+    "commodities": {
+        "_id": "objectId", "hs_code": "string", "commodity_name": "string",
+        "category": "string", "unit": "string", "description": "string",
+    },
+    "years": {
+        "_id": "objectId", "year": "number", "description": "string",
+    },
+    "impexp": {
+        "_id": "objectId", "import_export_quantity_in_000_metric_tonnes": "string",
+        "product": "string", **{month: "number" for month in MONTH_FIELDS}, "total": "number",
+    },
+}
+
+ALLOWED_COLLECTIONS = set(COLLECTION_SCHEMAS)
+
+# Read-only stages only: $out / $merge would let a prompt write to the database.
+ALLOWED_STAGES = {
+    "$match", "$group", "$project", "$sort", "$limit", "$skip", "$lookup",
+    "$unwind", "$count", "$addFields", "$set", "$unset", "$replaceRoot",
+    "$replaceWith", "$facet", "$bucket", "$sortByCount", "$sample",
+}
+
+GROUP_ACCUMULATORS = {
+    "$sum", "$avg", "$min", "$max", "$first", "$last", "$push",
+    "$addToSet", "$count", "$stdDevPop", "$stdDevSamp",
+}
+
+LOOKUP_KEYS = {key.lower(): key for key in ("from", "localField", "foreignField", "as", "let", "pipeline")}
+
+COMPARISON_OPERATORS = {"$eq", "$ne", "$gt", "$gte", "$lt", "$lte"}
+
+# Stages after which the document shape is no longer tracked.
+OPAQUE_STAGES = {"$replaceRoot", "$replaceWith", "$facet", "$bucket", "$sortByCount"}
+
+
+class PipelineValidationError(ValueError):
+    """Raised when a generated query cannot be repaired locally."""
+
+    def __init__(self, errors, query_data=None):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+        self.query_data = query_data
+
+
+# --- Helpers ---
+def _coerce_number(value):
+    """Returns value as int/float if it is a string-quoted number, else None."""
+    if not isinstance(value, str):
+        return None
+    text = value.strip()
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def _closest(name, candidates):
+    """Case-insensitive exact match first, then a conservative fuzzy match."""
+    lowered = {candidate.lower(): candidate for candidate in candidates}
+    if name.lower() in lowered:
+        return lowered[name.lower()]
+    matches = difflib.get_close_matches(name.lower(), list(lowered), n=1, cutoff=0.85)
+    return lowered[matches[0]] if matches else None
+
+
+class _Validator:
+    """Walks one pipeline, tracking the document shape stage by stage."""
+
+    def __init__(self, schemas):
+        self.schemas = schemas
+        self.repairs = []
+        self.errors = []
+        self.shape = None
+
+    # -- shape helpers --
+    # A shape is a dict mapping field -> type string, nested dict (for
+    # $lookup results) or None (computed value, any sub-path allowed).
+    # A shape of None means the whole document is untracked.
+    def resolve(self, shape, path, where):
+        """Returns (repaired_path, type) or (None, None) if unknown."""
+        if shape is None:
+            return path, None
+        parts = path.split(".")
+        fixed = []
+        node = shape
+        for index, part in enumerate(parts):
+            if node is None:
+                fixed.extend(parts[index:])
+                return ".".join(fixed), None
+            if not isinstance(node, dict):
+                return None, None
+            if part not in node:
+                candidate = _closest(part, node)
+                if candidate is None:
+                    return None, None
+                self.repairs.append(f"{where}: field '{part}' -> '{candidate}'")
+                part = candidate
+            fixed.append(part)
+            node = node[part]
+        return ".".join(fixed), node if isinstance(node, str) else None
+
+    def check_path(self, shape, path, where):
+        repaired, _ = self.resolve(shape, path, where)
+        if repaired is None:
+            self.errors.append(f"{where}: unknown field '{path}'")
+            return path
+        return repaired
+
+    def walk_expression(self, shape, expr, where):
+        """Repairs "$field" references inside an aggregation expression."""
+        if isinstance(expr, str):
+            if expr.startswith("$") and not expr.startswith("$$"):
+                return "$" + self.check_path(shape, expr[1:], where)
+            return expr
+        if isinstance(expr, list):
+            return [self.walk_expression(shape, item, where) for item in expr]
+        if isinstance(expr, dict):
+            return {key: self.walk_expression(shape, value, where) for key, value in expr.items()}
+        return expr
+
+    # -- $match --
+    def coerce_match_value(self, value, field_type, where):
+        if field_type != "number":
+            return value
+        number = _coerce_number(value)
+        if number is not None:
+            self.repairs.append(f"{where}: string {value!r} -> number {number}")
+            return number
+        if isinstance(value, dict):
+            coerced = {}
+            for op, operand in value.items():
+                if op in COMPARISON_OPERATORS:
+                    operand = self.coerce_match_value(operand, field_type, where)
+                elif op in ("$in", "$nin") and isinstance(operand, list):
+                    operand = [self.coerce_match_value(item, field_type, where) for item in operand]
+                coerced[op] = operand
+            return coerced
+        return value
+
+    def walk_match(self, shape, query, where):
+        if not isinstance(query, dict):
+            self.errors.append(f"{where}: $match must be an object")
+            return query
+        fixed = {}
+        for key, value in query.items():
+            if key in ("$and", "$or", "$nor"):
+                if not isinstance(value, list):
+                    self.errors.append(f"{where}: {key} must be an array")
+                    fixed[key] = value
+                else:
+                    fixed[key] = [self.walk_match(shape, item, where) for item in value]
+            elif key == "$expr":
+                fixed[key] = self.walk_expression(shape, value, where)
+            elif key.startswith("$"):
+                fixed[key] = value
+            else:
+                path, field_type = self.resolve(shape, key, where)
+                if path is None:
+                    self.errors.append(f"{where}: unknown field '{key}'")
+                    path = key
+                fixed[path] = self.coerce_match_value(value, field_type, f"{where}.{path}")
+        return fixed
+
+    # -- stage handlers (each returns (stage_body, new_shape)) --
+    def stage_match(self, shape, body, where):
+        return self.walk_match(shape, body, where), shape
+
+    def stage_lookup(self, shape, body, where):
+        if not isinstance(body, dict):
+            self.errors.append(f"{where}: $lookup must be an object")
+            return body, shape
+        fixed = {}
+        for key, value in body.items():
+            canonical = LOOKUP_KEYS.get(key.lower())
+            if canonical is None:
+                self.errors.append(f"{where}: unexpected $lookup key '{key}'")
+                continue
+            if canonical != key:
+                self.repairs.append(f"{where}: $lookup key '{key}' -> '{canonical}'")
+            fixed[canonical] = value
+        source = fixed.get("from")
+        if source not in self.schemas:
+            candidate = _closest(source, self.schemas) if isinstance(source, str) else None
+            if candidate is None:
+                self.errors.append(f"{where}: $lookup.from '{source}' is not a known collection")
+                return fixed, shape
+            self.repairs.append(f"{where}: $lookup.from '{source}' -> '{candidate}'")
+            fixed["from"] = source = candidate
+        if not isinstance(fixed.get("as"), str):
+            self.errors.append(f"{where}: $lookup.as must be a string")
+            return fixed, shape
+        if "pipeline" not in fixed:
+            for key in ("localField", "foreignField"):
+                if not isinstance(fixed.get(key), str):
+                    self.errors.append(f"{where}: $lookup.{key} must be a string")
+                    return fixed, shape
+            fixed["localField"] = self.check_path(shape, fixed["localField"], where)
+            fixed["foreignField"] = self.check_path(self.schemas[source], fixed["foreignField"], where)
+        if shape is not None:
+            shape = dict(shape)
+            shape[fixed["as"]] = dict(self.schemas[source]) if "pipeline" not in fixed else None
+        return fixed, shape
+
+    def stage_unwind(self, shape, body, where):
+        if isinstance(body, dict):
+            path = body.get("path")
+            if isinstance(path, str) and path.startswith("$"):
+                body = dict(body, path="$" + self.check_path(shape, path[1:], where))
+            else:
+                self.errors.append(f"{where}: $unwind.path must be a '$field' string")
+            return body, shape
+        if isinstance(body, str) and body.startswith("$"):
+            return "$" + self.check_path(shape, body[1:], where), shape
+        if isinstance(body, str):
+            self.repairs.append(f"{where}: $unwind '{body}' -> '${body}'")
+            return "$" + self.check_path(shape, body, where), shape
+        self.errors.append(f"{where}: $unwind must be a '$field' string or object")
+        return body, shape
+
+    def stage_group(self, shape, body, where):
+        if not isinstance(body, dict):
+            self.errors.append(f"{where}: $group must be an object")
+            return body, shape
+        if "_id" not in body:
+            self.repairs.append(f"{where}: missing $group._id -> null")
+            body = {"_id": None, **body}
+        fixed = {"_id": self.walk_expression(shape, body["_id"], where)}
+        new_shape = {"_id": None}
+        for name, accumulator in body.items():
+            if name == "_id":
+                continue
+            if not isinstance(accumulator, dict) or len(accumulator) != 1:
+                self.errors.append(f"{where}: $group.{name} must be a single-accumulator object")
+                fixed[name] = accumulator
+                continue
+            (op, operand), = accumulator.items()
+            if op not in GROUP_ACCUMULATORS:
+                candidate = _closest(op, GROUP_ACCUMULATORS)
+                if candidate is None:
+                    self.errors.append(f"{where}: unknown accumulator '{op}'")
+                    fixed[name] = accumulator
+                    continue
+                self.repairs.append(f"{where}: accumulator '{op}' -> '{candidate}'")
+                op = candidate
+            fixed[name] = {op: self.walk_expression(shape, operand, where)}
+            new_shape[name] = "number" if op in ("$sum", "$avg", "$count", "$stdDevPop", "$stdDevSamp") else None
+        return fixed, new_shape
+
+    def stage_project(self, shape, body, where):
+        if not isinstance(body, dict) or not body:
+            self.errors.append(f"{where}: $project must be a non-empty object")
+            return body, shape
+        fixed = {}
+        inclusion = exclusion = False
+        for name, value in body.items():
+            number = _coerce_number(value)
+            if number is not None:
+                self.repairs.append(f"{where}: $project.{name} {value!r} -> {number}")
+                value = number
+            if isinstance(value, bool):
+                value = int(value)
+            if isinstance(value, (int, float)) and value in (0, 1):
+                if name != "_id":
+                    inclusion = inclusion or value == 1
+                    exclusion = exclusion or value == 0
+                path, _ = self.resolve(shape, name, where)
+                if path is None:
+                    # Projecting a field that does not exist is a no-op; drop it.
+                    self.repairs.append(f"{where}: dropped unknown $project field '{name}'")
+                    continue
+                fixed[path] = int(value)
+            else:
+                fixed[name] = self.walk_expression(shape, value, where)
+                inclusion = True
+        if inclusion and exclusion:
+            self.errors.append(f"{where}: $project mixes inclusion and exclusion")
+            return fixed, shape
+        if shape is None:
+            return fixed, None
+        # {"_id": 0} alone is an exclusion too: every other field is kept.
+        if not inclusion and (exclusion or fixed.get("_id") == 0):
+            new_shape = {key: value for key, value in shape.items() if fixed.get(key) != 0}
+        else:
+            new_shape = {} if fixed.get("_id") == 0 else {"_id": shape.get("_id")}
+            for name, value in fixed.items():
+                if value == 0:
+                    continue
+                root = name.split(".")[0]
+                new_shape[root] = shape.get(root) if value == 1 else None
+        return fixed, new_shape
+
+    def stage_add_fields(self, shape, body, where):
+        if not isinstance(body, dict):
+            self.errors.append(f"{where}: stage body must be an object")
+            return body, shape
+        fixed = {name: self.walk_expression(shape, value, where) for name, value in body.items()}
+        if shape is not None:
+            shape = dict(shape)
+            for name in fixed:
+                shape[name.split(".")[0]] = None
+        return fixed, shape
+
+    def stage_sort(self, shape, body, where):
+        if not isinstance(body, dict) or not body:
+            self.errors.append(f"{where}: $sort must be a non-empty object")
+            return body, shape
+        fixed = {}
+        for name, direction in body.items():
+            number = _coerce_number(direction)
+            if number is not None:
+                self.repairs.append(f"{where}: $sort.{name} {direction!r} -> {number}")
+                direction = number
+            if direction not in (1, -1) and not isinstance(direction, dict):
+                self.errors.append(f"{where}: $sort.{name} must be 1 or -1")
+            fixed[self.check_path(shape, name, where)] = direction
+        return fixed, shape
+
+    def stage_integer(self, shape, body, where):
+        number = _coerce_number(body)
+        if number is not None:
+            self.repairs.append(f"{where}: {body!r} -> {int(number)}")
+            body = int(number)
+        if isinstance(body, bool) or not isinstance(body, int) or body < 0:
+            self.errors.append(f"{where}: expected a non-negative integer")
+        return body, shape
+
+    def stage_count(self, shape, body, where):
+        if not isinstance(body, str) or not body or body.startswith("$"):
+            self.errors.append(f"{where}: $count must be a field name string")
+            return body, shape
+        return body, {body: "number"}
+
+    def stage_unset(self, shape, body, where):
+        names = [body] if isinstance(body, str) else body
+        if not isinstance(names, list):
+            self.errors.append(f"{where}: $unset must be a string or array")
+            return body, shape
+        if shape is not None:
+            shape = {key: value for key, value in shape.items() if key not in names}
+        return body, shape
+
+    def stage_sample(self, shape, body, where):
+        if not isinstance(body, dict) or "size" not in body:
+            self.errors.append(f"{where}: $sample must be {{'size': n}}")
+            return body, shape
+        size, _ = self.stage_integer(shape, body["size"], where)
+        return {"size": size}, shape
+
+    def stage_opaque(self, shape, body, where):
+        return self.walk_expression(shape, body, where), None
+
+    HANDLERS = {
+        "$match": stage_match, "$lookup": stage_lookup, "$unwind": stage_unwind,
+        "$group": stage_group, "$project": stage_project, "$addFields": stage_add_fields,
+        "$set": stage_add_fields, "$sort": stage_sort, "$limit": stage_integer,
+        "$skip": stage_integer, "$count": stage_count, "$unset": stage_unset,
+        "$sample": stage_sample,
+    }
+
+    # -- pipeline --
+    def normalize_stages(self, pipeline):
+        """Splits multi-key stages and fixes stage-name casing."""
+        stages = []
+        lowered = {stage.lower(): stage for stage in ALLOWED_STAGES}
+        for index, stage in enumerate(pipeline):
+            where = f"stage {index}"
+            if not isinstance(stage, dict) or not stage:
+                self.errors.append(f"{where}: each stage must be a non-empty object")
+                continue
+            if len(stage) > 1:
+                self.repairs.append(f"{where}: split multi-operator stage {list(stage)}")
+            for name, body in stage.items():
+                key = name if name.startswith("$") else "$" + name
+                canonical = lowered.get(key.lower())
+                if canonical is None:
+                    self.errors.append(f"{where}: stage '{name}' is not allowed")
+                    continue
+                if canonical != name:
+                    self.repairs.append(f"{where}: stage '{name}' -> '{canonical}'")
+                stages.append({canonical: body})
+        return stages
+
+    def run(self, collection, pipeline):
+        shape = dict(self.schemas[collection])
+        fixed = []
+        for index, stage in enumerate(self.normalize_stages(pipeline)):
+            (name, body), = stage.items()
+            where = f"stage {index} ({name})"
+            if name in OPAQUE_STAGES:
+                handler = _Validator.stage_opaque
+            else:
+                handler = self.HANDLERS.get(name, _Validator.stage_opaque)
+            body, shape = handler(self, shape, body, where)
+            fixed.append({name: body})
+        self.shape = shape
+        return fixed
+
+
+# --- Public API ---
+def validate_and_repair(query_data, schemas=None):
+    """
+    Validates a generated {"collection", "pipeline"} object and applies
+    deterministic repairs.
+    Returns (repaired_query_data, repairs). Raises PipelineValidationError
+    listing every problem that could not be fixed locally.
+    """
+    schemas = schemas or COLLECTION_SCHEMAS
+    repairs = []
+    if isinstance(query_data, str):
+        try:
+            query_data = json.loads(query_data)
+        except json.JSONDecodeError as e:
+            raise PipelineValidationError([f"response is not valid JSON: {e}"], query_data)
+    if not isinstance(query_data, dict):
+        raise PipelineValidationError(["response must be a JSON object"])
+
+    missing = [key for key in ("collection", "pipeline") if key not in query_data]
+    if missing:
+        raise PipelineValidationError([f"missing top-level key(s): {', '.join(missing)}"], query_data)
+
+    collection = query_data["collection"]
+    if collection not in schemas:
+        candidate = _closest(collection, schemas) if isinstance(collection, str) else None
+        if candidate is None:
+            raise PipelineValidationError([f"collection '{collection}' is not one of {sorted(schemas)}"], query_data)
+        repairs.append(f"collection '{collection}' -> '{candidate}'")
+        collection = candidate
+
+    pipeline = query_data["pipeline"]
+    if isinstance(pipeline, str):
+        try:
+            pipeline = json.loads(pipeline)
+            repairs.append("pipeline was a JSON string -> parsed")
+        except json.JSONDecodeError:
+            raise PipelineValidationError(["pipeline is a string that is not valid JSON"], query_data)
+    if isinstance(pipeline, dict):
+        repairs.append("pipeline was a single stage object -> wrapped in a list")
+        pipeline = [pipeline]
+    if not isinstance(pipeline, list):
+        raise PipelineValidationError(["pipeline must be an array of stages"], query_data)
+
+    validator = _Validator(schemas)
+    pipeline = validator.run(collection, pipeline)
+    repairs.extend(validator.repairs)
+    repaired = {"collection": collection, "pipeline": pipeline}
+    if validator.errors:
+        raise PipelineValidationError(validator.errors, repaired)
+    return repaired, repairs
+
+
+def output_shape(collection, pipeline, schemas=None):
+    """
+    Field layout of the rows a validated pipeline returns: {field: type,
+    nested dict (e.g. a joined document) or None (a computed value)}, or
+    None when a stage makes the layout unknown.
+    """
+    validator = _Validator(schemas or COLLECTION_SCHEMAS)
+    validator.run(collection, pipeline)
+    return validator.shape
+
+
+def build_repair_prompt(user_query, query_data, errors, schemas=None):
+    """
+    Short, targeted correction prompt used for the single re-ask. Much
+    smaller than the full schema prompt: only the failing output, the
+    problems found, and the relevant field lists.
+    """
+    schemas = schemas or COLLECTION_SCHEMAS
+    fields = "\n".join(f"- {name}: {', '.join(schemas[name])}" for name in sorted(schemas))
+    return f"""Your MongoDB query JSON for the request "{user_query}" failed validation.
+
+Previous output:
+{json.dumps(query_data)}
+
+Problems:
+{chr(10).join('- ' + error for error in errors)}
+
+Valid fields per collection:
+{fields}
+
+Return ONLY the corrected JSON object with keys "collection" and "pipeline".
+"""
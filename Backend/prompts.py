@@ -0,0 +1,77 @@
+"""
+The query-generation prompt, shared by the server and the offline tools
+(llm_bench.py, ollama_standin.py) that must build or read it without a
+database connection.
+"""
+import re
+
+# IMPORTANT: This is your refined schema prompt. Everything except the user
+# request is static per schema version, so it is formatted once per schema
+# hash (see dperp1.compiled_prompt) rather than on every request. The request
+# is appended as the last line, so local models can keep the prefix cached.
+SCHEMA_PROMPT_TEMPLATE = """
+You are a MongoDB aggregation expert.  
+Your job is to convert the user's plain-English question into a concise valid JSON object with these top-level fields only:
+{{"collection": "<collection>", "pipeline": [...]}}
+
+The database is named 'Trade' (exact case). It contains these collections and relationships:
+
+{schema_summary}
+(impexp.product is equivalent to commodities.commodity_name; join trades to the other collections on the "-> collection._id" fields.)
+
+Instructions:
+- Choose 'trades' for queries about: specific trade lines, USD values, units, ports, trades by country/commodity/year, or "top N by value". Always join related info using $lookup and $unwind as needed.
+- Choose 'impexp' for: monthly/annual import/export totals, queries using words like "metric tonnes", or product-based aggregated import/export (e.g. LPG, MS, HSD, CRUDE OIL).
+- trades.created_at is the trade timestamp (ISO 8601). For date ranges ("in Q2 2024", "in June 2024", "since March 2024") match it with ISO date strings and a half-open range: {{"created_at": {{"$gte": "2024-04-01", "$lt": "2024-07-01"}}}}. For daily/weekly/monthly trends group by {{"$dateTrunc": {{"date": "$created_at", "unit": "month"}}}} and sort by _id. Use year_doc.year only for fiscal-year questions.
+- Only use fields exactly as shown (no guessing keys). Only output a JSON object with keys: collection and pipeline.
+
+EXAMPLES:
+
+User: "exports from india"
+{{"collection": "trades", "pipeline": [
+  {{"$lookup": {{"from": "countries", "localField": "country_id", "foreignField": "_id", "as": "country_doc"}}}},
+  {{"$unwind": "$country_doc"}},
+  {{"$match": {{"country_doc.country_name": "India", "trade_type": "Export"}}}}
+]}}
+
+User: "top 3 commodities by value last year"
+{{"collection": "trades", "pipeline": [
+  {{"$lookup": {{"from": "years", "localField": "year_id", "foreignField": "_id", "as": "year_doc"}}}},
+  {{"$unwind": "$year_doc"}},
+  {{"$lookup": {{"from": "commodities", "localField": "commodity_id", "foreignField": "_id", "as": "commodity_doc"}}}},
+  {{"$unwind": "$commodity_doc"}},
+  {{"$match": {{"year_doc.year": 2024}}}},
+  {{"$group": {{"_id": "$commodity_doc.commodity_name", "total_value": {{"$sum": "$value_usd"}}}}}},
+  {{"$sort": {{"total_value": -1}}}},
+  {{"$limit": 3}}
+]}}
+
+User: "monthly import of crude oil"
+{{"collection": "impexp", "pipeline": [
+  {{"$match": {{"product": "CRUDE OIL", "import_export_quantity_in_000_metric_tonnes": "IMPORT"}}}},
+  {{"$project": {{"_id": 0, "product": 1, "april": 1, "may": 1, "june": 1, "july": 1, "august": 1, "september": 1, "october": 1, "november": 1, "december": 1, "january": 1, "february": 1, "march": 1, "total": 1}}}}
+]}}
+
+User: "monthly export value in the first half of 2024"
+{{"collection": "trades", "pipeline": [
+  {{"$match": {{"trade_type": "Export", "created_at": {{"$gte": "2024-01-01", "$lt": "2024-07-01"}}}}}},
+  {{"$group": {{"_id": {{"$dateTrunc": {{"date": "$created_at", "unit": "month"}}}}, "total_usd": {{"$sum": "$value_usd"}}}}}},
+  {{"$sort": {{"_id": 1}}}}
+]}}
+
+User: "total exports by port"
+{{"collection": "trades", "pipeline": [
+  {{"$match": {{"trade_type": "Export"}}}},
+  {{"$group": {{"_id": "$port", "total_usd": {{"$sum": "$value_usd"}}}}}},
+  {{"$sort": {{"total_usd": -1}}}}
+]}}
+
+ALWAYS generate only valid JSON using double quotes. Only allowed values for "collection" are: trades, impexp, countries, commodities, years. Ignore any unrelated collections or fields.  
+Now, output the JSON query object for this (verbatim) user request:
+"""
+
+
+def prompt_examples() -> list:
+    """(question, query JSON text) pairs from the prompt's EXAMPLES section."""
+    text = SCHEMA_PROMPT_TEMPLATE.replace("{{", "{").replace("}}", "}")
+    return re.findall(r'^User: "([^"\n]+)"\n(\{.*?\]\})$', text, re.M | re.S)
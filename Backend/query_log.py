@@ -0,0 +1,219 @@
+"""
+Persisted query popularity log and a cache warmer driven by it.
+
+Every restart or deploy starts with empty generation and result caches,
+so the first users after it pay the full LLM and aggregation latency for
+the same dashboard questions that were answered minutes before.
+
+- QueryLog appends one compact JSON line per answered query (normalized
+  text, canonical query JSON, latency) to QUERY_LOG_PATH, and keeps
+  per-query frequency in memory. On startup it is compacted to one line
+  per query, so the file stays proportional to distinct questions.
+- CacheWarmer takes the top-K queries by frequency plus the prompt's
+  built-in examples and warms each one through warm_fn, at startup and
+  every WARMUP_INTERVAL_SECONDS, rate limited so live traffic comes first.
+  snapshot() reports how many of those queries are currently warm.
+"""
+import os
+import json
+import time
+import threading
+from admission import TokenBucket
+from response_cache import canonical_json
+from speculation import normalize_query
+
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH", os.path.join(os.path.dirname(__file__), ".query_log.jsonl"))
+# Distinct queries kept when the log is compacted.
+MAX_ENTRIES = int(os.getenv("QUERY_LOG_MAX_ENTRIES", 5000))
+WARMUP_TOP_K = int(os.getenv("WARMUP_TOP_K", 50))
+WARMUP_PER_MINUTE = int(os.getenv("WARMUP_PER_MINUTE", 30))
+WARMUP_INTERVAL_SECONDS = int(os.getenv("WARMUP_INTERVAL_SECONDS", 900))
+
+
+class QueryLog:
+    """Append-only JSONL log; entries aggregates it per normalized query."""
+
+    def __init__(self, path=QUERY_LOG_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}   # key -> {"key", "query", "query_data", "count", "ms", "ts"}
+
+    @staticmethod
+    def _merge(entries, record):
+        entry = entries.get(record["key"])
+        count = record.get("count", 1)
+        if entry is None:
+            entries[record["key"]] = {**record, "count": count}
+            return
+        # Running mean latency; the newest query text and pipeline win.
+        entry["ms"] = (entry["ms"] * entry["count"] + record["ms"] * count) / (entry["count"] + count)
+        entry["count"] += count
+        if record["ts"] >= entry["ts"]:
+            entry.update(query=record["query"], query_data=record["query_data"], ts=record["ts"])
+
+    def load(self):
+        """Rebuilds the in-memory counts from the file (all workers append to it)."""
+        entries = {}
+        lines = 0
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        self._merge(entries, json.loads(line))
+                        lines += 1
+                    except (ValueError, KeyError):
+                        continue   # a torn last line after a crash
+        except OSError:
+            pass
+        with self.lock:
+            self.entries = entries
+        return lines
+
+    def record(self, user_query, query_data, latency_seconds):
+        record = {
+            "key": normalize_query(user_query),
+            "query": user_query,
+            "query_data": query_data,
+            "ms": round(latency_seconds * 1000),
+            "ts": round(time.time()),
+        }
+        line = canonical_json(record) + "\n"
+        with self.lock:
+            # Merge the decoded line, so memory holds exactly what the file does.
+            self._merge(self.entries, json.loads(line))
+            try:
+                # One short write per line in append mode: workers do not interleave.
+                with open(self.path, "a") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"--- Could not append to query log: {e}")
+
+    def compact(self, max_entries=MAX_ENTRIES):
+        """Rewrites the file as one line per query (the most frequent max_entries)."""
+        lines = self.load()
+        with self.lock:
+            kept = self._top(max_entries)
+            if lines <= len(kept):
+                return
+            temporary = f"{self.path}.tmp"
+            try:
+                with open(temporary, "w") as f:
+                    for entry in kept:
+                        f.write(canonical_json(entry) + "\n")
+                os.replace(temporary, self.path)
+            except OSError as e:
+                print(f"--- Could not compact query log: {e}")
+                return
+            self.entries = {entry["key"]: entry for entry in kept}
+        print(f"--- Query log compacted: {lines} line(s) -> {len(kept)} query(ies)")
+
+    def _top(self, k):
+        return sorted(self.entries.values(), key=lambda e: (-e["count"], -e["ts"]))[:k]
+
+    def top(self, k):
+        """The k most frequent queries, most recent first on ties."""
+        with self.lock:
+            return self._top(k)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CacheWarmer:
+    """
+    Periodically warms the most frequent logged queries and the fixed
+    examples. warm_fn(user_query, query_data_or_None) generates (reusing
+    query_data when it still validates) and executes one query;
+    is_warm(user_query) checks both caches without doing any work.
+    """
+
+    def __init__(self, log, warm_fn, is_warm, examples=(), top_k=WARMUP_TOP_K,
+                 per_minute=WARMUP_PER_MINUTE, interval_seconds=WARMUP_INTERVAL_SECONDS):
+        self.log = log
+        self.warm_fn = warm_fn
+        self.is_warm = is_warm
+        self.examples = list(examples)   # [(user_query, query_data or None)]
+        self.top_k = top_k
+        self.bucket = TokenBucket(per_minute)
+        self.interval_seconds = interval_seconds
+        self._stop = threading.Event()
+        self._thread = None
+        self.running = False
+        self.stats = {"runs": 0, "warmed": 0, "already_warm": 0, "failed": 0, "last_run": None,
+                      "last_run_seconds": None}
+
+    def candidates(self):
+        chosen = {}
+        for entry in self.log.top(self.top_k):
+            chosen.setdefault(entry["key"], (entry["query"], entry["query_data"]))
+        for user_query, query_data in self.examples:
+            chosen.setdefault(normalize_query(user_query), (user_query, query_data))
+        return list(chosen.values())
+
+    def _wait_for_token(self):
+        while not self._stop.is_set():
+            wait = self.bucket.wait_time(1)
+            if wait == 0.0:
+                self.bucket.take(1)
+                return True
+            self._stop.wait(wait)
+        return False
+
+    def run_once(self):
+        started = time.perf_counter()
+        self.running = True
+        try:
+            for user_query, query_data in self.candidates():
+                if self.is_warm(user_query):
+                    self.stats["already_warm"] += 1
+                    continue
+                if not self._wait_for_token():
+                    return
+                try:
+                    if self.warm_fn(user_query, query_data):
+                        self.stats["warmed"] += 1
+                    else:
+                        self.stats["failed"] += 1
+                except Exception as e:
+                    self.stats["failed"] += 1
+                    print(f"--- Warm-up of '{user_query}' failed: {e}")
+        finally:
+            self.running = False
+            self.stats["runs"] += 1
+            self.stats["last_run"] = round(time.time())
+            self.stats["last_run_seconds"] = round(time.perf_counter() - started, 2)
+        print(f"--- Cache warm-up done in {self.stats['last_run_seconds']}s: {self.snapshot()['warmth']}")
+
+    def start(self):
+        """Warms now and then every interval, on a daemon thread."""
+        self._stop = threading.Event()
+
+        def loop():
+            while not self._stop.is_set():
+                self.log.load()
+                self.run_once()
+                self._stop.wait(self.interval_seconds)
+
+        self._thread = threading.Thread(target=loop, name="cache-warmup", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Signals the thread to exit; with a timeout, also waits for it (before
+        fork). Returns False if the thread is still running afterwards.
+        """
+        self._stop.set()
+        if timeout is not None and self._thread is not None:
+            self._thread.join(timeout)
+        return self._thread is None or not self._thread.is_alive()
+
+    def snapshot(self):
+        candidates = self.candidates()
+        warm = sum(1 for user_query, _ in candidates if self.is_warm(user_query))
+        return {
+            **self.stats,
+            "running": self.running,
+            "logged_queries": len(self.log),
+            "warmth": {"warm": warm, "candidates": len(candidates),
+                       "ratio": round(warm / len(candidates), 3) if candidates else None},
+        }
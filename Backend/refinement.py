@@ -0,0 +1,268 @@
+"""
+Incremental conversational refinement of the previous query.
+
+Follow-ups like "now only 2023", "just the top 3" or "imports instead" used
+to trigger a brand-new full-prompt generation. Here each session keeps its
+last query, pipeline and result fingerprint; follow-ups are parsed locally
+into small pipeline edits, applied to the previous pipeline, and answered
+from the cached previous rows when the edit can be evaluated on them.
+Anything the parser does not understand falls back to a short "edit this
+pipeline" prompt instead of the full schema prompt.
+"""
+import re
+import copy
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from partitioning import sort_key
+
+MAX_SESSIONS = 1000
+SESSION_TTL_SECONDS = 30 * 60
+# Rows larger than this are not kept for local refinement.
+MAX_CACHED_ROWS = 5000
+
+FOLLOWUP_RE = re.compile(r"^(now|only|just|and|but|what about|how about|instead|same|then|make it|show only)\b", re.I)
+YEAR_RE = re.compile(r"\b(20\d{2}|19\d{2})\b")
+TOP_RE = re.compile(r"\b(?:top|first|bottom|last)\s+(\d+)\b", re.I)
+# Grouping and dimension words the local edits cannot express ("and the top
+# 5 ports" needs a new $group): any of them, unless already in the previous
+# question, sends the follow-up to the LLM edit prompt.
+DIMENSION_RE = re.compile(
+    r"\b(by|per|each|group(?:ed)?|breakdown|split|ports?|countr(?:y|ies)|commodit(?:y|ies)|products?|"
+    r"categor(?:y|ies)|partners?|destinations?|origins?|months?|monthly|quarters?|quarterly|daily|weekly|"
+    r"yearly|annual|average|avg|mean|count|number|share|percent(?:age)?|growth|trend)\b", re.I)
+WORD_NUMBERS = {"one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6,
+                "seven": 7, "eight": 8, "nine": 9, "ten": 10}
+TOP_WORD_RE = re.compile(r"\b(?:top|first|bottom|last)\s+(" + "|".join(WORD_NUMBERS) + r")\b", re.I)
+
+# Row-level stages: the output rows are a filtered/sorted view of the input,
+# so filtering the cached rows gives the same answer as re-running Mongo.
+ROW_LEVEL_STAGES = {"$match", "$lookup", "$unwind", "$project", "$addFields", "$set", "$sort"}
+
+TRADE_TYPE_FIELDS = {
+    "trades": ("trade_type", {"export": "Export", "import": "Import"}),
+    "impexp": ("import_export_quantity_in_000_metric_tonnes", {"export": "EXPORT", "import": "IMPORT"}),
+}
+
+
+def result_fingerprint(results):
+    return hashlib.sha1(json.dumps(results, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class QueryStateStore:
+    """Session -> last query state, bounded (LRU) and expiring."""
+
+    def __init__(self, max_sessions=MAX_SESSIONS, ttl_seconds=SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.states = OrderedDict()
+
+    def get(self, session):
+        with self.lock:
+            state = self.states.get(session)
+            if state is None or time.monotonic() - state["at"] > self.ttl_seconds:
+                self.states.pop(session, None)
+                return None
+            self.states.move_to_end(session)
+            return state
+
+    def put(self, session, user_query, query_data, results, version=None):
+        """results may be None (e.g. a revalidated 304); follow-ups then re-run the edited pipeline."""
+        state = {
+            "query": user_query,
+            "query_data": copy.deepcopy(query_data),
+            "version": version,
+            "fingerprint": result_fingerprint(results) if results is not None else None,
+            "results": results if results is not None and len(results) <= MAX_CACHED_ROWS else None,
+            "at": time.monotonic(),
+        }
+        with self.lock:
+            self.states[session] = state
+            self.states.move_to_end(session)
+            while len(self.states) > self.max_sessions:
+                self.states.popitem(last=False)
+
+
+# --- Local follow-up parser ---
+def looks_like_followup(text, previous):
+    """
+    Only explicit follow-up phrasing, and only in a session with a previous
+    query: a short fresh question ("only exports to china") must not edit
+    anything.
+    """
+    if not previous or not previous.get("query_data"):
+        return False
+    text = text.strip()
+    return bool(FOLLOWUP_RE.match(text)) or text.lower().rstrip(".?!").endswith("instead")
+
+
+def _unhandled(text, previous_query, mentions):
+    """Entities or dimension words in text that the previous question did not already name."""
+    previous = previous_query.lower()
+
+    def new(phrase):
+        return re.search(rf"\b{re.escape(phrase.lower())}\b", previous) is None
+
+    # Years are the one entity the parser edits itself.
+    entities = [name for collection, name in mentions if collection != "years" and new(name)]
+    words = [match.group(0) for match in DIMENSION_RE.finditer(text) if new(match.group(0))]
+    return entities + words
+
+
+def parse_followup(text, collection, previous_query="", mentions=()):
+    """
+    Returns a list of edits like {"op": "year", "value": 2023}, or None if
+    the follow-up needs more than the parser can express. mentions are the
+    (collection, name) entities found in text (EntityIndex.mentions). A new
+    entity ("what about china") or grouping ("and the top 5 ports") returns
+    None: applying only the recognised part would answer a different
+    question. Only edits valid for the collection are returned.
+    """
+    if _unhandled(text, previous_query, mentions):
+        return None
+    lowered = text.lower()
+    edits = []
+    year = YEAR_RE.search(lowered)
+    if year and collection == "trades":
+        edits.append({"op": "year", "value": int(year.group(1))})
+    top = TOP_RE.search(lowered) or TOP_WORD_RE.search(lowered)
+    if top:
+        count = top.group(1)
+        edits.append({"op": "limit", "value": int(count) if count.isdigit() else WORD_NUMBERS[count.lower()]})
+    if re.search(r"\b(bottom|lowest|least|smallest|ascending)\b", lowered):
+        edits.append({"op": "sort", "value": 1})
+    elif re.search(r"\b(highest|largest|biggest|descending)\b", lowered):
+        edits.append({"op": "sort", "value": -1})
+    if collection in TRADE_TYPE_FIELDS:
+        field, values = TRADE_TYPE_FIELDS[collection]
+        kinds = [kind for kind in ("export", "import") if re.search(rf"\b{kind}s?\b", lowered)]
+        if len(kinds) == 1:
+            edits.append({"op": "trade_type", "field": field, "value": values[kinds[0]]})
+    return edits or None
+
+
+# --- Pipeline edits ---
+def _first_shape_change(pipeline):
+    for index, stage in enumerate(pipeline):
+        if next(iter(stage)) not in ROW_LEVEL_STAGES - {"$sort", "$project"}:
+            return index
+    return len(pipeline)
+
+
+def _year_alias(pipeline):
+    for stage in pipeline:
+        body = stage.get("$lookup")
+        if isinstance(body, dict) and body.get("from") == "years":
+            return body.get("as")
+    return None
+
+
+def apply_edits(query_data, edits):
+    """Returns a new query_data with the edits applied to the previous pipeline."""
+    query_data = copy.deepcopy(query_data)
+    pipeline = query_data["pipeline"]
+    for edit in edits:
+        if edit["op"] == "year":
+            alias = _year_alias(pipeline)
+            key = f"{alias}.year" if alias else "year_doc.year"
+            for stage in pipeline:
+                if key in stage.get("$match", {}):
+                    stage["$match"][key] = edit["value"]
+                    break
+            else:
+                at = _first_shape_change(pipeline)
+                stages = [{"$match": {key: edit["value"]}}]
+                if alias is None:
+                    stages = [
+                        {"$lookup": {"from": "years", "localField": "year_id", "foreignField": "_id", "as": "year_doc"}},
+                        {"$unwind": "$year_doc"},
+                    ] + stages
+                pipeline[at:at] = stages
+        elif edit["op"] == "trade_type":
+            for stage in pipeline:
+                if edit["field"] in stage.get("$match", {}):
+                    stage["$match"][edit["field"]] = edit["value"]
+                    break
+            else:
+                pipeline.insert(0, {"$match": {edit["field"]: edit["value"]}})
+        elif edit["op"] == "limit":
+            for stage in pipeline:
+                if "$limit" in stage:
+                    stage["$limit"] = edit["value"]
+                    break
+            else:
+                pipeline.append({"$limit": edit["value"]})
+        elif edit["op"] == "sort":
+            for stage in pipeline:
+                if "$sort" in stage:
+                    stage["$sort"] = {key: edit["value"] for key in stage["$sort"]}
+    return query_data
+
+
+def _get_path(row, path):
+    for part in path.split("."):
+        if not isinstance(row, dict) or part not in row:
+            return None
+        row = row[part]
+    return row
+
+
+def local_result(previous, edits):
+    """
+    Evaluates the edits on the cached previous rows when that is provably
+    equivalent to re-running the edited pipeline. Returns rows or None.
+    """
+    rows = previous.get("results")
+    if rows is None:
+        return None
+    pipeline = previous["query_data"]["pipeline"]
+    stages = [next(iter(stage)) for stage in pipeline]
+    has_limit = "$limit" in stages
+    row_level = all(stage in ROW_LEVEL_STAGES for stage in stages)
+    sort_keys = next((list(stage["$sort"]) for stage in pipeline if "$sort" in stage), [])
+    matched = {key for stage in pipeline for key in stage.get("$match", {})}
+    rows = list(rows)
+    # Filters first, then ordering, then truncation - the order Mongo would apply them.
+    order = {"year": 0, "trade_type": 0, "sort": 1, "limit": 2}
+    for edit in sorted(edits, key=lambda e: order[e["op"]]):
+        if edit["op"] in ("year", "trade_type"):
+            path = edit.get("field") or f"{_year_alias(pipeline) or 'year_doc'}.year"
+            # Only narrowing is safe: swapping an existing filter needs rows we never fetched.
+            if path in matched or not row_level:
+                return None
+            if any(_get_path(row, path) is None for row in rows):
+                return None
+            rows = [row for row in rows if _get_path(row, path) == edit["value"]]
+        elif edit["op"] == "sort":
+            if has_limit or not sort_keys:
+                return None
+            if rows and _get_path(rows[0], sort_keys[0]) is None:
+                return None
+            # MongoDB order, so missing values and mixed types sort instead of raising.
+            rows.sort(key=sort_key({sort_keys[0]: edit["value"]}))
+        elif edit["op"] == "limit":
+            # Shrinking an existing result is safe; growing past the old limit is not.
+            previous_limit = next((stage["$limit"] for stage in pipeline if "$limit" in stage), None)
+            if previous_limit is not None and edit["value"] > previous_limit:
+                return None
+            rows = rows[:edit["value"]]
+    return rows
+
+
+def build_edit_prompt(previous, followup, schema_fields):
+    """Short 'edit this pipeline' prompt for follow-ups the local parser missed."""
+    collection = previous["query_data"]["collection"]
+    return f"""You are editing an existing MongoDB aggregation for the 'Trade' database.
+
+Previous question: "{previous['query']}"
+Previous query JSON:
+{json.dumps(previous['query_data'])}
+
+Fields of '{collection}': {', '.join(schema_fields)}
+
+Apply this follow-up with the smallest change to the pipeline: "{followup}"
+Return ONLY the edited JSON object with keys "collection" and "pipeline".
+"""
@@ -0,0 +1,193 @@
+"""
+ETag / conditional-GET support and negotiated compression for query results.
+
+A result is identified by its canonical pipeline plus the data version of
+the collections it reads, so the ETag can be computed before touching
+MongoDB: a matching If-None-Match returns 304 without executing or
+serializing anything. Serialized bodies are cached per ETag together with
+each compressed variant, so repeated requests also skip JSON encoding and
+compression.
+
+br and zstd come from the brotli and zstandard packages listed in
+requirements.txt; if either is missing that encoding is simply not offered
+and clients fall back to gzip.
+"""
+import os
+import gzip
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Bodies smaller than this are sent uncompressed: the header overhead wins.
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 1024))
+BODY_CACHE_BYTES = int(os.getenv("BODY_CACHE_BYTES", 64 * 1024 * 1024))
+GENERATION_CACHE_ENTRIES = int(os.getenv("GENERATION_CACHE_ENTRIES", 5000))
+
+# Server preference when the client accepts several encodings equally.
+ENCODERS = {"gzip": lambda body: gzip.compress(body, compresslevel=6)}
+if brotli is not None:
+    ENCODERS["br"] = lambda body: brotli.compress(body, quality=5)
+if zstandard is not None:
+    ENCODERS["zstd"] = lambda body: zstandard.ZstdCompressor(level=6).compress(body)
+PREFERENCE = ["zstd", "br", "gzip"]
+
+
+def canonical_json(value):
+    """Key-order and whitespace independent JSON (ObjectIds as strings)."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+
+
+def make_etag(query_data, data_version, user_query=""):
+    digest = hashlib.sha256()
+    digest.update(canonical_json(query_data).encode())
+    digest.update(canonical_json(data_version).encode())
+    digest.update(user_query.encode())
+    return f'"{digest.hexdigest()[:32]}"'
+
+
+def encoded_etag(etag, encoding):
+    """
+    The strong ETag of one content-coding of a result: the compressed bytes
+    differ from the identity ones, so they get their own validator.
+    """
+    return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+def revalidate(if_none_match, etag, encoding, body=None):
+    """
+    The ETag to answer 304 with, or None. With the body cached, only the
+    variant that would be served counts. Without it, the client may hold the
+    identity or the negotiated variant, and either is current.
+    """
+    if body is not None:
+        candidates = [encoded_etag(etag, body.encoding_for(encoding))]
+    else:
+        candidates = [encoded_etag(etag, encoding), etag]
+    return next((candidate for candidate in candidates if etag_matches(if_none_match, candidate)), None)
+
+
+def negotiate_encoding(accept_encoding):
+    """Picks the best available encoding from an Accept-Encoding header, or None."""
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        weights[name.strip().lower()] = quality
+    candidates = [name for name in PREFERENCE if name in ENCODERS and weights.get(name, weights.get("*", 0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda name: (weights.get(name, weights.get("*", 0)), -PREFERENCE.index(name)))
+
+
+class LRUCache:
+    """Thread-safe LRU bounded by entry count and, optionally, total size."""
+
+    def __init__(self, max_entries=None, max_bytes=None, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof or (lambda value: 0)
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.bytes -= self.sizeof(old)
+            self.items[key] = value
+            self.bytes += size
+            while ((self.max_entries is not None and len(self.items) > self.max_entries)
+                   or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                _, evicted = self.items.popitem(last=False)
+                self.bytes -= self.sizeof(evicted)
+
+    def peek(self, key):
+        """Like get, without touching recency or hit counts."""
+        with self.lock:
+            return self.items.get(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+
+class CachedBody:
+    """One serialized result plus lazily built compressed variants."""
+
+    def __init__(self, body, rows):
+        self.rows = rows
+        self.variants = {None: body}
+        self.lock = threading.Lock()
+
+    def encoding_for(self, encoding):
+        """The encoding actually used for a negotiated one: small bodies stay uncompressed."""
+        return None if len(self.variants[None]) < COMPRESS_MIN_BYTES else encoding
+
+    def encoded(self, encoding):
+        """Returns (bytes, encoding_used); small bodies stay uncompressed."""
+        identity = self.variants[None]
+        encoding = self.encoding_for(encoding)
+        if encoding is None:
+            return identity, None
+        with self.lock:
+            if encoding not in self.variants:
+                self.variants[encoding] = ENCODERS[encoding](identity)
+            return self.variants[encoding], encoding
+
+    def size(self):
+        # Stable estimate for LRU accounting: the compressed variants together
+        # are smaller than the identity body, and the rows about as large.
+        return 3 * len(self.variants[None])
+
+
+# Normalized query text -> generated {"collection", "pipeline"}: repeats skip the LLM.
+generated_queries = LRUCache(max_entries=GENERATION_CACHE_ENTRIES)
+# ETag -> CachedBody: repeats skip execution, serialization and compression.
+result_bodies = LRUCache(max_bytes=BODY_CACHE_BYTES, sizeof=lambda entry: entry.size())
+# Normalized query text -> latest CachedBody whatever its data version; served
+# (marked stale) when the LLM queue is saturated.
+stale_results = LRUCache(max_bytes=BODY_CACHE_BYTES // 4, sizeof=lambda entry: entry.size())
@@ -0,0 +1,239 @@
+"""
+Cached schema introspection for the 'Trade' database.
+
+The schema used to be hand-copied into every prompt, and the copies drifted
+apart. This module samples each collection, infers field names, coarse types
+and small value domains (e.g. trade_type in {Export, Import}, the impexp
+product list), and keeps the result under a content hash. The compact
+summary feeds the prompt builder and the per-field types feed
+pipeline_validator, so both always agree with the data.
+"""
+import os
+import re
+import json
+import hashlib
+import datetime
+import threading
+from collections import Counter
+
+from bson import ObjectId
+
+from pipeline_validator import COLLECTION_SCHEMAS
+
+COLLECTIONS = ["trades", "countries", "commodities", "years", "impexp"]
+
+# Relationships are not discoverable from samples, so they stay declared here.
+RELATIONSHIPS = {
+    "trades": {"country_id": "countries", "commodity_id": "commodities", "year_id": "years"},
+}
+
+SAMPLE_SIZE = int(os.getenv("SCHEMA_SAMPLE_SIZE", 500))
+# A string/number field is summarised as a value domain if it has at most this many distinct values.
+MAX_DOMAIN_VALUES = int(os.getenv("SCHEMA_MAX_DOMAIN_VALUES", 40))
+CACHE_PATH = os.getenv("SCHEMA_CACHE_PATH", os.path.join(os.path.dirname(__file__), ".schema_cache.json"))
+
+ISO_DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?$")
+# Free-text fields never get a domain even when the sample is small.
+FREE_TEXT_FIELDS = {"description"}
+
+
+def _value_type(value):
+    if isinstance(value, ObjectId):
+        return "objectId"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, (int, float)):
+        return "number"
+    if isinstance(value, datetime.datetime):
+        return "date"
+    if isinstance(value, str):
+        return "isoDateString" if ISO_DATE_RE.match(value) else "string"
+    if isinstance(value, dict):
+        return "object"
+    if isinstance(value, list):
+        return "array"
+    return "null" if value is None else type(value).__name__
+
+
+def profile_documents(documents):
+    """
+    Infers {"fields": {name: {"type", "values"?, "min"?, "max"?}}} from a
+    list of sample documents. Only top-level fields are profiled.
+    """
+    types = {}
+    values = {}
+    for doc in documents:
+        for name, value in doc.items():
+            types.setdefault(name, Counter())[_value_type(value)] += 1
+            if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                values.setdefault(name, Counter())[value] += 1
+
+    fields = {}
+    for name, counter in types.items():
+        non_null = [t for t, _ in counter.most_common() if t != "null"]
+        field_type = non_null[0] if non_null else "null"
+        info = {"type": field_type}
+        seen = values.get(name)
+        if seen and field_type == "number":
+            info["min"], info["max"] = min(seen), max(seen)
+        if (seen and field_type in ("string", "number") and name not in FREE_TEXT_FIELDS
+                and len(seen) <= MAX_DOMAIN_VALUES and len(seen) < len(documents)):
+            info["values"] = sorted(seen)
+        fields[name] = info
+    return {"fields": fields, "sampled": len(documents)}
+
+
+def _validator_type(field_type):
+    # pipeline_validator only distinguishes what it needs for coercion/paths.
+    return {"isoDateString": "string"}.get(field_type, field_type)
+
+
+def render_summary(profiles):
+    """Compact one-line-per-collection schema text for the prompt."""
+    lines = []
+    for name in COLLECTIONS:
+        profile = profiles.get(name)
+        if not profile:
+            continue
+        relations = RELATIONSHIPS.get(name, {})
+        parts = []
+        for field, info in profile["fields"].items():
+            if field == "_id":
+                continue
+            text = f"{field} ({info['type']}"
+            if field in relations:
+                text += f" -> {relations[field]}._id"
+            elif "values" in info and (info["type"] == "string" or len(info["values"]) <= 12):
+                text += ": " + "|".join(json.dumps(v) for v in info["values"])
+            elif "min" in info:
+                text += f", {info['min']}..{info['max']}"
+            parts.append(text + ")")
+        lines.append(f"- {name}: _id, " + ", ".join(parts))
+    return "\n".join(lines)
+
+
+def _static_profiles():
+    """Fallback profiles built from the declared schemas when Mongo is unavailable."""
+    return {
+        name: {"fields": {field: {"type": field_type} for field, field_type in fields.items()}, "sampled": 0}
+        for name, fields in COLLECTION_SCHEMAS.items()
+    }
+
+
+class SchemaCache:
+    """
+    Holds the introspected profiles, the derived prompt summary and
+    validator schemas, keyed by a content hash. refresh() only re-samples
+    collections whose (count, max _id) fingerprint changed.
+    """
+
+    def __init__(self, db, cache_path=CACHE_PATH, sample_size=SAMPLE_SIZE):
+        self.db = db
+        self.cache_path = cache_path
+        self.sample_size = sample_size
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        self.profiles = _static_profiles()
+        self.content_hash = None
+        self.summary = ""
+        self.schemas = {}
+        # Callables run after a refresh that sampled changed data.
+        self.on_change = []
+        self._stop = threading.Event()
+        self._thread = None
+        self._load()
+        self._rebuild()
+
+    # --- persistence ---
+    def _load(self):
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            self.profiles.update(cached["profiles"])
+            self.fingerprints = cached.get("fingerprints", {})
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save(self):
+        try:
+            with open(self.cache_path, "w") as f:
+                json.dump({"hash": self.content_hash, "fingerprints": self.fingerprints,
+                           "profiles": self.profiles}, f, default=str)
+        except OSError as e:
+            print(f"--- Could not write schema cache: {e}")
+
+    def _rebuild(self):
+        """Recomputes derived views only when the profile content changed."""
+        content_hash = hashlib.sha256(json.dumps(self.profiles, sort_keys=True, default=str).encode()).hexdigest()
+        if content_hash == self.content_hash:
+            return False
+        schemas = {}
+        for name, profile in self.profiles.items():
+            # Declared fields stay valid even if a sparse field was missed by the sample.
+            schemas[name] = dict(COLLECTION_SCHEMAS.get(name, {"_id": "objectId"}))
+            schemas[name].update({field: _validator_type(info["type"]) for field, info in profile["fields"].items()})
+        self.schemas = schemas
+        self.summary = render_summary(self.profiles)
+        self.content_hash = content_hash
+        return True
+
+    # --- introspection ---
+    def _fingerprint(self, collection):
+        last = collection.find_one(sort=[("_id", -1)], projection={"_id": 1})
+        return [collection.estimated_document_count(), str(last["_id"]) if last else None]
+
+    def refresh(self, force=False):
+        """Re-samples changed collections. Returns True if the schema changed."""
+        changed = False
+        for name in COLLECTIONS:
+            try:
+                collection = self.db.get_collection(name)
+                fingerprint = self._fingerprint(collection)
+                if not force and self.fingerprints.get(name) == fingerprint:
+                    continue
+                sample = list(collection.aggregate([{"$sample": {"size": self.sample_size}}]))
+            except Exception as e:
+                print(f"--- Schema introspection skipped '{name}': {e}")
+                continue
+            if not sample:
+                continue
+            with self.lock:
+                self.profiles[name] = profile_documents(sample)
+                self.fingerprints[name] = fingerprint
+            changed = True
+        if changed:
+            with self.lock:
+                changed = self._rebuild()
+            self._save()
+        if changed:
+            # Listeners see the new summary and hash; a re-sample with the same content notifies no one.
+            for callback in self.on_change:
+                try:
+                    callback()
+                except Exception as e:
+                    print(f"--- Schema change callback failed: {e}")
+        return changed
+
+    def start(self, interval_seconds=300, refresh_now=True):
+        """Refreshes once now, then every interval_seconds on a daemon thread."""
+        if refresh_now:
+            self.refresh()
+        self._stop = threading.Event()
+
+        def loop():
+            while not self._stop.wait(interval_seconds):
+                if self.refresh():
+                    print(f"--- Schema changed, new hash {self.content_hash[:12]}")
+
+        self._thread = threading.Thread(target=loop, name="schema-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Signals the thread to exit; with a timeout, also waits for it (before
+        fork). Returns False if the thread is still running afterwards.
+        """
+        self._stop.set()
+        if timeout is not None and self._thread is not None:
+            self._thread.join(timeout)
+        return self._thread is None or not self._thread.is_alive()
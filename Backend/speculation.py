@@ -0,0 +1,153 @@
+"""
+Speculative query generation from partial voice transcripts.
+
+The STT proxy posts every changed partial transcript for a voice session.
+Once a partial has been stable for STABLE_MS, generation (and optionally
+execution) starts in the background. When the final query arrives at
+/api/trade/query, a finished or in-flight job for the same normalized text
+is reused instead of starting a new multi-second LLM call, but only for up
+to TAKE_WAIT_SECONDS; after that the request generates normally. Jobs for
+text the user kept talking past are cancelled or simply left to expire.
+
+Jobs are keyed by normalized text but generate from the transcript as
+spoken. Partials run as batch work; a final transcript runs (or is
+resubmitted, if its job has not started yet) at interactive priority.
+Text already taken by a query is not speculated on again when the proxy's
+final POST arrives late.
+"""
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+
+STABLE_MS = int(os.getenv("SPECULATION_STABLE_MS", 600))
+JOB_TTL_SECONDS = int(os.getenv("SPECULATION_TTL_SECONDS", 30))
+MAX_WORKERS = int(os.getenv("SPECULATION_WORKERS", 4))
+# How long a query waits for an unfinished speculative job before generating itself.
+TAKE_WAIT_SECONDS = float(os.getenv("SPECULATION_TAKE_WAIT_SECONDS", 3))
+# Partials shorter than this rarely form a complete question.
+MIN_WORDS = 2
+
+
+def normalize_query(text):
+    """Formatted finals ("Exports from India.") and raw partials must compare equal."""
+    text = re.sub(r"[^\w\s]", " ", text.lower())
+    return " ".join(text.split())
+
+
+class Speculator:
+    """
+    Per-session stability timers plus a table of speculative jobs keyed by
+    normalized query text. job_fn(transcript, final) runs on a small thread
+    pool; final is True once the transcript is final.
+    """
+
+    def __init__(self, job_fn, stable_ms=STABLE_MS, ttl_seconds=JOB_TTL_SECONDS):
+        self.job_fn = job_fn
+        self.stable_seconds = stable_ms / 1000
+        self.ttl_seconds = ttl_seconds
+        self.pool = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="speculate")
+        self.lock = threading.Lock()
+        self.sessions = {}   # session -> {"text", "timer", "job", "seen"}
+        self.jobs = {}       # normalized text -> (future, created_at, final)
+        self.taken = {}      # normalized text -> when a query took it
+        self.stats = {"started": 0, "reused": 0, "cancelled": 0, "expired": 0, "promoted": 0,
+                      "skipped": 0, "timed_out": 0}
+
+    def observe(self, session, transcript, final=False):
+        """Records a partial (or final) transcript for a voice session."""
+        text = normalize_query(transcript)
+        if len(text.split()) < MIN_WORDS:
+            return
+        with self.lock:
+            if text in self.taken:
+                # The query already arrived (the final POST came late): nobody would use the job.
+                self.stats["skipped"] += 1
+                return
+            state = self.sessions.setdefault(session, {"text": None, "timer": None, "job": None})
+            state["seen"] = time.monotonic()
+            if state["text"] == text and not final:
+                return
+            if state["timer"] is not None:
+                state["timer"].cancel()
+            state["text"] = text
+            if final:
+                state["timer"] = None
+                self._start(session, text, transcript, final=True)
+            else:
+                timer = threading.Timer(self.stable_seconds, self._on_stable, args=(session, text, transcript))
+                timer.daemon = True
+                state["timer"] = timer
+                timer.start()
+
+    def _on_stable(self, session, text, transcript):
+        with self.lock:
+            state = self.sessions.get(session)
+            if state is not None and state["text"] == text:
+                self._start(session, text, transcript)
+
+    def _start(self, session, text, transcript, final=False):
+        # Caller holds self.lock.
+        self._expire()
+        state = self.sessions[session]
+        previous = state["job"]
+        if previous is not None and previous != text and previous in self.jobs:
+            # The user kept talking: the older speculation will not be needed.
+            if self.jobs[previous][0].cancel():
+                del self.jobs[previous]
+                self.stats["cancelled"] += 1
+        state["job"] = text
+        existing = self.jobs.get(text)
+        if existing is not None and final and not existing[2] and existing[0].cancel():
+            # Queued as batch work and not started yet: run it as interactive instead.
+            existing = None
+            self.stats["promoted"] += 1
+        if existing is None:
+            self.jobs[text] = (self.pool.submit(self.job_fn, transcript, final), time.monotonic(), final)
+            self.stats["started"] += 1
+            print(f"--- Speculating on '{transcript}' (session {session}{', final' if final else ''})")
+
+    def _expire(self):
+        now = time.monotonic()
+        for text, (future, created, _) in list(self.jobs.items()):
+            if now - created > self.ttl_seconds:
+                future.cancel()
+                del self.jobs[text]
+                self.stats["expired"] += 1
+        for text, taken in list(self.taken.items()):
+            if now - taken > self.ttl_seconds:
+                del self.taken[text]
+        for session, state in list(self.sessions.items()):
+            if now - state["seen"] > self.ttl_seconds:
+                del self.sessions[session]
+
+    def take(self, user_query, timeout=TAKE_WAIT_SECONDS):
+        """
+        Returns the speculative result for user_query if one was started,
+        waiting up to timeout for it if it is still running; otherwise None.
+        """
+        text = normalize_query(user_query)
+        with self.lock:
+            self._expire()
+            self.taken[text] = time.monotonic()
+            entry = self.jobs.pop(text, None)
+            for session, state in list(self.sessions.items()):
+                if state["job"] == text:
+                    del self.sessions[session]
+        if entry is None:
+            return None
+        try:
+            result = entry[0].result(timeout=timeout)
+        except FuturesTimeout:
+            # Still queued or generating: the caller generates itself rather than wait longer.
+            entry[0].cancel()
+            self.stats["timed_out"] += 1
+            print(f"--- Speculative job for '{text}' not ready after {timeout}s")
+            return None
+        except Exception as e:  # includes CancelledError
+            print(f"--- Speculative job for '{text}' unusable: {e}")
+            return None
+        if result is not None:
+            self.stats["reused"] += 1
+        return result
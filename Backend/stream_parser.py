@@ -0,0 +1,181 @@
+"""
+Incremental parser for a streamed {"collection": ..., "pipeline": [...]} answer.
+
+Generation used to be all-or-nothing: the server waited for the full
+completion, then json.loads'd it. With streaming completions, feed() takes
+each chunk as it arrives and returns events as soon as they are known:
+
+- ("collection", name)   the collection value is complete (name as the
+                         validator will repair it, e.g. "Trades" -> "trades");
+- ("stage", i, stage)    pipeline stage i is complete (parsed JSON);
+- ("pipeline", stages)   the pipeline array is closed;
+
+so the caller can start preparing execution while the model is still
+writing. The moment the output can no longer become a valid query -
+broken JSON structure, text outside the object, an unknown collection, a
+stage that is not an object or not an allowed stage - feed() raises
+StreamAborted, and the caller stops the stream instead of paying for the
+rest of a bad generation. Problems the validator repairs locally (stage
+name casing, a pipeline given as a string or single object) do not abort.
+"""
+import json
+from pipeline_validator import ALLOWED_COLLECTIONS, ALLOWED_STAGES, PipelineValidationError, _closest
+
+WHITESPACE = " \t\r\n"
+STAGE_NAMES = {stage.lower(): stage for stage in ALLOWED_STAGES}
+
+
+class StreamAborted(PipelineValidationError):
+    """The partial output is already invalid; query_data holds the text so far."""
+
+
+class IncrementalQueryParser:
+    def __init__(self):
+        self.text = ""
+        self.position = 0
+        self.stack = []           # open brackets: "{" or "["
+        self.in_string = False
+        self.escaped = False
+        self.done = False
+        self.collection = None
+        # Top-level object: expecting "key", "colon", "value" or "comma".
+        self.expect = None
+        self.key = None
+        self.value_start = None
+        # Pipeline array (depth 2 when open).
+        self.in_pipeline = False
+        self.stage_start = None
+        self.stages = []
+
+    def _abort(self, message):
+        raise StreamAborted([f"aborted while streaming: {message}"], self.text)
+
+    def feed(self, chunk):
+        """Consumes the next chunk of text; returns the events it completed."""
+        self.text += chunk
+        events = []
+        text = self.text
+        while self.position < len(text):
+            i = self.position
+            c = text[i]
+            self.position += 1
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif c == "\\":
+                    self.escaped = True
+                elif c == '"':
+                    self.in_string = False
+                    if len(self.stack) == 1:
+                        self._end_top_string(i + 1, events)
+                continue
+            if c in WHITESPACE:
+                continue
+            if self.done:
+                self._abort(f"unexpected text after the JSON object: {text[i:i + 20]!r}")
+            depth = len(self.stack)
+            if depth == 0:
+                if c != "{":
+                    self._abort("response must be a JSON object")
+                self.stack.append(c)
+                self.expect = "key"
+                continue
+            if depth == 1:
+                self._top_level(c, i, events)
+                continue
+            if depth == 2 and self.in_pipeline and self.stage_start is None and c not in ",]":
+                if c != "{":
+                    self._abort(f"stage {len(self.stages)}: each stage must be a non-empty object")
+                self.stage_start = i
+            if c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.stack.append(c)
+            elif c in "}]":
+                self._close(c, i, events)
+        return events
+
+    # --- top level ---
+    def _top_level(self, c, i, events):
+        if self.expect == "key":
+            if c == "}":
+                self._close(c, i, events)
+            elif c == '"':
+                self.in_string = True
+                self.value_start = i
+            else:
+                self._abort(f"expected a key, got {c!r}")
+        elif self.expect == "colon":
+            if c != ":":
+                self._abort(f"expected ':' after key {self.key!r}")
+            self.expect = "value"
+        elif self.expect == "value":
+            self.value_start = i
+            self.expect = "in_value"
+            if self.key == "collection" and c != '"':
+                self._abort("collection must be a string")
+            if c == '"':
+                self.in_string = True
+            elif c in "{[":
+                self.stack.append(c)
+                if self.key == "pipeline" and c == "[":
+                    self.in_pipeline = True
+        elif self.expect == "in_value":
+            # Inside a bare literal (number, true, null): it ends at ',' or '}'.
+            if c in ",}":
+                self.expect = "comma"
+                self._top_level(c, i, events)
+        elif self.expect == "comma":
+            if c == ",":
+                self.expect = "key"
+            elif c == "}":
+                self._close(c, i, events)
+            else:
+                self._abort(f"expected ',' or '}}' after {self.key!r}")
+
+    def _end_top_string(self, end, events):
+        raw = self.text[self.value_start:end]
+        if self.expect == "key":
+            self.key = json.loads(raw)
+            self.expect = "colon"
+            return
+        self.expect = "comma"
+        if self.key == "collection":
+            name = json.loads(raw)
+            self.collection = _closest(name, ALLOWED_COLLECTIONS)
+            if self.collection is None:
+                self._abort(f"collection '{name}' is not one of {sorted(ALLOWED_COLLECTIONS)}")
+            events.append(("collection", self.collection))
+
+    # --- brackets ---
+    def _close(self, c, i, events):
+        opener = self.stack.pop()
+        if (opener, c) not in (("{", "}"), ("[", "]")):
+            self._abort(f"mismatched {c!r}")
+        depth = len(self.stack)
+        if depth == 0:
+            self.done = True
+        elif depth == 1:
+            # A nested top-level value just closed.
+            self.expect = "comma"
+            if self.in_pipeline:
+                self.in_pipeline = False
+                events.append(("pipeline", list(self.stages)))
+        elif depth == 2 and self.in_pipeline and c == "}":
+            events.append(self._stage(self.text[self.stage_start:i + 1]))
+            self.stage_start = None
+
+    def _stage(self, raw):
+        index = len(self.stages)
+        try:
+            stage = json.loads(raw)
+        except json.JSONDecodeError as e:
+            self._abort(f"stage {index} is not valid JSON: {e}")
+        if not stage:
+            self._abort(f"stage {index}: each stage must be a non-empty object")
+        for name in stage:
+            key = name if name.startswith("$") else "$" + name
+            if key.lower() not in STAGE_NAMES:
+                self._abort(f"stage {index}: stage '{name}' is not allowed")
+        self.stages.append(stage)
+        return ("stage", index, stage)
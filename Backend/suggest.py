@@ -0,0 +1,291 @@
+"""
+In-memory typeahead over the entity names users type into the search bar:
+countries, commodities, impexp products and trade ports.
+
+Without suggestions, users typed free-form names ("jnpt", "crude") that
+either failed to resolve or cost a full LLM round trip to find out. The
+index is built from MongoDB once and answers /api/suggest from memory
+only:
+
+- Every name is indexed under each prefix (up to MAX_PREFIX characters) of
+  the whole name and of each word in it. Posting lists are stored in score
+  order, so a lookup is one dict access plus the first `limit` ids.
+- A trigram index catches typos and infixes ("ndia", "tokio") when no
+  name starts with what was typed.
+- Score is popularity: log(1 + trade rows naming the entity) plus
+  QUERY_WEIGHT * log(1 + logged questions mentioning it). observe() counts
+  new questions, and the background worker re-ranks every RERANK_SECONDS.
+- Data changes refresh only their source: a change to countries reloads
+  country names, and so on. trades (ports and usage counts) is the
+  expensive one and reloads at most every TRADES_REFRESH_SECONDS.
+"""
+import os
+import re
+import math
+import time
+import threading
+
+SUGGEST_LIMIT = int(os.getenv("SUGGEST_LIMIT", 8))
+SUGGEST_LIMIT_MAX = 50
+MAX_PREFIX = 12
+MAX_PHRASE_WORDS = 4
+FUZZY_CUTOFF = 0.5
+QUERY_WEIGHT = 2.0
+RERANK_SECONDS = int(os.getenv("SUGGEST_RERANK_SECONDS", 60))
+TRADES_REFRESH_SECONDS = int(os.getenv("SUGGEST_TRADES_REFRESH_SECONDS", 300))
+
+KINDS = ("country", "commodity", "product", "port")
+# Source collection -> kinds whose names or counts it provides.
+SOURCES = {
+    "countries": ("country",),
+    "commodities": ("commodity",),
+    "impexp": ("product",),
+    "trades": ("country", "commodity", "port"),
+}
+WORD_RE = re.compile(r"[\w&.'-]+")
+
+
+def _normalize(text):
+    return " ".join(WORD_RE.findall(text.lower()))
+
+
+def _grams(text, n=3):
+    text = f"  {text} "
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class _Snapshot:
+    """One immutable build; suggest() reads whichever snapshot is current."""
+
+    def __init__(self, entries, prefixes, grams, names):
+        self.entries = entries      # [(label, kind, score, normalized)] in score order
+        self.prefixes = prefixes    # prefix -> [entry index], score order
+        self.grams = grams          # trigram -> [entry index], score order
+        self.names = names          # normalized label -> [entry index]
+
+
+class SuggestIndex:
+    def __init__(self, db=None):
+        self.db = db
+        self.lock = threading.Lock()
+        self.labels = {kind: set() for kind in KINDS}
+        self.usage = {kind: {} for kind in KINDS}   # kind -> {label: trade rows (or impexp rows)}
+        self.queried = {}                           # normalized label -> questions mentioning it
+        self.current = _Snapshot([], {}, {}, {})
+        self.dirty = False
+        self.pending = set()
+        self.trades_loaded = 0.0
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.stats = {"builds": 0, "build_ms": None, "refreshes": {}, "served": 0, "observed": 0}
+
+    # --- loading ---
+    def _names(self, collection, field):
+        return {doc["_id"]: doc[field] for doc in self.db.get_collection(collection).find({}, {field: 1})
+                if isinstance(doc.get(field), str)}
+
+    def _counts(self, collection, field):
+        pipeline = [{"$group": {"_id": f"${field}", "rows": {"$sum": 1}}}]
+        return {doc["_id"]: doc["rows"] for doc in self.db.get_collection(collection).aggregate(pipeline)
+                if doc["_id"] is not None}
+
+    def _load(self, collection):
+        if collection == "countries":
+            self.labels["country"] = set(self._names("countries", "country_name").values())
+        elif collection == "commodities":
+            self.labels["commodity"] = set(self._names("commodities", "commodity_name").values())
+        elif collection == "impexp":
+            products = {name: rows for name, rows in self._counts("impexp", "product").items() if isinstance(name, str)}
+            self.labels["product"], self.usage["product"] = set(products), products
+        elif collection == "trades":
+            for kind, source, field in (("country", "countries", "country_name"),
+                                        ("commodity", "commodities", "commodity_name")):
+                names = self._names(source, field)
+                usage = {}
+                for key, rows in self._counts("trades", f"{kind}_id").items():
+                    if key in names:
+                        usage[names[key]] = usage.get(names[key], 0) + rows
+                self.usage[kind] = usage
+            ports = {name: rows for name, rows in self._counts("trades", "port").items() if isinstance(name, str)}
+            self.labels["port"], self.usage["port"] = set(ports), ports
+            self.trades_loaded = time.monotonic()
+        self.stats["refreshes"][collection] = self.stats["refreshes"].get(collection, 0) + 1
+
+    def refresh(self, collections=None):
+        """Reloads the given source collections (default: all) and rebuilds."""
+        for collection in collections or SOURCES:
+            if collection in SOURCES:
+                self._load(collection)
+        self.build()
+
+    # --- building ---
+    def build(self):
+        started = time.perf_counter()
+        entries = []
+        queried = dict(self.queried)
+        for kind in KINDS:
+            usage = self.usage[kind]
+            for label in self.labels[kind]:
+                normalized = _normalize(label)
+                if not normalized:
+                    continue
+                score = math.log1p(usage.get(label, 0)) + QUERY_WEIGHT * math.log1p(queried.get(normalized, 0))
+                entries.append((label, kind, round(score, 3), normalized))
+        entries.sort(key=lambda entry: (-entry[2], len(entry[0]), entry[0]))
+        prefixes, grams, names = {}, {}, {}
+        for index, (_, _, _, normalized) in enumerate(entries):
+            names.setdefault(normalized, []).append(index)
+            words = normalized.split()
+            keys = set()
+            for start in range(len(words)):
+                phrase = " ".join(words[start:])
+                keys.update(phrase[:size] for size in range(1, min(len(phrase), MAX_PREFIX) + 1))
+            for key in keys:
+                prefixes.setdefault(key, []).append(index)
+            for gram in _grams(normalized):
+                grams.setdefault(gram, []).append(index)
+        self.current = _Snapshot(entries, prefixes, grams, names)
+        self.dirty = False
+        self.stats["builds"] += 1
+        self.stats["build_ms"] = round((time.perf_counter() - started) * 1000, 1)
+
+    # --- popularity ---
+    def observe(self, user_query, count=1):
+        """Counts the indexed names a question mentions; ranking follows on the next re-rank."""
+        words = _normalize(user_query).split()
+        names = self.current.names
+        found = False
+        with self.lock:
+            for start in range(len(words)):
+                for size in range(min(MAX_PHRASE_WORDS, len(words) - start), 0, -1):
+                    phrase = " ".join(words[start:start + size])
+                    if phrase in names:
+                        self.queried[phrase] = self.queried.get(phrase, 0) + count
+                        found = True
+                        break
+        if found:
+            self.dirty = True
+            self.stats["observed"] += 1
+
+    # --- lookups ---
+    @staticmethod
+    def _starts_with(normalized, fragment):
+        return normalized.startswith(fragment) or f" {fragment}" in f" {normalized}"
+
+    def suggest(self, text, limit=SUGGEST_LIMIT, kinds=None):
+        """
+        Suggestions for the name being typed at the end of text: the longest
+        trailing phrase (up to MAX_PHRASE_WORDS words) that prefixes a name,
+        else trigram matches for the last word. Each suggestion carries the
+        completed text.
+        """
+        self.stats["served"] += 1
+        snapshot = self.current
+        spans = [match.span() for match in WORD_RE.finditer(text.lower())]
+        if not spans or spans[-1][1] < len(text.rstrip()) or text[-1:].isspace():
+            return []
+        words = [text[start:end].lower() for start, end in spans]
+        found, start = [], spans[-1][0]
+        for size in range(min(MAX_PHRASE_WORDS, len(words)), 0, -1):
+            fragment = " ".join(words[-size:])
+            found = self._prefix(snapshot, fragment, limit, kinds)
+            if found:
+                start = spans[-size][0]
+                break
+        if not found:
+            found = self._fuzzy(snapshot, words[-1], limit, kinds)
+        return [{
+            "text": snapshot.entries[index][0],
+            "kind": snapshot.entries[index][1],
+            "score": snapshot.entries[index][2],
+            "completion": text[:start] + snapshot.entries[index][0],
+        } for index in found]
+
+    def _prefix(self, snapshot, fragment, limit, kinds):
+        found = []
+        long = len(fragment) > MAX_PREFIX
+        for index in snapshot.prefixes.get(fragment[:MAX_PREFIX], ()):
+            _, kind, _, normalized = snapshot.entries[index]
+            if kinds and kind not in kinds:
+                continue
+            if long and not self._starts_with(normalized, fragment):
+                continue
+            found.append(index)
+            if len(found) >= limit:
+                break
+        return found
+
+    def _fuzzy(self, snapshot, word, limit, kinds):
+        if len(word) < 3 or limit <= 0:
+            return []
+        query = _grams(word)
+        shared = {}
+        for gram in query:
+            for index in snapshot.grams.get(gram, ()):
+                shared[index] = shared.get(index, 0) + 1
+        needed = FUZZY_CUTOFF * len(query)
+        ranked = sorted((index for index, count in shared.items()
+                         if count >= needed and not (kinds and snapshot.entries[index][1] not in kinds)),
+                        key=lambda index: (-shared[index], index))
+        return ranked[:limit]
+
+    # --- background ---
+    def changed(self, collection):
+        """data_version callback: queue a source refresh for the worker."""
+        if collection in SOURCES:
+            with self.lock:
+                self.pending.add(collection)
+            self._wake.set()
+
+    def _work(self):
+        pending = set()
+        with self.lock:
+            pending, self.pending = self.pending, set()
+            # trades is expensive to reload: later changes wait for the interval.
+            if "trades" in pending and time.monotonic() - self.trades_loaded < TRADES_REFRESH_SECONDS:
+                pending.discard("trades")
+                self.pending.add("trades")
+        if pending:
+            self.refresh(pending)
+            print(f"--- Suggestions refreshed from {sorted(pending)} in {self.stats['build_ms']}ms")
+        elif self.dirty:
+            self.build()
+
+    def start(self):
+        """Background refresh on data changes, and re-ranking after observed questions."""
+        self._stop = threading.Event()
+
+        def loop():
+            while not self._stop.is_set():
+                self._wake.wait(RERANK_SECONDS)
+                self._wake.clear()
+                if self._stop.is_set():
+                    return
+                try:
+                    self._work()
+                except Exception as e:
+                    print(f"--- Suggestion refresh failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="suggest-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Signals the thread to exit; with a timeout, also waits for it (before
+        fork). Returns False if the thread is still running afterwards.
+        """
+        self._stop.set()
+        self._wake.set()
+        if timeout is not None and self._thread is not None:
+            self._thread.join(timeout)
+        return self._thread is None or not self._thread.is_alive()
+
+    def snapshot(self):
+        entries = self.current.entries
+        return {
+            **self.stats,
+            "entries": {kind: sum(1 for entry in entries if entry[1] == kind) for kind in KINDS},
+            "prefixes": len(self.current.prefixes),
+            "pending": sorted(self.pending),
+        }
@@ -0,0 +1,103 @@
+"""The proxy against the local fake streaming-STT server (fake_stt_handler)."""
+import json
+import asyncio
+import numpy as np
+import websockets
+import assemblyai_proxy as proxy
+
+# public/audio-processor.js posts 4096 PCM16 samples (256 ms) per frame.
+FRAME_BYTES = 8192
+SMALL_FRAME_BYTES = 256
+
+
+def _speech(n_bytes, seed=0):
+    samples = np.random.default_rng(seed).normal(0, 8000, n_bytes // 2).clip(-32768, 32767)
+    return samples.astype("<i2").tobytes()
+
+
+def _port(server):
+    return next(iter(server.sockets)).getsockname()[1]
+
+
+async def _session(frames):
+    """Streams frames through a proxy to the fake server; returns (messages, proxy server)."""
+    upstream = await websockets.serve(proxy.fake_stt_handler, "localhost", 0)
+    server = proxy.ProxyServer(f"ws://localhost:{_port(upstream)}/v3/ws", api_key=None)
+    front = await websockets.serve(server.handler, "localhost", 0)
+    messages = []
+    try:
+        async with websockets.connect(f"ws://localhost:{_port(front)}/?sample_rate=16000") as client:
+            messages.append(json.loads(await client.recv()))
+            for frame in frames:
+                await client.send(frame)
+            await client.send(json.dumps({"type": "Terminate"}))
+            async for message in client:
+                messages.append(json.loads(message))
+                if messages[-1]["type"] == "Termination":
+                    break
+    finally:
+        front.close()
+        upstream.close()
+        await front.wait_closed()
+        await upstream.wait_closed()
+    return messages
+
+
+def _frames(audio, size):
+    return [audio[i:i + size] for i in range(0, len(audio), size)]
+
+
+def test_browser_frames_pass_through_whole(monkeypatch):
+    monkeypatch.setattr(proxy, "VAD_ENABLED", False)
+    audio = _speech(4 * FRAME_BYTES)
+    messages = asyncio.run(_session(_frames(audio, FRAME_BYTES)))
+
+    assert messages[0]["type"] == "Begin"
+    # Each 256 ms frame is already above the chunk size and within the upstream's 1000 ms limit.
+    assert [m["chunk_bytes"] for m in messages if m["type"] == "Turn"] == [FRAME_BYTES] * 4
+    assert messages[-1]["type"] == "Termination"
+    assert messages[-1]["audio_duration_seconds"] == len(audio) / (proxy.SAMPLE_RATE * proxy.BYTES_PER_SAMPLE)
+
+
+def test_small_frames_are_coalesced_into_upstream_chunks(monkeypatch):
+    monkeypatch.setattr(proxy, "VAD_ENABLED", False)
+    audio = _speech(20 * SMALL_FRAME_BYTES)
+    messages = asyncio.run(_session(_frames(audio, SMALL_FRAME_BYTES)))
+
+    chunks = [m["chunk_bytes"] for m in messages if m["type"] == "Turn"]
+    # One chunk as soon as 100 ms is buffered, then the remainder flushed ahead of Terminate.
+    target = proxy._ms_to_bytes(proxy.UPSTREAM_CHUNK_MS)
+    assert len(chunks) == 2
+    assert target <= chunks[0] < target + SMALL_FRAME_BYTES
+    assert sum(chunks) == len(audio)
+    assert messages[-1]["type"] == "Termination"
+    assert messages[-1]["audio_duration_seconds"] == len(audio) / (proxy.SAMPLE_RATE * proxy.BYTES_PER_SAMPLE)
+
+
+def test_silence_is_not_forwarded(monkeypatch):
+    monkeypatch.setattr(proxy, "VAD_ENABLED", True)
+    messages = asyncio.run(_session([bytes(FRAME_BYTES)] * 4))
+
+    assert [m["type"] for m in messages] == ["Begin", "Termination"]
+    assert messages[-1]["audio_duration_seconds"] == 0
+
+
+def test_coalescer_never_splits_a_sample():
+    coalescer = proxy.FrameCoalescer(target_bytes=1001, max_bytes=1001)
+    ready = coalescer.add(bytes(1500))
+    assert [len(chunk) for chunk in ready] == [1000]
+    assert len(coalescer.flush()) == 500
+
+
+def test_vad_keeps_speech_and_drops_silence():
+    vad = proxy.VoiceActivityDetector()
+    assert vad.filter(bytes(3200)) == b""
+    speech = _speech(3200)
+    assert len(vad.filter(speech)) >= len(speech)
+
+
+def test_only_allowed_parameters_reach_upstream():
+    assert proxy.upstream_query("sample_rate=16000&format_turns=true&token=stolen") == \
+        "sample_rate=16000&format_turns=true"
+    assert proxy.upstream_query("") == proxy.DEFAULT_QUERY
+    assert proxy.upstream_query("token=x") == proxy.DEFAULT_QUERY
@@ -0,0 +1,74 @@
+"""Streaming chat against FakeStreamingClient, including `chat.py --fake`."""
+import sys
+import chat
+
+
+def _run(monkeypatch, capsys, argv, lines):
+    inputs = iter(lines)
+    monkeypatch.setattr(sys, "argv", ["chat.py", *argv])
+    monkeypatch.setattr("builtins.input", lambda prompt="": next(inputs))
+    chat.main()
+    return capsys.readouterr().out
+
+
+def test_stream_reply_reports_time_to_first_token(capsys):
+    history = chat.ChatHistory()
+    history.add("user", "hello there")
+    text, first_token, total = chat.stream_reply(chat.FakeStreamingClient(delay=0.01), history)
+
+    assert "You said: hello there" in text
+    assert 0 < first_token <= total
+    assert text.strip() in capsys.readouterr().out
+
+
+def test_history_is_compacted_within_budget():
+    history = chat.ChatHistory(budget=300)
+    for turn in range(20):
+        history.add("user" if turn % 2 == 0 else "model", f"turn {turn} " + "word " * 40)
+
+    assert history.tokens() <= 300
+    assert len(history.turns) >= chat.KEEP_RECENT_TURNS
+    assert history.recap
+    contents = history.contents()
+    assert contents[0]["parts"][0]["text"].startswith("Summary of the earlier conversation")
+    assert contents[-1]["parts"][0]["text"].startswith("turn 19")
+
+
+def _roles(history):
+    return [turn["role"] for turn in history.contents()]
+
+
+def test_compaction_keeps_user_and_model_turns_alternating():
+    history = chat.ChatHistory(budget=300)
+    for turn in range(15):
+        # Compaction also runs right after a user turn, with an odd number of turns.
+        history.add("user" if turn % 2 == 0 else "model", f"turn {turn} " + "word " * 20)
+        roles = _roles(history)
+        assert roles[0] == "user"
+        assert all(a != b for a, b in zip(roles, roles[1:])), roles
+    assert history.recap
+
+
+def test_fake_mode_keeps_multi_turn_history(monkeypatch, capsys):
+    out = _run(monkeypatch, capsys, ["--fake"], ["first question", "second question", "exit"])
+
+    assert "(fake)" in out
+    assert "You said: first question [history: 1 turn(s)]" in out
+    # The second request carries the first question and answer too.
+    assert "You said: second question [history: 3 turn(s)]" in out
+    assert "first token" in out
+
+
+def test_trade_mode_routes_data_questions(monkeypatch, capsys):
+    asked = []
+
+    def engine(question):
+        asked.append(question)
+        return [{"_id": 2023, "total": 42}], None
+
+    monkeypatch.setattr(chat, "ask_trade_engine", engine)
+    out = _run(monkeypatch, capsys, ["--fake", "--trade"], ["total exports by year", "hi", "quit"])
+
+    assert asked == ["total exports by year"]
+    assert "1 row(s) from the trade engine" in out
+    assert "Answer using these query results" in out
@@ -0,0 +1,72 @@
+"""Streamed bulk export (export.py): column planning and lossless writes."""
+import io
+import csv
+import pytest
+from bson import ObjectId
+from export import EXTRA_COLUMN, ExportError, export_stream
+
+pa = pytest.importorskip("pyarrow")   # Parquet and Arrow are optional
+
+
+class Cursor:
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.closed = False
+
+    def __iter__(self):
+        return self.rows
+
+    def __next__(self):
+        return next(self.rows)
+
+    def close(self):
+        self.closed = True
+
+
+def _csv(rows, pipeline, batch_size=2, collection="trades"):
+    data = b"".join(export_stream(Cursor(rows), collection, "csv", batch_size, pipeline))
+    return list(csv.reader(io.StringIO(data.decode())))
+
+
+def _arrow(rows, pipeline, batch_size=2):
+    data = b"".join(export_stream(Cursor(rows), "trades", "arrow", batch_size, pipeline))
+    return pa.ipc.open_stream(data).read_all()
+
+
+def test_declared_columns_missing_from_the_first_batch_are_kept():
+    rows = [{"_id": ObjectId(), "port": "JNPT"}, {"_id": ObjectId(), "port": "Kandla"},
+            {"_id": ObjectId(), "port": "Mundra", "value_usd": 12.5}]
+    table = _csv(rows, [{"$match": {"trade_type": "Export"}}])
+
+    header = table[0]
+    assert "value_usd" in header and EXTRA_COLUMN not in header
+    assert table[3][header.index("value_usd")] == "12.5"
+
+
+def test_computed_fields_appearing_later_go_to_the_extra_column():
+    pipeline = [{"$group": {"_id": {"year": "$year_id", "port": "$port"}, "total": {"$sum": "$value_usd"}}}]
+    rows = [{"_id": {"year": 1}, "total": 5}, {"_id": {"year": 2}, "total": 6},
+            {"_id": {"year": 3, "port": "JNPT"}, "total": 7}]
+    table = _csv(rows, pipeline)
+
+    header = table[0]
+    assert header == ["_id.year", "total", EXTRA_COLUMN]
+    assert table[3][2] == '{"_id.port": "JNPT"}'
+
+
+def test_arrow_keeps_every_value():
+    pipeline = [{"$group": {"_id": "$port", "total": {"$sum": "$value_usd"}}}]
+    rows = [{"_id": "JNPT", "total": 5.0}, {"_id": "Kandla", "total": 6.0}, {"_id": "Mundra", "total": 7.5}]
+    table = _arrow(rows, pipeline)
+
+    assert table.column("total").to_pylist() == [5.0, 6.0, 7.5]
+
+
+def test_type_mismatch_fails_instead_of_writing_null():
+    pipeline = [{"$group": {"_id": "$port", "rows": {"$sum": 1}}}]
+    rows = [{"_id": "JNPT", "rows": 1}, {"_id": "Kandla", "rows": 2}, {"_id": "Mundra", "rows": "many"}]
+    cursor = Cursor(rows)
+
+    with pytest.raises(ExportError, match="column 'rows'"):
+        b"".join(export_stream(cursor, "trades", "parquet", 2, pipeline))
+    assert cursor.closed
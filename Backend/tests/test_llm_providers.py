@@ -0,0 +1,112 @@
+"""LLMClient's deadline, retry and hedging policy, driven by FakeProvider."""
+import json
+import time
+import pytest
+import llm_providers
+from admission import AdmissionController, Overloaded
+from llm_providers import LLMClient, FakeProvider, DeadlineExceeded, providers_from_spec
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(monkeypatch):
+    monkeypatch.setattr(llm_providers, "BACKOFF_SECONDS", 0.01)
+
+
+def _hedged(primary, secondary, admission=None, after=0.05, **kwargs):
+    client = LLMClient([primary, secondary], admission=admission, **kwargs)
+    client.hedge_after = lambda provider: after
+    return client
+
+
+def test_fake_spec():
+    (provider,) = providers_from_spec("fake")
+    assert isinstance(provider, FakeProvider)
+
+
+def test_retries_transient_failures():
+    provider = FakeProvider("flaky", latency=0.01, failures=2)
+    client = LLMClient([provider], retries=2)
+
+    value, completion = client.complete("prompt", parse=json.loads)
+
+    assert value["collection"] == "countries"
+    assert provider.calls == 3
+    assert client.snapshot()["providers"]["fake:flaky"]["errors"] == 2
+
+
+def test_gives_up_after_the_retries():
+    client = LLMClient([FakeProvider("down", latency=0.01, failures=5)], retries=1)
+    with pytest.raises(ConnectionError):
+        client.complete("prompt")
+
+
+def test_deadline_bounds_the_call():
+    client = LLMClient([FakeProvider("slow", latency=1.0)], deadline=0.2, retries=0)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        client.complete("prompt")
+    assert time.monotonic() - started < 0.5
+
+
+def test_slow_primary_is_hedged_and_the_hedge_wins():
+    slow, fast = FakeProvider("slow", latency=1.0), FakeProvider("fast", latency=0.01)
+    client = _hedged(slow, fast)
+
+    started = time.monotonic()
+    _, completion = client.complete("prompt")
+
+    assert completion.provider == "fake:fast"
+    assert time.monotonic() - started < 0.5
+    assert client.hedges == {"fired": 1, "won": 1}
+
+
+def test_invalid_answer_loses_to_a_valid_hedge():
+    wrong = FakeProvider("wrong", responder="not json", latency=0.1)
+    right = FakeProvider("right", latency=0.15)
+    client = _hedged(wrong, right)
+
+    value, completion = client.complete("prompt", parse=json.loads)
+
+    assert completion.provider == "fake:right"
+    assert value["collection"] == "countries"
+
+
+def test_losing_hedge_releases_its_admission_slot():
+    admission = AdmissionController({}, max_in_flight=4)
+    client = _hedged(FakeProvider("slow", latency=1.0), FakeProvider("fast", latency=0.01), admission)
+
+    client.complete("prompt")
+
+    # The slow call is still sleeping, but no longer holds a slot.
+    assert admission.snapshot()["in_flight"] == 0
+
+
+def test_losing_streamed_hedge_is_cancelled():
+    chunks = {"fake:slow": [], "fake:fast": []}
+    slow, fast = FakeProvider("slow", latency=0.6), FakeProvider("fast", latency=0.01)
+    client = _hedged(slow, fast)
+    streams = iter(["fake:slow", "fake:fast"])
+
+    def stream():
+        return chunks[next(streams)].append
+
+    client.complete("prompt", stream=stream)
+    time.sleep(0.8)
+
+    # The loser stopped streaming and is not counted as a provider error.
+    assert len(chunks["fake:slow"]) < len(chunks["fake:fast"])
+    assert client.snapshot()["providers"]["fake:slow"] == {
+        "calls": 0, "errors": 0, "p50_ms": None, "p95_ms": None}
+
+
+def test_queue_wait_counts_against_the_deadline():
+    admission = AdmissionController({}, max_in_flight=1, queue_timeout=5)
+    busy = admission.slot("fake", 10)
+    client = LLMClient([FakeProvider("queued", latency=0.01)], admission=admission, deadline=0.2, retries=0)
+
+    started = time.monotonic()
+    with pytest.raises(Overloaded):
+        client.complete("prompt")
+    busy.release()
+
+    assert time.monotonic() - started < 0.5
@@ -0,0 +1,90 @@
+"""The offline local-model path (local_model.py, OllamaProvider) against ollama_standin."""
+import json
+import threading
+from http.server import ThreadingHTTPServer
+import pytest
+from ollama_standin import StandIn, make_handler, DEFAULT_ANSWER
+from local_model import OllamaServer
+from llm_providers import LLMClient, OllamaProvider
+from prompts import prompt_examples
+
+PREFIX = "You translate questions into MongoDB queries.\nSchema: countries, trades.\n"
+
+
+@pytest.fixture
+def standin():
+    model = StandIn(load_seconds=0.05, prefill_ms=1, token_ms=1, parallel=2)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(model))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield model, f"http://127.0.0.1:{server.server_address[1]}/api/chat"
+    server.shutdown()
+    server.server_close()
+
+
+def _examples(count):
+    examples = prompt_examples()[:count]
+    assert len(examples) == count
+    return [(question, json.loads(text)) for question, text in examples]
+
+
+def test_calls_share_one_connection_and_the_cached_prefix(standin):
+    model, url = standin
+    server = OllamaServer(url, batch_size=1)
+    (question, expected), = _examples(1)
+
+    for _ in range(3):
+        text, tokens = server.generate("llama3", PREFIX + question, timeout=10)
+        assert json.loads(text) == expected
+        assert tokens > 0
+
+    assert model.stats["connections"] == 1
+    assert model.stats["loads"] == 1   # kept resident by keep_alive
+    assert model.stats["prefix_misses"] == 1 and model.stats["prefix_hits"] == 2
+    server.session.close()
+
+
+def test_streamed_answer(standin):
+    _, url = standin
+    server = OllamaServer(url, batch_size=1)
+    chunks = []
+
+    text, _ = server.generate("llama3", PREFIX + "something unknown", timeout=10, on_chunk=chunks.append)
+
+    assert len(chunks) > 1 and "".join(chunks) == text
+    assert json.loads(text) == DEFAULT_ANSWER
+    server.session.close()
+
+
+def test_concurrent_calls_are_merged_into_one_request(standin):
+    model, url = standin
+    server = OllamaServer(url, batch_size=3, batch_window_seconds=0.5)
+    examples = _examples(3)
+    results = {}
+
+    def ask(question):
+        results[question] = json.loads(server.generate("llama3", PREFIX + question, timeout=10)[0])
+
+    threads = [threading.Thread(target=ask, args=(question,)) for question, _ in examples]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == dict(examples)
+    assert server.stats["batches"] == 1 and server.stats["requests"] == 1
+    assert model.stats["merged_requests"] == 1
+    server.session.close()
+
+
+def test_provider_answers_through_the_client(standin):
+    _, url = standin
+    client = LLMClient([OllamaProvider("llama3", url=url)])
+    (question, expected), = _examples(1)
+
+    value, completion = client.complete(PREFIX + question, parse=json.loads)
+
+    assert value == expected
+    assert completion.provider == "ollama:llama3"
+    assert client.snapshot()["servers"]["ollama:llama3"]["url"] == url
@@ -0,0 +1,92 @@
+"""Validation and deterministic repair of generated pipelines (pipeline_validator.py)."""
+import pytest
+from pipeline_validator import PipelineValidationError, validate_and_repair, build_repair_prompt
+
+
+def _repair(pipeline, collection="trades"):
+    return validate_and_repair({"collection": collection, "pipeline": pipeline})
+
+
+def test_valid_pipeline_is_unchanged():
+    pipeline = [{"$match": {"trade_type": "Export"}}, {"$sort": {"value_usd": -1}}, {"$limit": 5}]
+    repaired, repairs = _repair(pipeline)
+    assert repaired == {"collection": "trades", "pipeline": pipeline}
+    assert repairs == []
+
+
+def test_excluding_only_id_keeps_the_other_fields():
+    repaired, _ = _repair([{"$project": {"_id": 0}}, {"$sort": {"value_usd": -1}}])
+    assert repaired["pipeline"][1] == {"$sort": {"value_usd": -1}}
+
+
+def test_inclusion_with_id_excluded_keeps_only_the_included_fields():
+    with pytest.raises(PipelineValidationError) as error:
+        _repair([{"$project": {"_id": 0, "port": 1}}, {"$sort": {"value_usd": -1}}])
+    assert "unknown field 'value_usd'" in str(error.value.errors)
+
+
+def test_exclusion_drops_the_excluded_field():
+    with pytest.raises(PipelineValidationError):
+        _repair([{"$project": {"port": 0}}, {"$sort": {"port": 1}}])
+
+
+def test_mixed_projection_is_rejected():
+    with pytest.raises(PipelineValidationError) as error:
+        _repair([{"$project": {"port": 1, "value_usd": 0}}])
+    assert "mixes inclusion and exclusion" in error.value.errors[0]
+
+
+@pytest.mark.parametrize("query_data, expected, repair", [
+    ({"collection": "trade", "pipeline": [{"$limit": 5}]},
+     {"collection": "trades", "pipeline": [{"$limit": 5}]}, "collection 'trade' -> 'trades'"),
+    ({"collection": "trades", "pipeline": '[{"$limit": 5}]'},
+     {"collection": "trades", "pipeline": [{"$limit": 5}]}, "pipeline was a JSON string -> parsed"),
+    ({"collection": "trades", "pipeline": {"$limit": 5}},
+     {"collection": "trades", "pipeline": [{"$limit": 5}]}, "pipeline was a single stage object -> wrapped in a list"),
+    ({"collection": "trades", "pipeline": [{"limit": "5"}]},
+     {"collection": "trades", "pipeline": [{"$limit": 5}]}, "stage 0: stage 'limit' -> '$limit'"),
+])
+def test_top_level_repairs(query_data, expected, repair):
+    repaired, repairs = validate_and_repair(query_data)
+    assert repaired == expected
+    assert repair in repairs
+
+
+def test_stage_level_repairs():
+    repaired, repairs = _repair([
+        {"$lookup": {"from": "Countries", "localfield": "country_id", "foreignField": "_id", "as": "country"}},
+        {"$unwind": "country"},
+        {"$match": {"country.population": {"$gte": "1000000"}, "valu_usd": {"$gt": 0}}},
+        {"$group": {"_id": "$country.country_name", "total": {"$summ": "$value_usd"}}},
+        {"$sort": {"total": "-1"}},
+    ])
+    pipeline = repaired["pipeline"]
+    assert pipeline[0]["$lookup"] == {"from": "countries", "localField": "country_id",
+                                      "foreignField": "_id", "as": "country"}
+    assert pipeline[1] == {"$unwind": "$country"}
+    assert pipeline[2]["$match"] == {"country.population": {"$gte": 1000000}, "value_usd": {"$gt": 0}}
+    assert pipeline[3]["$group"]["total"] == {"$sum": "$value_usd"}
+    assert pipeline[4] == {"$sort": {"total": -1}}
+    assert len(repairs) == 7
+
+
+def test_split_multi_operator_stage():
+    repaired, _ = _repair([{"$sort": {"value_usd": -1}, "$limit": 3}])
+    assert repaired["pipeline"] == [{"$sort": {"value_usd": -1}}, {"$limit": 3}]
+
+
+@pytest.mark.parametrize("pipeline, message", [
+    ([{"$out": "stolen"}], "stage '$out' is not allowed"),
+    ([{"$match": {"no_such_field": 1}}], "unknown field 'no_such_field'"),
+    ([{"$limit": -1}], "expected a non-negative integer"),
+])
+def test_unrepairable_errors(pipeline, message):
+    with pytest.raises(PipelineValidationError) as error:
+        _repair(pipeline)
+    assert any(message in problem for problem in error.value.errors)
+
+
+def test_repair_prompt_lists_the_problems():
+    prompt = build_repair_prompt("exports", {"collection": "trades", "pipeline": []}, ["stage 0: bad"])
+    assert "- stage 0: bad" in prompt
+    assert "- trades: _id, country_id" in prompt
@@ -0,0 +1,87 @@
+"""Local follow-up parsing and pipeline edits (refinement.py)."""
+import pytest
+from entity_index import EntityIndex
+from refinement import looks_like_followup, parse_followup, apply_edits, local_result
+
+PREVIOUS = {
+    "query": "exports from india",
+    "query_data": {"collection": "trades", "pipeline": [
+        {"$match": {"country_id": 1, "trade_type": "Export"}},
+        {"$sort": {"value_usd": -1}},
+    ]},
+    "results": [{"value_usd": 30, "trade_type": "Export"}, {"value_usd": 10, "trade_type": "Export"},
+                {"value_usd": 20, "trade_type": "Export"}],
+}
+
+
+@pytest.fixture(scope="module")
+def index():
+    entities = EntityIndex()
+    entities.build({
+        "countries": [{"_id": 1, "country_name": "India"}, {"_id": 2, "country_name": "China"},
+                      {"_id": 3, "country_name": "Japan"}],
+        "commodities": [{"_id": 1, "commodity_name": "Crude Oil"}],
+        "years": [{"_id": 1, "year": 2023}],
+    })
+    return entities
+
+
+def _parse(text, index, previous=PREVIOUS):
+    return parse_followup(text, previous["query_data"]["collection"], previous["query"], index.mentions(text))
+
+
+def test_needs_a_previous_query():
+    assert not looks_like_followup("now only 2023", None)
+    assert looks_like_followup("now only 2023", PREVIOUS)
+    assert not looks_like_followup("exports from china", PREVIOUS)
+
+
+@pytest.mark.parametrize("text", [
+    "what about china imports",
+    "now only imports from japan",
+    "and the top 5 ports",
+    "now by commodity",
+    "just crude oil",
+])
+def test_new_entities_and_groupings_go_to_the_llm(text, index):
+    assert _parse(text, index) is None
+
+
+@pytest.mark.parametrize("text, edits", [
+    ("now only 2023", [{"op": "year", "value": 2023}]),
+    ("just the top 3", [{"op": "limit", "value": 3}]),
+    ("imports instead", [{"op": "trade_type", "field": "trade_type", "value": "Import"}]),
+    ("and for india only in 2023", [{"op": "year", "value": 2023}]),
+    ("now lowest first", [{"op": "sort", "value": 1}]),
+])
+def test_recognised_follow_ups(text, edits, index):
+    assert _parse(text, index) == edits
+
+
+def test_dimension_already_in_the_previous_question(index):
+    previous = {**PREVIOUS, "query": "top exporting countries"}
+    assert _parse("just the top 3 countries", index, previous) == [{"op": "limit", "value": 3}]
+
+
+def test_apply_edits_replaces_filters_and_adds_a_limit():
+    edited = apply_edits(PREVIOUS["query_data"], [
+        {"op": "trade_type", "field": "trade_type", "value": "Import"}, {"op": "limit", "value": 2}])
+
+    assert edited["pipeline"][0]["$match"] == {"country_id": 1, "trade_type": "Import"}
+    assert edited["pipeline"][-1] == {"$limit": 2}
+    assert PREVIOUS["query_data"]["pipeline"][0]["$match"]["trade_type"] == "Export"
+
+
+def test_apply_edits_joins_years_for_a_year_filter():
+    edited = apply_edits(PREVIOUS["query_data"], [{"op": "year", "value": 2023}])
+    stages = [next(iter(stage)) for stage in edited["pipeline"]]
+
+    assert stages == ["$match", "$lookup", "$unwind", "$match", "$sort"]
+    assert edited["pipeline"][3] == {"$match": {"year_doc.year": 2023}}
+
+
+def test_local_result_reuses_cached_rows():
+    rows = local_result(PREVIOUS, [{"op": "sort", "value": 1}, {"op": "limit", "value": 2}])
+    assert [row["value_usd"] for row in rows] == [10, 20]
+    # Swapping an existing filter needs rows that were never fetched.
+    assert local_result(PREVIOUS, [{"op": "trade_type", "field": "trade_type", "value": "Import"}]) is None
@@ -0,0 +1,28 @@
+import mongomock
+
+from schema_introspect import SchemaCache
+
+
+def make_cache(tmp_path):
+    db = mongomock.MongoClient().Trade
+    db.countries.insert_one({"country_name": "India", "population": 1})
+    return db, SchemaCache(db, cache_path=str(tmp_path / "schema.json"))
+
+
+def test_callbacks_see_the_rebuilt_schema(tmp_path):
+    db, cache = make_cache(tmp_path)
+    initial = cache.content_hash
+    seen = []
+    cache.on_change.append(lambda: seen.append((cache.content_hash, cache.summary)))
+    assert cache.refresh()
+    assert seen == [(cache.content_hash, cache.summary)]
+    assert seen[0][0] != initial
+
+
+def test_resample_with_same_content_does_not_notify(tmp_path):
+    db, cache = make_cache(tmp_path)
+    assert cache.refresh()
+    seen = []
+    cache.on_change.append(lambda: seen.append(cache.content_hash))
+    assert not cache.refresh(force=True)
+    assert seen == []
@@ -0,0 +1,77 @@
+"""Speculative generation from voice transcripts (speculation.py)."""
+import time
+import threading
+from speculation import Speculator
+
+
+class Jobs:
+    """job_fn recording its calls; gate blocks the jobs until set."""
+
+    def __init__(self, blocked=False):
+        self.calls = []
+        self.gate = threading.Event()
+        if not blocked:
+            self.gate.set()
+
+    def __call__(self, transcript, final):
+        self.calls.append((transcript, final))
+        self.gate.wait(5)
+        return {"query": transcript}
+
+
+def test_final_transcript_is_generated_from_the_original_text():
+    jobs = Jobs()
+    speculator = Speculator(jobs, stable_ms=10)
+    speculator.observe("s1", "Exports from India?", final=True)
+
+    assert speculator.take("exports from india") == {"query": "Exports from India?"}
+    assert jobs.calls == [("Exports from India?", True)]
+
+
+def test_stable_partial_runs_as_batch_work():
+    jobs = Jobs()
+    speculator = Speculator(jobs, stable_ms=10)
+    speculator.observe("s1", "exports from india")
+    time.sleep(0.1)
+
+    assert jobs.calls == [("exports from india", False)]
+    assert speculator.take("Exports from India.") == {"query": "exports from india"}
+
+
+def test_take_gives_up_after_the_timeout():
+    jobs = Jobs(blocked=True)
+    speculator = Speculator(jobs)
+    speculator.observe("s1", "exports from india", final=True)
+
+    started = time.monotonic()
+    assert speculator.take("exports from india", timeout=0.1) is None
+    assert time.monotonic() - started < 1
+    assert speculator.stats["timed_out"] == 1
+    jobs.gate.set()
+
+
+def test_late_final_after_take_starts_no_job():
+    jobs = Jobs()
+    speculator = Speculator(jobs)
+    assert speculator.take("exports from india") is None
+    speculator.observe("s1", "Exports from India.", final=True)
+
+    assert jobs.calls == []
+    assert speculator.stats["skipped"] == 1
+
+
+def test_final_promotes_a_job_that_has_not_started():
+    jobs = Jobs(blocked=True)
+    speculator = Speculator(jobs, stable_ms=10)
+    # Fill the pool so the partial's job waits in the executor queue.
+    for number in range(4):
+        speculator.observe(f"busy{number}", f"question number {number}", final=True)
+    speculator.observe("s1", "exports from india")
+    time.sleep(0.1)
+    speculator.observe("s1", "exports from india", final=True)
+    jobs.gate.set()
+
+    assert speculator.take("exports from india") == {"query": "exports from india"}
+    assert ("exports from india", False) not in jobs.calls
+    assert ("exports from india", True) in jobs.calls
+    assert speculator.stats["promoted"] == 1
@@ -0,0 +1,22 @@
+"""Date rewrites between trades (string created_at) and trades_ts (timeseries.py)."""
+from datetime import datetime
+import timeseries as ts
+
+
+def test_native_rewrite_turns_string_ranges_into_dates():
+    pipeline, rewrites = ts.rewrite_for_native([{"$match": {"created_at": {"$gte": "2024-06", "$lte": "2024-06"}}}])
+    assert pipeline[0] == {"$match": {"created_at": {"$gte": datetime(2024, 6, 1), "$lt": datetime(2024, 7, 1)}}}
+    assert rewrites
+
+
+def test_native_rows_get_the_source_shape():
+    pipeline, _ = ts.rewrite_for_native([{"$match": {"created_at": {"$gte": "2024"}}}, {"$limit": 5}])
+    assert pipeline[-2] == {"$unset": "meta"}
+    converted = pipeline[-1]["$set"]["created_at"]["$cond"][1]
+    assert converted == {"$dateToString": {"date": "$created_at", "format": ts.SOURCE_DATE_FORMAT}}
+    assert datetime(2024, 6, 15, 10, 45).strftime(ts.SOURCE_DATE_FORMAT) == "2024-06-15T10:45:00Z"
+
+
+def test_string_rewrite_parses_dates_inside_expr():
+    pipeline, _ = ts.rewrite_for_strings([{"$match": {"$expr": {"$eq": [{"$year": "$created_at"}, 2024]}}}])
+    assert pipeline == [{"$match": {"$expr": {"$eq": [{"$year": {"$toDate": "$created_at"}}, 2024]}}}]
@@ -0,0 +1,393 @@
+"""
+Date-range support for trades.created_at, with time-series storage.
+
+trades.created_at is an ISO-8601 string, so "trades in Q2 2024" is a string
+comparison and daily/monthly trends need a per-document date parse. This
+module adds:
+
+- an ingest/migration path into `trades_ts`, a MongoDB time-series
+  collection (timeField created_at as a native date, metaField
+  {country_id, commodity_id}); servers without time-series support get a
+  regular collection with the same shape and date indexes instead;
+- executor rewrites: on trades_ts, string date comparisons become native
+  date ranges ("2024-06" -> [2024-06-01, 2024-07-01)) and string date
+  parsing/slicing of created_at becomes plain date expressions; on the
+  string-stored trades collection, date operators get a $toDate so the
+  same generated pipeline still runs.
+
+trades_ts is a derived copy of trades, like the year partitions. It is
+queried only while trades still has the fingerprint the copy was built from
+(data_version.record_sync); otherwise date queries run on trades.
+`migrate` rebuilds the copy. `ingest` is the write path for new trades: it
+inserts into trades and trades_ts together, so the copy stays in sync.
+
+  python timeseries.py migrate             # (re)build trades_ts from trades
+  python timeseries.py ingest trades.json  # add an extended-JSON export to both
+"""
+import os
+import re
+import sys
+import argparse
+from datetime import datetime, timedelta, timezone
+from data_version import fingerprint, record_sync, clear_sync, in_sync
+
+TS_COLLECTION = "trades_ts"
+SOURCE = "trades"
+DATE_FIELD = "created_at"
+META_FIELD = "meta"
+META_FIELDS = ("country_id", "commodity_id")
+GRANULARITY = "hours"
+BATCH_SIZE = 5000
+
+DATE_RE = re.compile(r"^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:[T ](\d{2}):(\d{2})(?::(\d{2})(?:\.\d+)?)?)?)?)?(Z|[+-]\d{2}:?\d{2})?$")
+# Expression operators taking a date; on string storage their argument needs $toDate.
+DATE_OPERATORS = {"$year", "$month", "$dayOfMonth", "$dayOfWeek", "$dayOfYear", "$week",
+                  "$hour", "$minute", "$isoWeek", "$isoWeekYear", "$dateTrunc", "$dateToString"}
+SUBSTR_FORMATS = {4: "%Y", 7: "%Y-%m", 10: "%Y-%m-%d", 13: "%Y-%m-%dT%H"}
+COMPARISONS = {"$gt", "$gte", "$lt", "$lte", "$eq", "$ne"}
+# How trades stores created_at ("2024-06-15T10:45:00Z"); rows served from
+# trades_ts are converted back so both copies return the same rows.
+SOURCE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+
+# --- Dates ---
+def parse_date(text):
+    """
+    ISO text (full or partial: "2024", "2024-06", "2024-06-15T10:45:00Z") ->
+    (start, end, precise). end is the exclusive end of a partial date.
+    Returns None for text that is not a date.
+    """
+    match = DATE_RE.match(text.strip()) if isinstance(text, str) else None
+    if not match:
+        return None
+    year, month, day, hour, minute, second, _ = match.groups()
+    if month is None:
+        return datetime(int(year), 1, 1), datetime(int(year) + 1, 1, 1), False
+    if day is None:
+        start = datetime(int(year), int(month), 1)
+        end = datetime(int(year) + (month == "12"), int(month) % 12 + 1, 1)
+        return start, end, False
+    try:
+        value = datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if value.tzinfo is not None:
+        # Stored as naive UTC, the way pymongo returns dates.
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    if hour is None:
+        return value, value + timedelta(days=1), False
+    return value, value, True
+
+
+def to_timeseries_doc(doc):
+    """A trades document with a native created_at and the metadata subdocument."""
+    doc = dict(doc)
+    value = doc.get(DATE_FIELD)
+    if isinstance(value, str):
+        parsed = parse_date(value)
+        if parsed is None:
+            return None
+        doc[DATE_FIELD] = parsed[0]
+    elif not isinstance(value, datetime):
+        return None
+    # Kept top-level too, so generated $lookup stages work unchanged.
+    doc[META_FIELD] = {field: doc.get(field) for field in META_FIELDS}
+    return doc
+
+
+# --- Storage ---
+def available(db):
+    return TS_COLLECTION in db.list_collection_names()
+
+
+def ensure_collection(db, granularity=GRANULARITY):
+    """Creates trades_ts; returns "timeseries" or "indexed" (fallback layout)."""
+    if available(db):
+        options = db.get_collection(TS_COLLECTION).options()
+        return "timeseries" if "timeseries" in options else "indexed"
+    try:
+        db.create_collection(TS_COLLECTION, timeseries={
+            "timeField": DATE_FIELD, "metaField": META_FIELD, "granularity": granularity})
+        mode = "timeseries"
+    except Exception as e:
+        print(f"Time-series collections unavailable ({e}); using an indexed collection.")
+        db.create_collection(TS_COLLECTION)
+        mode = "indexed"
+    collection = db.get_collection(TS_COLLECTION)
+    for field in META_FIELDS:
+        collection.create_index([(f"{META_FIELD}.{field}", 1), (DATE_FIELD, 1)])
+    if mode == "indexed":
+        collection.create_index(DATE_FIELD)
+    return mode
+
+
+def _batches(documents, batch_size):
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _insert(db, documents, batch_size):
+    collection = db.get_collection(TS_COLLECTION)
+    inserted, skipped = 0, 0
+    for batch in _batches(documents, batch_size):
+        converted = [doc for doc in map(to_timeseries_doc, batch) if doc is not None]
+        skipped += len(batch) - len(converted)
+        if converted:
+            collection.insert_many(converted, ordered=False)
+            inserted += len(converted)
+    return inserted, skipped
+
+
+def usable(db):
+    """trades_ts exists and still matches trades."""
+    return available(db) and in_sync(db, TS_COLLECTION)
+
+
+def migrate(db, granularity=GRANULARITY, batch_size=BATCH_SIZE):
+    """(Re)builds trades_ts from trades, converting created_at to native dates."""
+    # Date queries go back to trades while the copy is rebuilt; the state is
+    # taken first, so writes during the copy leave it out of sync.
+    clear_sync(db, TS_COLLECTION)
+    state = fingerprint(db.get_collection(SOURCE))
+    if available(db):
+        db.drop_collection(TS_COLLECTION)
+    mode = ensure_collection(db, granularity)
+    cursor = db.get_collection(SOURCE).find({}, batch_size=batch_size)
+    inserted, skipped = _insert(db, cursor, batch_size)
+    record_sync(db, TS_COLLECTION, SOURCE, state)
+    print(f"Copied {inserted} trade(s) into '{TS_COLLECTION}' ({mode}); skipped {skipped} without a date.")
+    return True
+
+
+def ingest(db, path, granularity=GRANULARITY, batch_size=BATCH_SIZE):
+    """
+    Loads a JSON array export (extended JSON, like db/trades.json) into trades
+    and trades_ts. Documents already in trades are skipped. A copy that was in
+    sync before stays in sync.
+    """
+    from bson import json_util
+    source = db.get_collection(SOURCE)
+    synced = in_sync(db, TS_COLLECTION) or (
+        not source.estimated_document_count()
+        and not (available(db) and db.get_collection(TS_COLLECTION).estimated_document_count()))
+    ensure_collection(db, granularity)
+    with open(path, encoding="utf-8") as handle:
+        documents = json_util.loads(handle.read())
+    added, inserted, skipped = 0, 0, 0
+    for batch in _batches(documents, batch_size):
+        ids = [doc["_id"] for doc in batch if "_id" in doc]
+        existing = set(source.distinct("_id", {"_id": {"$in": ids}})) if ids else set()
+        new = [doc for doc in batch if doc.get("_id") not in existing or "_id" not in doc]
+        if not new:
+            continue
+        source.insert_many(new, ordered=False)   # assigns _id to documents without one
+        added += len(new)
+        batch_inserted, batch_skipped = _insert(db, new, batch_size)
+        inserted, skipped = inserted + batch_inserted, skipped + batch_skipped
+    if synced:
+        record_sync(db, TS_COLLECTION, SOURCE, fingerprint(source))
+    print(f"Ingested {added} new trade(s) from {path}; {inserted} into '{TS_COLLECTION}', "
+          f"skipped {skipped} without a date.")
+    if not synced:
+        print(f"'{TS_COLLECTION}' was already out of sync with '{SOURCE}'; run migrate to rebuild it.")
+    return True
+
+
+# --- Pipeline rewrites ---
+def uses_dates(pipeline):
+    """True if any stage mentions created_at (as a key or a "$created_at" path)."""
+    def walk(value):
+        if isinstance(value, dict):
+            return any(key == DATE_FIELD or key.startswith(f"{DATE_FIELD}.") or walk(v) for key, v in value.items())
+        if isinstance(value, list):
+            return any(walk(v) for v in value)
+        return value == f"${DATE_FIELD}"
+    return walk(pipeline)
+
+
+# A partial date ("2024-06") stands for its whole period [start, end).
+PERIOD_BOUNDS = {"$gte": ("$gte", 0), "$gt": ("$gte", 1), "$lt": ("$lt", 0), "$lte": ("$lt", 1)}
+
+
+def _date_predicate(predicate, rewrites):
+    """String predicate on created_at -> native date predicate."""
+    if isinstance(predicate, str):
+        parsed = parse_date(predicate)
+        if parsed is None:
+            return predicate
+        start, end, precise = parsed
+        rewrites.append(f"{DATE_FIELD} == '{predicate}' -> date range")
+        return start if precise else {"$gte": start, "$lt": end}
+    if not isinstance(predicate, dict):
+        return predicate
+    result = {}
+    for operator, operand in predicate.items():
+        if operator == "$regex" and isinstance(operand, str) and operand.startswith("^"):
+            prefix = parse_date(operand[1:].rstrip("T"))
+            if prefix is not None and not prefix[2]:
+                result["$gte"], result["$lt"] = prefix[0], prefix[1]
+                rewrites.append(f"{DATE_FIELD} regex '{operand}' -> date range")
+                continue
+        if operator == "$options" and "$regex" not in result and "$regex" in predicate and "$gte" in result:
+            continue
+        parsed = parse_date(operand) if isinstance(operand, str) else None
+        if operator == "$in" and isinstance(operand, list):
+            result[operator] = [(parse_date(v) or (v,))[0] for v in operand]
+            continue
+        if parsed is None or operator not in COMPARISONS:
+            result[operator] = operand
+            continue
+        start, end, precise = parsed
+        rewrites.append(f"{DATE_FIELD} {operator} '{operand}' -> date")
+        if precise:
+            result[operator] = start
+        elif operator in PERIOD_BOUNDS:
+            bound, use_end = PERIOD_BOUNDS[operator]
+            result[bound] = end if use_end else start
+        elif operator == "$eq":
+            result["$gte"], result["$lt"] = start, end
+        else:  # $ne
+            result["$not"] = {"$gte": start, "$lt": end}
+    return result
+
+
+def _native_expression(value, rewrites):
+    """Expression rewrites for native dates: no parsing, slicing becomes formatting."""
+    if isinstance(value, list):
+        return [_native_expression(v, rewrites) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if len(value) == 1:
+        (operator, argument), = value.items()
+        if operator in ("$toDate", "$dateFromString"):
+            source = argument.get("dateString") if isinstance(argument, dict) else argument
+            if source == f"${DATE_FIELD}":
+                rewrites.append(f"{operator} of {DATE_FIELD} dropped")
+                return f"${DATE_FIELD}"
+        if (operator in ("$substr", "$substrBytes", "$substrCP") and isinstance(argument, list)
+                and len(argument) == 3 and argument[0] == f"${DATE_FIELD}" and argument[1] == 0
+                and argument[2] in SUBSTR_FORMATS):
+            rewrites.append(f"{operator} of {DATE_FIELD} -> $dateToString")
+            return {"$dateToString": {"format": SUBSTR_FORMATS[argument[2]], "date": f"${DATE_FIELD}"}}
+    return {key: _native_expression(v, rewrites) for key, v in value.items()}
+
+
+def _rewrite_match(body, rewrites, leading):
+    result = {}
+    for key, predicate in body.items():
+        if key == DATE_FIELD:
+            result[key] = _date_predicate(predicate, rewrites)
+        elif key in ("$and", "$or", "$nor") and isinstance(predicate, list):
+            result[key] = [_rewrite_match(p, rewrites, False) if isinstance(p, dict) else p for p in predicate]
+        elif key == "$expr":
+            result[key] = _native_expression(predicate, rewrites)
+        elif leading and key in META_FIELDS:
+            # The metaField copy is what the time-series indexes cover.
+            result[f"{META_FIELD}.{key}"] = predicate
+            rewrites.append(f"{key} -> {META_FIELD}.{key}")
+        else:
+            result[key] = predicate
+    return result
+
+
+def rewrite_for_native(pipeline):
+    """Returns (pipeline, rewrites) for running a trades pipeline on trades_ts."""
+    rewrites = []
+    rewritten = []
+    leading = True
+    for stage in pipeline:
+        (name, body), = stage.items()
+        if name == "$match" and isinstance(body, dict):
+            stage = {"$match": _rewrite_match(body, rewrites, leading)}
+        else:
+            stage = {name: _native_expression(body, rewrites)}
+            if name != "$lookup":
+                leading = False
+        rewritten.append(stage)
+    return rewritten + _source_shape(), rewrites
+
+
+def _source_shape():
+    """Stages giving trades_ts rows the trades shape: no meta, created_at as the stored string."""
+    field = f"${DATE_FIELD}"
+    return [
+        {"$unset": META_FIELD},
+        # A row without created_at (e.g. after $group) stays without it.
+        {"$set": {DATE_FIELD: {"$cond": [
+            {"$eq": [{"$type": field}, "date"]},
+            {"$dateToString": {"date": field, "format": SOURCE_DATE_FORMAT}},
+            field,
+        ]}}},
+    ]
+
+
+def _string_expression(value, rewrites):
+    """Date operators on the string field get a $toDate; everything else unchanged."""
+    if isinstance(value, list):
+        return [_string_expression(v, rewrites) for v in value]
+    if not isinstance(value, dict):
+        return value
+    result = {}
+    for key, argument in value.items():
+        if key in DATE_OPERATORS:
+            if argument == f"${DATE_FIELD}":
+                argument = {"$toDate": argument}
+                rewrites.append(f"{key} of {DATE_FIELD} -> $toDate")
+            elif isinstance(argument, dict) and argument.get("date") == f"${DATE_FIELD}":
+                argument = dict(argument, date={"$toDate": f"${DATE_FIELD}"})
+                rewrites.append(f"{key} of {DATE_FIELD} -> $toDate")
+        result[key] = _string_expression(argument, rewrites)
+    return result
+
+
+def _string_match(body, rewrites):
+    """Query predicates compare strings as they are; only $expr needs the $toDate."""
+    result = {}
+    for key, predicate in body.items():
+        if key == "$expr":
+            result[key] = _string_expression(predicate, rewrites)
+        elif key in ("$and", "$or", "$nor") and isinstance(predicate, list):
+            result[key] = [_string_match(p, rewrites) if isinstance(p, dict) else p for p in predicate]
+        else:
+            result[key] = predicate
+    return result
+
+
+def rewrite_for_strings(pipeline):
+    """Returns (pipeline, rewrites) for the ISO-string trades collection."""
+    rewrites = []
+    rewritten = [{name: _string_match(body, rewrites) if name == "$match" and isinstance(body, dict)
+                  else _string_expression(body, rewrites)}
+                 for stage in pipeline for name, body in stage.items()]
+    return rewritten, rewrites
+
+
+def main():
+    from dotenv import load_dotenv
+    import pymongo
+
+    parser = argparse.ArgumentParser(description="Time-series storage for trades.created_at")
+    parser.add_argument("--granularity", default=GRANULARITY, choices=["seconds", "minutes", "hours"])
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help=f"(re)build {TS_COLLECTION} from {SOURCE}")
+    ingest_parser = sub.add_parser("ingest", help=f"load a JSON export into {SOURCE} and {TS_COLLECTION}")
+    ingest_parser.add_argument("path")
+    args = parser.parse_args()
+
+    load_dotenv()
+    db = pymongo.MongoClient(os.getenv("MONGO_ATLAS_URI")).get_database("Trade")
+    if args.command == "migrate":
+        ok = migrate(db, args.granularity)
+    else:
+        ok = ingest(db, args.path, args.granularity)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -43,6 +43,8 @@ const Header = React.forwardRef(
 
     // AssemblyAI API key - should be in environment variable
     const ASSEMBLYAI_API_KEY = import.meta.env.VITE_ASSEMBLYAI_API_KEY || "";
+    // Backend proxy (Backend/assemblyai_proxy.py) - keeps the API key off the browser
+    const STT_PROXY_URL = import.meta.env.VITE_STT_PROXY_URL || "";
 
     // Connection parameters for AssemblyAI v3 Streaming API
     const CONNECTION_PARAMS = {
@@ -55,6 +57,10 @@ const Header = React.forwardRef(
       const params = new URLSearchParams();
       params.append("sample_rate", CONNECTION_PARAMS.sample_rate.toString());
       params.append("format_turns", CONNECTION_PARAMS.format_turns.toString());
+      if (STT_PROXY_URL) {
+        // The proxy adds the Authorization header upstream
+        return `${STT_PROXY_URL}?${params.toString()}`;
+      }
       // Try adding token as URL parameter (if API supports it)
       if (apiKey) {
         params.append("token", apiKey);
@@ -165,9 +171,9 @@ const Header = React.forwardRef(
     };
 
     const startRecording = async () => {
-      if (!ASSEMBLYAI_API_KEY) {
+      if (!ASSEMBLYAI_API_KEY && !STT_PROXY_URL) {
         alert(
-          "AssemblyAI API key not found. Please set VITE_ASSEMBLYAI_API_KEY in your .env file."
+          "AssemblyAI API key not found. Please set VITE_ASSEMBLYAI_API_KEY (or VITE_STT_PROXY_URL) in your .env file."
         );
         return;
       }